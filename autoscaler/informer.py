@@ -0,0 +1,109 @@
+# Watch-driven local caches of Kubernetes objects for the puller and autoscaler.
+#
+# Every component image that uses it ships its own copy of this file (puller/,
+# autoscaler/); keep them identical.
+#
+# An Informer lists a resource once, then follows a watch from the list's
+# resourceVersion. When the server closes the stream (every WATCH_TIMEOUT
+# seconds) or it breaks, the watch resumes from the last event seen; only a
+# 410 Gone (that version was compacted away) lists again. Control loops read
+# the cache instead of calling the API, and `wait_for` / `wait_for_change`
+# wake up on the event that changes it instead of polling.
+import threading
+import time
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+
+WATCH_TIMEOUT = 300  # seconds the server keeps a watch open
+RETRY_DELAY   = 2    # seconds before retrying after an API error
+
+
+def object_key(obj):
+    return (obj.metadata.namespace or "", obj.metadata.name)
+
+
+class Informer:
+    """Objects returned by `list_func(*args, **kwargs)`, kept current by a watch.
+
+    `version` increases with every change, so a reader can tell whether
+    anything happened since it last looked.
+    """
+
+    def __init__(self, list_func, *args, **kwargs):
+        self._list_func = list_func
+        self._args = args
+        self._kwargs = kwargs
+        self._objects = {}
+        self._cond = threading.Condition()
+        self._synced = False
+        self.version = 0
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _changed(self):
+        self.version += 1
+        self._cond.notify_all()
+
+    def _run(self):
+        resource_version = None
+        while True:
+            try:
+                if resource_version is None:
+                    listing = self._list_func(*self._args, **self._kwargs)
+                    with self._cond:
+                        self._objects = {object_key(o): o for o in listing.items}
+                        self._synced = True
+                        self._changed()
+                    resource_version = listing.metadata.resource_version
+
+                w = watch.Watch()
+                for event in w.stream(self._list_func, *self._args,
+                                      resource_version=resource_version,
+                                      timeout_seconds=WATCH_TIMEOUT, **self._kwargs):
+                    obj = event["object"]
+                    resource_version = obj.metadata.resource_version
+                    with self._cond:
+                        if event["type"] == "DELETED":
+                            self._objects.pop(object_key(obj), None)
+                        else:
+                            self._objects[object_key(obj)] = obj
+                        self._changed()
+            except ApiException as e:
+                if e.status == 410:  # resourceVersion too old: relist
+                    resource_version = None
+                else:
+                    print(f"Watch error ({self._list_func.__name__}): {e}")
+                    time.sleep(RETRY_DELAY)
+            except Exception as e:
+                print(f"Watch error ({self._list_func.__name__}): {e}")
+                resource_version = None
+                time.sleep(RETRY_DELAY)
+
+    def wait_synced(self, timeout=None):
+        """Blocks until the first list has been loaded; returns whether it has."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._synced, timeout)
+
+    def items(self):
+        """Cached objects, sorted by namespace and name."""
+        with self._cond:
+            return [self._objects[key] for key in sorted(self._objects)]
+
+    def get(self, name, namespace=None):
+        with self._cond:
+            return self._objects.get((namespace or "", name))
+
+    def wait_for(self, predicate, timeout=None):
+        """Blocks until `predicate(items)` is true or `timeout` passes; returns its last value."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self._synced and predicate([self._objects[k] for k in sorted(self._objects)]),
+                timeout)
+
+    def wait_for_change(self, version, timeout=None):
+        """Blocks until the cache differs from `version` or `timeout` passes; returns the current version."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
@@ -1,34 +1,172 @@
 import os
 import redis
 import time
-import tempfile
-import json
+import yaml
+import jobstate
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from informer import Informer
+from scaling import RateEstimator, ScalingState, ThresholdPolicy, CostPolicy
 from kubernetes import client, config, utils
 from kubernetes.client import ApiException
 
 # --- AutoScaling constants ---
 THRESHOLD        = float(os.getenv("SCALING_THRESHOLD", 10.0))
 NAMESPACE_PREFIX = "ds-clmpi"
-MANIFEST_DIR     = "/manifests"   # <-- montado desde el ConfigMap
+MANIFEST_DIR     = os.getenv("MANIFEST_DIR", "/manifests")   # <-- montado desde el ConfigMap
+PLACEHOLDER      = "PLACE_HOLDER"
+MANIFEST_FILES   = [
+    "puller-sa.yaml",
+    "puller-role.yaml",
+    "puller-rolebinding.yaml",
+    "puller-deployment.yaml",
+    "observer-sa.yaml",
+    "observer-role.yaml",
+    "observer-rolebinding.yaml",
+]
+PROVISION_WORKERS = int(os.getenv("PROVISION_WORKERS", 4))
+
+# "cost" sizes the cluster from queued render cost and arrival rate;
+# "threshold" keeps the original pending-jobs-per-namespace rule.
+SCALING_POLICY       = os.getenv("SCALING_POLICY", "cost")
+TARGET_QUEUE_WAIT    = float(os.getenv("TARGET_QUEUE_WAIT", 30))
+MIN_NAMESPACES       = int(os.getenv("MIN_NAMESPACES", 1))
+MAX_NAMESPACES       = int(os.getenv("MAX_NAMESPACES", 8))
+MAX_SCALE_STEP       = int(os.getenv("MAX_SCALE_STEP", 2))
+SCALE_HYSTERESIS     = float(os.getenv("SCALE_HYSTERESIS", 0.25))
+SCALE_UP_COOLDOWN    = float(os.getenv("SCALE_UP_COOLDOWN", 10))
+SCALE_DOWN_COOLDOWN  = float(os.getenv("SCALE_DOWN_COOLDOWN", 60))
+NAMESPACE_THROUGHPUT = float(os.getenv("NAMESPACE_THROUGHPUT", 2e6))  # pixel-samples/s, initial guess
+RATE_HALF_LIFE       = float(os.getenv("RATE_HALF_LIFE", 30))
+
+# Failed jobs are retried after RETRY_BASE_DELAY * 2^(attempts - 1) seconds (at
+# most RETRY_MAX_DELAY); a job that failed MAX_ATTEMPTS times is quarantined
+# instead and its clients are told it failed. Its record expires after
+# jobstate.JOB_TTL; every PRUNE_INTERVAL seconds the expired ones leave
+# jobs:quarantined.
+MAX_ATTEMPTS     = int(os.getenv("MAX_ATTEMPTS", 3))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 2))
+RETRY_MAX_DELAY  = float(os.getenv("RETRY_MAX_DELAY", 120))
+PRUNE_INTERVAL   = float(os.getenv("PRUNE_INTERVAL", 3600))
+
+# Recovery of the namespace a job failed in escalates with each failure
+# incident (a status check in which jobs that had not failed there before
+# failed there) within RECOVERY_WINDOW seconds: the first only retries the
+# jobs, RESTART_AFTER incidents restart the namespace's unhealthy pods (the MPI
+# master if all look healthy), REBUILD_AFTER rebuild the namespace. A success
+# in the namespace starts over, failures within RECOVERY_GRACE seconds of a
+# recovery action are put down to that action, and a job failing again in the
+# same namespace never escalates, so one poison job cannot recycle namespaces.
+RECOVERY_WINDOW = float(os.getenv("RECOVERY_WINDOW", 600))
+RECOVERY_GRACE  = float(os.getenv("RECOVERY_GRACE", 60))
+RESTART_AFTER   = int(os.getenv("RESTART_AFTER", 2))
+REBUILD_AFTER   = int(os.getenv("REBUILD_AFTER", 3))
+MPI_MASTER_POD  = "mpi-node-0"
 
 # --- Redis setup ---
 redis_host = os.getenv("REDIS_HOST", "redis")
-r = redis.Redis(host=redis_host, port=6379, db=0)
+r = metrics.instrument_redis(redis.Redis(host=redis_host, port=6379, db=0))
 
 # --- Kubernetes setup ---
 config.load_incluster_config()
 k8s_client = client.ApiClient()
 core_v1    = client.CoreV1Api()
 
+# Gives up on a failed job: marks it quarantined and reports the failure to
+# everyone waiting on it (coalesced submissions and, for a tile, the split job
+# it belongs to), as the socket handler's FINISH_JOB reports success. Releases
+# the in-flight entry, so an identical submission queues a fresh render.
+QUARANTINE_JOB = r.register_script(jobstate.LUA_TRANSITION + """
+local job_uuid, reason, now = ARGV[1], ARGV[2], ARGV[3]
+if not transition(job_uuid, 'fail', 'quarantined', '', now) then
+    return false
+end
+redis.call('HINCRBY', 'job:' .. job_uuid, 'attempts', 1)
+local jobs = {job_uuid}
+local parent = redis.call('HGET', 'tile_parent', job_uuid)
+if parent then
+    table.insert(jobs, parent)
+end
+for _, job in ipairs(jobs) do
+    local targets = redis.call('SMEMBERS', 'job_waiters:' .. job)
+    table.insert(targets, job)
+    for _, target in ipairs(targets) do
+        redis.call('HSET', 'failed_tasks', target, reason)
+        redis.call('HSET', 'completed_at', target, now)
+        redis.call('PUBLISH', 'job_updates', cjson.encode({uuid = target, event = 'failed', error = reason}))
+    end
+    local key = redis.call('HGET', 'task_keys', job)
+    if key and redis.call('HGET', 'inflight_jobs', key) == job then
+        redis.call('HDEL', 'inflight_jobs', key)
+    end
+end
+return true
+""")
+
+
+def namespace_index(ns_name: str) -> int:
+    return int(ns_name[len(NAMESPACE_PREFIX):] or 0)
+
+
+# Watch-driven caches: the control loop reads namespaces and pods from memory
+# and wakes up as soon as a namespace appears or disappears. Only the pods of
+# the fractal namespaces' components are cached, not every pod of the cluster.
+FRACTAL_POD_SELECTOR = "app in (mpi-node,observer,puller)"
+namespace_cache = Informer(core_v1.list_namespace)
+pod_cache       = Informer(core_v1.list_pod_for_all_namespaces, label_selector=FRACTAL_POD_SELECTOR)
+
 
 def list_namespaces():
     return sorted(
-        ns.metadata.name 
-        for ns in core_v1.list_namespace().items
-        if ns.metadata.name.startswith(NAMESPACE_PREFIX)
+        (ns.metadata.name
+         for ns in namespace_cache.items()
+         if ns.metadata.name.startswith(NAMESPACE_PREFIX)),
+        key=namespace_index
     )
 
 
+# --- Namespace provisioning ---
+def load_templates():
+    """Parses the per-namespace manifests once; returns [(file name, object)]."""
+    templates = []
+    for fname in MANIFEST_FILES:
+        path = os.path.join(MANIFEST_DIR, fname)
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            templates.extend((fname, obj) for obj in yaml.safe_load_all(f) if obj)
+    return templates
+
+
+def render(template, ns_name: str):
+    """Copy of a manifest object with every PLACE_HOLDER value set to ns_name."""
+    if isinstance(template, dict):
+        return {k: render(v, ns_name) for k, v in template.items()}
+    if isinstance(template, list):
+        return [render(v, ns_name) for v in template]
+    return ns_name if template == PLACEHOLDER else template
+
+
+TEMPLATES = load_templates()
+
+# Objects inside a namespace don't depend on each other at creation time, so
+# they are applied in parallel; whole namespaces are provisioned in the
+# background so the control loop never waits on the API server.
+apply_pool     = ThreadPoolExecutor(max_workers=len(TEMPLATES) or 1)
+provision_pool = ThreadPoolExecutor(max_workers=PROVISION_WORKERS)
+provisioning   = {}   # namespace -> Future of deploy_namespace
+redeploys      = {}   # namespace -> "deleting" | "provisioning"
+
+
+def apply_object(fname: str, obj, ns_name: str):
+    try:
+        utils.create_from_dict(k8s_client, obj, namespace=ns_name)
+    except utils.FailToCreateError as e:
+        if any(err.status != 409 for err in e.api_exceptions):
+            raise
+    print(f"  ↳ Applied {fname} → {ns_name}")
+
+
 def deploy_namespace(ns_name: str):
     print(f"[Autoscaler] Creating namespace: {ns_name}")
     try:
@@ -39,118 +177,289 @@ def deploy_namespace(ns_name: str):
         if e.status != 409:
             raise
 
-    ordered_manifests = [
-        "puller-sa.yaml",
-        "puller-role.yaml",
-        "puller-rolebinding.yaml",
-        "puller-deployment.yaml",
-        "observer-sa.yaml",
-        "observer-role.yaml",
-        "observer-rolebinding.yaml",
-    ]
-
-    for fname in ordered_manifests:
-        path = os.path.join(MANIFEST_DIR, fname)
-        if not os.path.exists(path):
-            continue
+    futures = [apply_pool.submit(apply_object, fname, render(obj, ns_name), ns_name)
+               for fname, obj in TEMPLATES]
+    for future in futures:
+        future.result()
 
-        with open(path) as f:
-            content = f.read()
 
-        content = content.replace(
-            "namespace: PLACE_HOLDER",
-            f"namespace: {ns_name}"
-        )
+def provision_namespace(ns_name: str):
+    """Starts deploying a namespace in the background."""
+    if ns_name not in provisioning:
+        provisioning[ns_name] = provision_pool.submit(deploy_namespace, ns_name)
 
-        with tempfile.NamedTemporaryFile("w+", suffix=".yaml") as tmp:
-            tmp.write(content)
-            tmp.flush()
-            utils.create_from_yaml(
-                k8s_client,
-                tmp.name,
-                namespace=ns_name
-            )
-        print(f"  ↳ Applied {fname} → {ns_name}")
 
+def collect_provisioned():
+    for ns_name, future in list(provisioning.items()):
+        if not future.done():
+            continue
+        del provisioning[ns_name]
+        if future.exception():
+            print(f"[Autoscaler] Failed to provision {ns_name}: {future.exception()}")
+        else:
+            print(f"[Autoscaler] Namespace ready: {ns_name}")
 
-def delete_namespace(ns_name: str):
-    print(f"[Autoscaler] Deleting namespace: {ns_name}")
-    core_v1.delete_namespace(name=ns_name)
 
+def redeploy_namespace(ns_name: str):
+    """Starts tearing a namespace down; advance_redeploys brings it back."""
+    if ns_name in redeploys:
+        return
+    try:
+        delete_namespace(ns_name)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+    redeploys[ns_name] = "deleting"
 
-def get_pending_tasks_len() -> int:
-    return r.llen("pending_tasks")
 
+def advance_redeploys(namespaces):
+    """One step of every namespace redeploy: deleting → provisioning → done."""
+    for ns_name, state in list(redeploys.items()):
+        if state == "deleting" and ns_name not in namespaces:
+            provision_namespace(ns_name)
+            redeploys[ns_name] = "provisioning"
+        elif state == "provisioning" and ns_name not in provisioning:
+            del redeploys[ns_name]
+            print(f"[Autoscaler] Redeployed {ns_name}")
 
-def get_running_tasks():
-    return r.lrange("running_tasks", 0, -1)
 
+def pod_is_ready(pod):
+    return (pod.status.phase == "Running"
+            and bool(pod.status.container_statuses)
+            and all(cs.ready for cs in pod.status.container_statuses))
 
-def auto_scaling():
-    pending_tasks_len = get_pending_tasks_len()
-    namespaces = list_namespaces()
-    count = len(namespaces)
-    ratio = (pending_tasks_len / count) if count else pending_tasks_len
 
-    print(f"[Autoscaler] tasks={pending_tasks_len}, namespaces={count}, ratio={ratio:.2f}")
+def restart_unhealthy_pods(ns_name: str):
+    """Deletes the namespace's unready pods (or its MPI master if every pod is
+    ready); their StatefulSet or Deployment recreates them."""
+    pods = [p for p in pod_cache.items() if p.metadata.namespace == ns_name]
+    names = [p.metadata.name for p in pods if not pod_is_ready(p)] or [MPI_MASTER_POD]
+    for name in names:
+        print(f"[Autoscaler] Restarting pod {name} in {ns_name}")
+        try:
+            core_v1.delete_namespaced_pod(name, ns_name)
+        except ApiException as e:
+            if e.status != 404:
+                raise
 
-    if ratio > THRESHOLD:
-        new_ns = f"{NAMESPACE_PREFIX}{count+1}"
-        deploy_namespace(new_ns)
 
-    elif ratio < THRESHOLD and count > 1:
-        last_ns = namespaces[-1]
-        delete_namespace(last_ns)
+def delete_namespace(ns_name: str):
+    print(f"[Autoscaler] Deleting namespace: {ns_name}")
+    core_v1.delete_namespace(name=ns_name)
 
 
-def tasks_status_check():
-    running_tasks = get_running_tasks()
-    
-    for task_data in running_tasks:
+def get_pending_tasks_len() -> int:
+    return r.zcard("pending_tasks")
+
+
+# --- Scaling policy ---
+if SCALING_POLICY == "threshold":
+    policy = ThresholdPolicy(THRESHOLD)
+else:
+    policy = CostPolicy(TARGET_QUEUE_WAIT, MIN_NAMESPACES, MAX_NAMESPACES, MAX_SCALE_STEP,
+                        SCALE_HYSTERESIS, SCALE_UP_COOLDOWN, SCALE_DOWN_COOLDOWN)
+
+arrivals    = RateEstimator(RATE_HALF_LIFE)
+completions = RateEstimator(RATE_HALF_LIFE)
+namespace_throughput = NAMESPACE_THROUGHPUT
+
+
+def namespace_is_idle(ns_name: str) -> bool:
+    if r.llen(f"processing:{ns_name}"):
+        return False
+    for job_uuid in jobstate.namespace_jobs(r, ns_name):
+        job = jobstate.get_job(r, job_uuid)
+        if job and job["status"] == "running":
+            return False
+    return True
+
+
+def finish_draining(namespaces):
+    """Deletes draining namespaces once their puller has nothing left to run."""
+    for ns_name in r.smembers("draining_namespaces"):
+        ns_name = ns_name.decode()
+        if ns_name not in namespaces:
+            r.srem("draining_namespaces", ns_name)
+        elif namespace_is_idle(ns_name):
+            delete_namespace(ns_name)
+            r.srem("draining_namespaces", ns_name)
+
+
+def auto_scaling(namespaces):
+    global namespace_throughput
+
+    # Namespaces still being provisioned count as capacity already on its way
+    namespaces = sorted(set(namespaces) | set(provisioning), key=namespace_index)
+    finish_draining(namespaces)
+    draining = {ns.decode() for ns in r.smembers("draining_namespaces")}
+    active = [ns for ns in namespaces if ns not in draining]
+    count = len(active)
+
+    counters = jobstate.counters(r)
+    queued_cost = max(counters.get("queued_cost", 0.0), 0.0)
+    arrival_rate = arrivals.update(counters.get("submitted_cost", 0.0))
+    completion_rate = completions.update(counters.get("completed_cost", 0.0))
+
+    # Only a saturated cluster tells us what one namespace can render per second
+    if count and queued_cost > 0 and completion_rate > 0:
+        namespace_throughput = 0.8 * namespace_throughput + 0.2 * (completion_rate / count)
+
+    # Lets the server estimate start times for new submissions
+    r.hset("job_counters", "throughput", namespace_throughput * count)
+
+    state = ScalingState(count, get_pending_tasks_len(), queued_cost, arrival_rate, namespace_throughput)
+    desired = policy.desired(state)
+
+    metrics.QUEUE_DEPTH.set(state.queued_jobs)
+    metrics.QUEUED_COST.set(queued_cost)
+    metrics.COST_RATE.labels("arrival").set(arrival_rate)
+    metrics.COST_RATE.labels("completion").set(completion_rate)
+    metrics.COST_RATE.labels("per_namespace").set(namespace_throughput)
+    metrics.NAMESPACES.labels("active").set(count)
+    metrics.NAMESPACES.labels("draining").set(len(draining))
+    metrics.NAMESPACES.labels("provisioning").set(len(provisioning))
+    metrics.SCALING_DECISIONS.labels(
+        "up" if desired > count else "down" if desired < count else "hold").inc()
+
+    print(f"[Autoscaler] tasks={state.queued_jobs}, queued_cost={queued_cost:.0f}, "
+          f"arrival={arrival_rate:.0f}/s, per_ns={namespace_throughput:.0f}/s, "
+          f"namespaces={count} (+{len(draining)} draining), desired={desired}")
+
+    if desired > count:
+        # Reuse draining namespaces first, they are already provisioned
+        for ns_name in sorted(draining, key=namespace_index)[:desired - count]:
+            r.srem("draining_namespaces", ns_name)
+            print(f"[Autoscaler] Cancelled draining of {ns_name}")
+            count += 1
+        used = {namespace_index(ns) for ns in [*namespaces, *redeploys]}
+        index = 1
+        while count < desired:
+            while index in used:
+                index += 1
+            used.add(index)
+            provision_namespace(f"{NAMESPACE_PREFIX}{index}")
+            count += 1
+
+    elif desired < count:
+        # Stop feeding the newest namespaces; they are deleted once idle
+        for ns_name in active[desired:]:
+            r.sadd("draining_namespaces", ns_name)
+            print(f"[Autoscaler] Draining namespace: {ns_name}")
+
+
+# --- Failure recovery ---
+recoveries = {}   # namespace -> {"incidents", "jobs" (uuids failed there), "since", "acted_at"}
+last_prune = 0.0  # time of the last prune of jobs:quarantined
+
+
+def retry_delay(attempts: int) -> float:
+    return min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+
+
+def recover_namespace(ns_name: str, job_uuids):
+    """Escalates the recovery of a namespace in which `job_uuids` just failed."""
+    now = time.time()
+    recovery = recoveries.get(ns_name)
+    if recovery is None or now - recovery["since"] > RECOVERY_WINDOW:
+        recovery = recoveries[ns_name] = {"incidents": 0, "jobs": set(), "since": now, "acted_at": 0.0}
+    new_jobs = set(job_uuids) - recovery["jobs"]
+    recovery["jobs"] |= new_jobs
+    if not new_jobs or now - recovery["acted_at"] < RECOVERY_GRACE:
+        return
+    recovery["incidents"] += 1
+
+    if recovery["incidents"] >= REBUILD_AFTER:
+        print(f"[Status] {recovery['incidents']} failure incidents in {ns_name}. Rebuilding...")
+        del recoveries[ns_name]
+        redeploy_namespace(ns_name)
+    elif recovery["incidents"] >= RESTART_AFTER:
+        print(f"[Status] {recovery['incidents']} failure incidents in {ns_name}. Restarting pods...")
+        recovery["acted_at"] = now
         try:
-            task = json.loads(task_data.decode('utf-8'))
-            status = task.get("status")
-            namespace = task.get("namespace")
-
-            if status == "success":
-                r.lrem("running_tasks", 0, task_data)
-                print(f"[Status] Task success, removed: {task}")
+            restart_unhealthy_pods(ns_name)
+        except ApiException as e:
+            print(f"[Autoscaler] Failed to restart pods in {ns_name}: {e}")
+    else:
+        print(f"[Status] Failure in {ns_name}. Retrying on the same pods.")
 
-            elif status == "fail":
-                r.lrem("running_tasks", 0, task_data)
 
-                # Prepare task for retry: strip status and namespace
-                retry_task = {k: v for k, v in task.items() if k not in ("status", "namespace")}
-
-
-                # push into pending_tasks
-                r.rpush("pending_tasks", json.dumps(retry_task))
-                print(f"[Status] Task failed, re-queued: {retry_task}")
-                
-                if namespace:
-                    print(f"[Status] Task failed in {namespace}. Redeploying...")
-                    delete_namespace(namespace)
-                    # wait until deletion completes
-                    while namespace in list_namespaces():
-                        time.sleep(1)
-                    deploy_namespace(namespace)
-                else:
-                    print(f"[Status] Failed task without namespace: {task}")
+def tasks_status_check():
+    global last_prune
+    succeeded = jobstate.peek_jobs(r, "success")
+    if succeeded:
+        pipe = r.pipeline(transaction=False)
+        for job_uuid in succeeded:
+            pipe.expire(f"job:{job_uuid}", jobstate.JOB_TTL)
+            pipe.hget(f"job:{job_uuid}", "namespace")
+        jobstate.ack_jobs(r, "success", succeeded, client=pipe)
+        namespaces = pipe.execute()[1:-1:2]
+        for job_uuid, namespace in zip(succeeded, namespaces):
+            print(f"[Status] Task success: {job_uuid}")
+            # The namespace works again
+            if namespace:
+                recoveries.pop(namespace.decode(), None)
+
+    failed_in = {}
+    # Retrying or quarantining a job takes it out of jobs:fail
+    for job_uuid in jobstate.peek_jobs(r, "fail"):
+        job = jobstate.get_job(r, job_uuid)
+        if job is None:
+            print(f"[Error] Couldn't find failed task: {job_uuid}")
+            jobstate.ack_jobs(r, "fail", [job_uuid])
+            continue
 
-        except (json.JSONDecodeError, AttributeError) as e:
-            print(f"[Error] Couldn't process task: {task_data}. Error: {e}")
+        attempts = job["attempts"] + 1
+        if attempts >= MAX_ATTEMPTS:
+            reason = f"render failed {attempts} times"
+            if QUARANTINE_JOB(args=[job_uuid, reason, time.time()]):
+                jobstate.expire_job(r, job_uuid)
+                print(f"[Status] Task quarantined after {attempts} attempts: {job_uuid}")
+        elif jobstate.schedule_retry(r, job_uuid, retry_delay(attempts)):
+            # Back into pending_tasks with its original priority once the backoff is over
+            print(f"[Status] Task failed, retrying in {retry_delay(attempts):.0f}s: {job_uuid}")
+        else:
+            print(f"[Error] Couldn't re-queue failed task: {job_uuid}")
+
+        namespace = job.get("namespace")
+        if namespace:
+            failed_in.setdefault(namespace, []).append(job_uuid)
+        else:
+            print(f"[Status] Failed task without namespace: {job_uuid}")
+
+    for namespace, job_uuids in failed_in.items():
+        recover_namespace(namespace, job_uuids)
+
+    jobstate.release_retries(r)
+
+    # Quarantined jobs stay in their index until their record expires
+    if time.time() - last_prune >= PRUNE_INTERVAL:
+        last_prune = time.time()
+        pruned = jobstate.prune_index(r, "quarantined")
+        if pruned:
+            print(f"[Status] Pruned {pruned} expired quarantined tasks")
 
 
 def main_loop():
+    metrics.serve()
+    for informer in (namespace_cache, pod_cache):
+        informer.start()
+    for informer in (namespace_cache, pod_cache):
+        informer.wait_synced()
+
     namespaces = list_namespaces()
     if not namespaces:
         print("[Autoscaler] No namespaces found, creating initial namespace")
         deploy_namespace(f"{NAMESPACE_PREFIX}1")
 
+    version = namespace_cache.version
     while True:
-        auto_scaling()
+        collect_provisioned()
+        namespaces = list_namespaces()
+        advance_redeploys(namespaces)
+        auto_scaling(namespaces)
         tasks_status_check()
-        time.sleep(2)
+        # Every 2 s, or as soon as a namespace is added or removed
+        version = namespace_cache.wait_for_change(version, timeout=2)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+import math
+import time
+
+
+class RateEstimator:
+    """Exponentially weighted rate of a monotonic counter (units per second)."""
+
+    def __init__(self, half_life, initial=0.0):
+        self.half_life = half_life
+        self.rate = initial
+        self._last_value = None
+        self._last_time = None
+        self._seeded = False
+
+    def update(self, value, now=None):
+        now = time.monotonic() if now is None else now
+        if self._last_value is not None and now > self._last_time:
+            dt = now - self._last_time
+            sample = max(value - self._last_value, 0.0) / dt
+            if self._seeded:
+                alpha = 1 - 0.5 ** (dt / self.half_life)
+                self.rate += alpha * (sample - self.rate)
+            else:
+                self.rate, self._seeded = sample, True
+        self._last_value, self._last_time = value, now
+        return self.rate
+
+
+class ScalingState:
+    """Snapshot of the cluster the policies decide on."""
+
+    def __init__(self, namespaces, queued_jobs, queued_cost, arrival_rate, service_rate):
+        self.namespaces = namespaces      # active (non-draining) namespaces
+        self.queued_jobs = queued_jobs
+        self.queued_cost = queued_cost    # pixel-samples waiting in pending_tasks
+        self.arrival_rate = arrival_rate  # pixel-samples submitted per second
+        self.service_rate = service_rate  # pixel-samples one namespace renders per second
+
+
+class ThresholdPolicy:
+    """The original rule: one namespace up or down around a jobs-per-namespace ratio."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def desired(self, state):
+        count = state.namespaces
+        ratio = (state.queued_jobs / count) if count else state.queued_jobs
+        if ratio > self.threshold:
+            return count + 1
+        if ratio < self.threshold and count > 1:
+            return count - 1
+        return count
+
+
+class CostPolicy:
+    """Sizes the cluster so queued work drains within `target_wait` seconds.
+
+    Capacity needed is the predicted arrival rate plus the backlog spread over
+    the target wait, divided by what one namespace renders per second. Scaling
+    up may add up to `max_step` namespaces at once. Scaling down needs the
+    demand to fall below the current size by the `hysteresis` fraction. Both
+    directions then respect their cooldowns.
+    """
+
+    def __init__(self, target_wait, min_namespaces, max_namespaces, max_step,
+                 hysteresis, up_cooldown, down_cooldown):
+        self.target_wait = target_wait
+        self.min_namespaces = min_namespaces
+        self.max_namespaces = max_namespaces
+        self.max_step = max_step
+        self.hysteresis = hysteresis
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self._last_up = float('-inf')
+        self._last_down = float('-inf')
+
+    def needed(self, state):
+        demand = state.arrival_rate + state.queued_cost / self.target_wait
+        return math.ceil(demand / state.service_rate) if state.service_rate > 0 else state.namespaces
+
+    def desired(self, state, now=None):
+        now = time.monotonic() if now is None else now
+        count = state.namespaces
+        needed = min(max(self.needed(state), self.min_namespaces), self.max_namespaces)
+
+        if needed > count and now - self._last_up >= self.up_cooldown:
+            self._last_up = now
+            return min(needed, count + self.max_step)
+
+        if (needed < count * (1 - self.hysteresis)
+                and now - self._last_down >= self.down_cooldown
+                and now - self._last_up >= self.down_cooldown):
+            self._last_down = now
+            return max(needed, count - self.max_step, self.min_namespaces)
+
+        return count
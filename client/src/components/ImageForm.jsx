@@ -57,7 +57,14 @@ export default function ImageForm() {
       navigate(`/loading/${uuid}`);
     } catch (err) {
       console.error(err);
-      setError('Error al enviar los parámetros.');
+      const response = err.response;
+      if (response && (response.status === 429 || response.status === 400) && response.data.error) {
+        // Rechazado por control de admisión: el servidor indica cuándo reintentar
+        const retry = response.data.retry_after ? ` Reintente en ${response.data.retry_after} s.` : '';
+        setError(`${response.data.error}.${retry}`);
+      } else {
+        setError('Error al enviar los parámetros.');
+      }
     } finally {
       setLoading(false);
     }
@@ -1,7 +1,7 @@
 import React, { useEffect, useState } from 'react';
 import { useParams, useNavigate } from 'react-router-dom';
-import { Card, Button, Container, Spinner, Row, Col } from 'react-bootstrap';
-import { getImage } from '../services/api';
+import { Card, Button, Container, Spinner, ProgressBar, Row, Col } from 'react-bootstrap';
+import { getImage, getPreview, jobEventsUrl } from '../services/api';
 
 export default function Loading() {
   const { uuid } = useParams();
@@ -9,6 +9,8 @@ export default function Loading() {
   const [imageSrc, setImageSrc] = useState(null);
   const [error, setError] = useState(null);
   const [params, setParams] = useState(null);
+  const [progress, setProgress] = useState(null);
+  const [previewSrc, setPreviewSrc] = useState(null);
 
   useEffect(() => {
     // Recuperar parámetros enviados desde localStorage
@@ -17,20 +19,70 @@ export default function Loading() {
   }, []);
 
   useEffect(() => {
-    const interval = setInterval(async () => {
+    let interval = null;
+    let events = null;
+    let hasPreview = false;
+
+    const fetchPreview = async (previewUuid) => {
+      if (hasPreview) return;
+      hasPreview = true;
       try {
-        const blob = await getImage(uuid);
+        const blob = await getPreview(previewUuid);
         if (blob) {
-          setImageSrc(URL.createObjectURL(blob));
+          setPreviewSrc(URL.createObjectURL(blob));
+        } else {
+          hasPreview = false;
+        }
+      } catch {
+        // Sin vista previa seguimos esperando la imagen final
+        hasPreview = false;
+      }
+    };
+
+    const fetchImage = async () => {
+      try {
+        const { image, previewUuid } = await getImage(uuid);
+        if (image) {
+          setImageSrc(URL.createObjectURL(image));
           clearInterval(interval);
+        } else if (previewUuid) {
+          fetchPreview(previewUuid);
         }
       } catch {
         setError('Error al procesar la imagen.');
         clearInterval(interval);
       }
-    }, 1000);
+    };
+
+    // Sin soporte de SSE (o si el stream se corta) volvemos a consultar cada segundo
+    const startPolling = () => {
+      if (!interval) interval = setInterval(fetchImage, 1000);
+    };
+
+    if (window.EventSource) {
+      events = new EventSource(jobEventsUrl(uuid));
+      events.addEventListener('progress', (e) => setProgress(JSON.parse(e.data).progress));
+      events.addEventListener('preview', (e) => fetchPreview(JSON.parse(e.data).uuid));
+      events.addEventListener('ready', () => {
+        events.close();
+        fetchImage();
+      });
+      events.addEventListener('failed', () => {
+        events.close();
+        setError('No se pudo generar la imagen: el render falló varias veces.');
+      });
+      events.onerror = () => {
+        events.close();
+        startPolling();
+      };
+    } else {
+      startPolling();
+    }
 
-    return () => clearInterval(interval);
+    return () => {
+      if (events) events.close();
+      clearInterval(interval);
+    };
   }, [uuid]);
 
   const renderDescription = () => {
@@ -55,8 +107,15 @@ export default function Loading() {
         <Card.Body className="text-center">
           {!imageSrc && !error ? (
             <>
-              <Spinner animation="border" role="status" />
+              {previewSrc ? (
+                <Card.Img variant="top" src={previewSrc} alt="Vista previa del fractal" style={{ imageRendering: 'pixelated' }} />
+              ) : (
+                <Spinner animation="border" role="status" />
+              )}
               <h4 className="mt-3">Generando tu fractal...</h4>
+              {progress !== null && (
+                <ProgressBar className="mt-3" now={progress} label={`${Math.round(progress)}%`} />
+              )}
               <Button variant="link" className="mt-3" onClick={() => navigate('/')}>Volver al inicio</Button>
             </>
           ) : error ? (
@@ -2,24 +2,28 @@ import axios from 'axios';
 
 const API_URL = '/api';
 
+// El servidor decide si el trabajo es lo bastante grande para una vista previa
 export const submitJob = async (params) => {
   const response = await axios.put(`${API_URL}/submit-job`, params);
   return response.data.uuid;
 };
 
-export const getImage = async (uuid) => {
+// { image } cuando la imagen está lista; { previewUuid } mientras se procesa
+// (null hasta que la vista previa se puede descargar)
+export const getImage = async (uuid, variant) => {
   try {
     const response = await axios.get(`${API_URL}/get-image/${uuid}`, {
+      params: variant ? { variant } : {},
       responseType: 'blob', // Esto indica que esperamos un blob o imagen binaria
       validateStatus: (status) => (status >= 200 && status < 300) || status === 202 || status === 404,
     });
 
     if (response.status === 200) {
       // Imagen lista, retornamos el blob directamente
-      return response.data;
+      return { image: response.data };
     } else if (response.status === 202) {
       // Imagen todavía procesándose
-      return null;
+      return { previewUuid: response.headers['x-preview-uuid'] || null };
     } else if (response.status === 404) {
       throw new Error('UUID not found');
     }
@@ -29,3 +33,12 @@ export const getImage = async (uuid) => {
   }
 };
 
+// Vista previa (baja resolución, 1 muestra): una imagen más, pedida una sola vez
+export const getPreview = async (previewUuid) => {
+  const { image } = await getImage(previewUuid, 'webp');
+  return image || null;
+};
+
+// Stream SSE con el progreso del trabajo (eventos "progress", "preview", "ready" y "failed")
+export const jobEventsUrl = (uuid) => `${API_URL}/job-events/${uuid}`;
+
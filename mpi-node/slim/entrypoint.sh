@@ -3,6 +3,10 @@
 # Start SSH daemon as root
 sudo /usr/sbin/sshd
 
+# Finished images go to the shared blob volume (mounted root-owned)
+sudo mkdir -p "${BLOB_DIR:-/blobs}"
+sudo chown mpi-user:mpi-user "${BLOB_DIR:-/blobs}"
+
 # Generate SSH key for mpi-user if it doesn't exist
 if [ ! -f "/home/mpi-user/.ssh/id_rsa" ]; then
   ssh-keygen -t rsa -b 4096 -f /home/mpi-user/.ssh/id_rsa -N ''
@@ -1,25 +1,63 @@
 #!/usr/bin/env python3
+import base64
+import json
 import subprocess
 import sys
 
-def main():
-    if len(sys.argv) < 2:
-        print("[ERROR] Usage: run_and_check.py <program> [args...]", flush=True)
-        sys.exit(1)
-
-    program = sys.argv[1]
-    args = sys.argv[2:]
-
+def run(program, args, tag=""):
+    prefix = f" {tag}" if tag else ""
     try:
-        print("[TASK] Master is running...", flush=True)
-        subprocess.run([program] + args, check=True)
-        print("[SUCCESS] Program finished with exit code 0", flush=True)
+        print(f"[TASK]{prefix} Master is running...", flush=True)
+        if tag:
+            returncode = run_tagged([program] + args, tag)
+        else:
+            returncode = subprocess.run([program] + args).returncode
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, program)
+        print(f"[SUCCESS]{prefix} Program finished with exit code 0", flush=True)
     except subprocess.CalledProcessError as e:
-        print(f"[ERROR] Program exited with code {e.returncode}", flush=True)
+        print(f"[ERROR]{prefix} Program exited with code {e.returncode}", flush=True)
     except FileNotFoundError:
-        print(f"[ERROR] Program '{program}' not found", flush=True)
+        print(f"[ERROR]{prefix} Program '{program}' not found", flush=True)
     except Exception as e:
-        print(f"[ERROR] Unexpected exception: {str(e)}", flush=True)
+        print(f"[ERROR]{prefix} Unexpected exception: {str(e)}", flush=True)
+
+def run_tagged(cmd, tag):
+    """Runs cmd with every output line prefixed by "[JOB <tag>] ".
+
+    Several batches may share the pod log when the puller partitions the
+    nodes; the prefix tells the observer which job a [STATUS] line is about.
+    """
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            text=True, errors="replace")
+    for line in proc.stdout:
+        print(f"[JOB {tag}] {line}", end="", flush=True)
+    return proc.wait()
+
+def run_batch(manifest):
+    """Runs every job of a batch back to back; markers are tagged with the job uuid.
+
+    The manifest is base64-encoded JSON: [{"uuid": ..., "cmd": [program, args...]}, ...]
+    """
+    try:
+        jobs = json.loads(base64.b64decode(manifest))
+    except ValueError as e:
+        print(f"[ERROR] Invalid batch manifest: {e}", flush=True)
+        sys.exit(1)
+
+    for job in jobs:
+        run(job["cmd"][0], job["cmd"][1:], tag=job["uuid"])
+
+def main():
+    if len(sys.argv) >= 3 and sys.argv[1] == "--batch":
+        run_batch(sys.argv[2])
+        return
+
+    if len(sys.argv) < 2:
+        print("[ERROR] Usage: run_and_check.py <program> [args...] | --batch <manifest>", flush=True)
+        sys.exit(1)
+
+    run(sys.argv[1], sys.argv[2:])
 
 if __name__ == "__main__":
     main()
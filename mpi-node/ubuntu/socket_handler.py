@@ -1,64 +1,331 @@
-import redis
+import asyncio
+import json
+import os
 import socket
-import threading
+import time
+import uuid
+import metrics
+import redis.asyncio as redis
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
 
 
 # Redis client
-r = redis.Redis(host='redis.distributed-fractals', port=6379, db=0)
+r = metrics.instrument_redis(redis.Redis(host='redis.distributed-fractals', port=6379, db=0))
 
+# Images are written to the blob volume shared with the server, named
+# <BLOB_DIR>/<uuid[:2]>/<uuid>.png; Redis only gets the name. Uploads are
+# streamed to disk in CHUNK_SIZE pieces, so a connection never holds more than
+# CHUNK_SIZE bytes. The server garbage-collects old blobs and partial uploads.
+BLOB_DIR   = os.getenv("BLOB_DIR", "/blobs")
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1024 * 1024))
 
-def run_server():
+# Galleries and previews are served smaller encodings of each image, written
+# next to its PNG once the job is already marked done (the server falls back to
+# the PNG until they exist):
+#   <uuid>.webp        same size, WEBP_QUALITY
+#   <uuid>.thumb.webp  at most THUMB_SIZE pixels on each side
+# Encoding runs on VARIANT_WORKERS threads; Pillow releases the GIL meanwhile.
+VARIANTS        = {'webp': '.webp', 'thumb': '.thumb.webp'}
+VARIANT_WORKERS = int(os.getenv("VARIANT_WORKERS", 2))
+WEBP_QUALITY    = int(os.getenv("WEBP_QUALITY", 80))
+THUMB_SIZE      = int(os.getenv("THUMB_SIZE", 256))
+variant_pool = ThreadPoolExecutor(VARIANT_WORKERS, thread_name_prefix='variants')
+
+# At most MAX_UPLOADS connections are served at once; further senders wait in
+# the listen backlog. A sender that stalls for READ_TIMEOUT seconds is dropped.
+MAX_UPLOADS  = int(os.getenv("MAX_UPLOADS", 32))
+READ_TIMEOUT = float(os.getenv("READ_TIMEOUT", 30))
+
+# Length headers are checked before anything is allocated or written: a uuid
+# is at most MAX_UUID_LEN bytes and an image at most MAX_IMAGE_BYTES (an
+# uncompressed 16384 x 16384 RGB PNG fits). Larger claims close the connection.
+MAX_UUID_LEN    = 64
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 1024 * 1024 * 1024))
+
+# Stores the image for the job and for every submission coalesced onto it,
+# tells their clients on job_updates, then releases the in-flight entry so new
+# submissions queue a fresh render. For tiles of a split job it also marks the
+# tile done, publishes the parent's progress and returns the parent uuid with
+# the number of tiles still missing.
+# completed_at records when each image became available, so the server can
+# time client pickup and expire unclaimed results.
+FINISH_JOB = r.register_script("""
+local job_uuid, image, now = ARGV[1], ARGV[2], ARGV[3]
+redis.call('HSET', 'completed_tasks', job_uuid, image)
+redis.call('HSET', 'completed_at', job_uuid, now)
+redis.call('PUBLISH', 'job_updates', cjson.encode({uuid = job_uuid, event = 'ready'}))
+local waiters = redis.call('SMEMBERS', 'job_waiters:' .. job_uuid)
+for _, waiter in ipairs(waiters) do
+    redis.call('HSET', 'completed_tasks', waiter, image)
+    redis.call('HSET', 'completed_at', waiter, now)
+    redis.call('PUBLISH', 'job_updates', cjson.encode({uuid = waiter, event = 'ready'}))
+end
+redis.call('DEL', 'job_waiters:' .. job_uuid)
+local key = redis.call('HGET', 'task_keys', job_uuid)
+if key and redis.call('HGET', 'inflight_jobs', key) == job_uuid then
+    redis.call('HDEL', 'inflight_jobs', key)
+end
+local parent = redis.call('HGET', 'tile_parent', job_uuid)
+if not parent then
+    return {#waiters, '', 0}
+end
+-- tile_parent stays until the stitch, so the collector keeps the tile until then;
+-- a repeated upload of a tile must not count (or stitch) twice
+if redis.call('SADD', 'split_done:' .. parent, job_uuid) == 0 then
+    return {#waiters, parent, -1}
+end
+local total = redis.call('HLEN', 'split:' .. parent)
+local remaining = total - redis.call('SCARD', 'split_done:' .. parent)
+redis.call('PUBLISH', 'job_updates', cjson.encode(
+    {uuid = parent, event = 'progress', progress = 100 * (total - remaining) / total}))
+return {#waiters, parent, remaining}
+""")
+
+# Marks a split job (and its coalesced submissions) failed when it cannot be stitched
+FAIL_SPLIT = r.register_script("""
+local parent, reason, now = ARGV[1], ARGV[2], ARGV[3]
+local targets = redis.call('SMEMBERS', 'job_waiters:' .. parent)
+table.insert(targets, parent)
+for _, target in ipairs(targets) do
+    redis.call('HSET', 'failed_tasks', target, reason)
+    redis.call('HSET', 'completed_at', target, now)
+    redis.call('PUBLISH', 'job_updates', cjson.encode({uuid = target, event = 'failed', error = reason}))
+end
+redis.call('DEL', 'job_waiters:' .. parent)
+local key = redis.call('HGET', 'task_keys', parent)
+if key and redis.call('HGET', 'inflight_jobs', key) == parent then
+    redis.call('HDEL', 'inflight_jobs', key)
+end
+return #targets
+""")
+
+
+
+async def run_server():
     HOST = '0.0.0.0'
     PORT = 5001
+    loop = asyncio.get_running_loop()
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind((HOST, PORT))
     server_socket.listen()
-    server_socket.settimeout(1.0)  # Set timeout for accept()
+    server_socket.setblocking(False)
+
+    upload_slots = asyncio.Semaphore(MAX_UPLOADS)
+    uploads = set()
+    metrics.serve()
 
     print(f"Server is listening on port {PORT}")
     while True:
-        try:
-            client_socket, _ = server_socket.accept()
-        except socket.timeout:
-            continue  # Just try again in the next loop iteration
+        # Only accept when a slot is free, so the backlog applies backpressure
+        await upload_slots.acquire()
+        client_socket, _ = await loop.sock_accept(server_socket)
+        client_socket.setblocking(False)
+
+        task = asyncio.create_task(handle_upload(client_socket))
+        uploads.add(task)
+        task.add_done_callback(uploads.discard)
+        task.add_done_callback(lambda _: upload_slots.release())
+
+
+async def handle_upload(client_socket):
+    job_uuid = None
+    metrics.UPLOADS_ACTIVE.inc()
+    started = time.perf_counter()
+    try:
+        # Step 1: Receive UUID length (4 bytes depending on sender)
+        uuid_len_bytes = await recv_exact(client_socket, 4)
+        uuid_len = int.from_bytes(uuid_len_bytes, byteorder='big')
+        if not 0 < uuid_len <= MAX_UUID_LEN:
+            raise ConnectionError(f"UUID length {uuid_len} out of bounds")
+
+        # Step 2: Receive UUID string
+        uuid_bytes = await recv_exact(client_socket, uuid_len)
+        job_uuid = str(uuid_bytes, 'utf-8')
+        print(f"UUID: {job_uuid}")
+
+        # Step 3: Receive buffer size (4 bytes for uint32)
+        buf_size_bytes = await recv_exact(client_socket, 4)
+        buf_size = int.from_bytes(buf_size_bytes, byteorder='big')
+        if not 0 < buf_size <= MAX_IMAGE_BYTES:
+            raise ConnectionError(f"Image size {buf_size} out of bounds")
+        print(buf_size)
+
+        # Step 4 & 5: Receive the buffer (image or binary data) into its blob
+        # and point the job (and every coalesced submission) at it
+        blob = await receive_blob(client_socket, job_uuid, buf_size)
+        metrics.IMAGE_BYTES.labels('received').inc(buf_size)
+        metrics.PHASE_SECONDS.labels('upload').observe(time.perf_counter() - started)
+
+        await finish_job(job_uuid, blob)
+
+    except asyncio.TimeoutError:
+        print(f"Upload {job_uuid} timed out after {READ_TIMEOUT}s without data")
+    except ConnectionError as e:
+        print(f"Upload {job_uuid} aborted: {e}")
+    except Exception as e:
+        print(f"Upload {job_uuid} failed: {e}")
+    finally:
+        metrics.UPLOADS_ACTIVE.dec()
+        client_socket.close()
+
+
+async def finish_job(job_uuid, blob):
+    waiters, parent, remaining = await FINISH_JOB(args=[job_uuid, blob, time.time()])
+    if waiters:
+        print(f"Fulfilled {waiters} coalesced submissions")
+    if not parent:
+        # Tiles of a split job are never served, so only final images get variants
+        variant_pool.submit(make_variants, blob).add_done_callback(report_variant_error)
+    elif remaining == 0:
+        # Exactly one upload sees the last tile arrive, so it stitches the parent
+        await stitch_job(parent.decode())
+
 
-        # Handle the client
+async def stitch_job(parent_uuid):
+    """Assembles the tiles of a split job into its final image.
+
+    If a tile's result or blob is gone, the parent fails instead.
+    """
+    layout = {tile_uuid.decode(): json.loads(tile)
+              for tile_uuid, tile in (await r.hgetall(f'split:{parent_uuid}')).items()}
+    tile_uuids = list(layout)
+    tiles = [blob.decode() if blob else None
+             for blob in await r.hmget('completed_tasks', tile_uuids)]
+
+    # Decoding and encoding PNGs is CPU bound; keep it off the event loop
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    blob = None
+    try:
+        if None in tiles:
+            raise FileNotFoundError(f"{tiles.count(None)} tile results are missing")
+        blob = await loop.run_in_executor(None, compose_tiles, parent_uuid, layout, tile_uuids, tiles)
+        metrics.PHASE_SECONDS.labels('stitch').observe(time.perf_counter() - started)
+        print(f"Stitched {len(tile_uuids)} tiles into {parent_uuid}")
+    except OSError as e:
+        print(f"Stitching {parent_uuid} failed: {e}")
+
+    pipe = r.pipeline()
+    pipe.hdel('completed_tasks', *tile_uuids)
+    pipe.hdel('completed_at', *tile_uuids)
+    pipe.hdel('tile_parent', *tile_uuids)
+    pipe.delete(f'split:{parent_uuid}', f'split_done:{parent_uuid}')
+    await pipe.execute()
+    if blob is None:
+        await FAIL_SPLIT(args=[parent_uuid, "stitch failed: missing tiles", time.time()])
+    else:
+        await finish_job(parent_uuid, blob)
+    await loop.run_in_executor(None, remove_blobs, [tile for tile in tiles if tile])
+
+
+def compose_tiles(parent_uuid, layout, tile_uuids, tiles):
+    first = next(iter(layout.values()))
+    canvas = Image.new('RGB', (first['width'], first['height']))
+    for tile_uuid, tile in zip(tile_uuids, tiles):
+        box = layout[tile_uuid]
+        with Image.open(blob_path(tile)) as img:
+            canvas.paste(img.convert('RGB'), (box['x'], box['y']))
+
+    blob = blob_name(parent_uuid)
+    path = blob_path(blob)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    canvas.save(f'{path}.tmp', format='PNG')
+    os.replace(f'{path}.tmp', path)
+    return blob
+
+
+def make_variants(blob):
+    path = blob_path(blob)
+    base = path[:-len('.png')]
+    with metrics.phase('variants'), Image.open(path) as img:
+        img = img.convert('RGB')
+        save_atomic(img, base + VARIANTS['webp'])
+        img.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        save_atomic(img, base + VARIANTS['thumb'])
+
+
+def save_atomic(img, path):
+    img.save(f'{path}.tmp', format='WEBP', quality=WEBP_QUALITY)
+    os.replace(f'{path}.tmp', path)
+
+
+def report_variant_error(future):
+    if future.exception() is not None:
+        print(f"Variant encoding failed: {future.exception()}")
+
+
+def blob_name(job_uuid):
+    job_uuid = str(uuid.UUID(job_uuid))  # never lets a sender pick another path
+    return f'{job_uuid[:2]}/{job_uuid}.png'
+
+
+def blob_path(blob):
+    return os.path.join(BLOB_DIR, blob)
+
+
+def remove_blobs(blobs):
+    for blob in blobs:
         try:
-            # Step 1: Receive UUID length (4 bytes depending on sender)
-            uuid_len_bytes = recv_exact(client_socket, 4)
-            uuid_len = int.from_bytes(uuid_len_bytes, byteorder='big')
+            os.remove(blob_path(blob))
+        except FileNotFoundError:
+            pass
+
+
+async def recv_into(sock, view):
+    loop = asyncio.get_running_loop()
+    n = await asyncio.wait_for(loop.sock_recv_into(sock, view), READ_TIMEOUT)
+    if not n:
+        raise ConnectionError("Client disconnected")
+    return n
 
-            # Step 2: Receive UUID string
-            uuid_bytes = recv_exact(client_socket, uuid_len)
-            job_uuid = uuid_bytes.decode('utf-8')
-            print(f"UUID: {job_uuid}")
 
-            # Step 3: Receive buffer size (4 bytes for uint32)
-            buf_size_bytes = recv_exact(client_socket, 4)
-            buf_size = int.from_bytes(buf_size_bytes, byteorder='big')
-            print(buf_size)
+async def recv_exact(sock, num_bytes):
+    """Receive exactly num_bytes from the socket into a single preallocated buffer."""
+    buf = bytearray(num_bytes)
+    view = memoryview(buf)
+    received = 0
+    while received < num_bytes:
+        received += await recv_into(sock, view[received:])
+    return view
 
-            # Step 4: Receive the buffer (image or binary data)
-            img_data = recv_exact(client_socket, buf_size)
 
-            # Step 5: Updates redis with image
-            r.hset('completed_tasks', job_uuid, img_data)
+async def recv_chunks(sock, num_bytes, chunk_size=CHUNK_SIZE):
+    """Yield num_bytes from the socket as successive views of one reused buffer.
 
-        finally:
-            client_socket.close()
+    Each view is only valid until the next one is requested.
+    """
+    view = memoryview(bytearray(min(chunk_size, num_bytes)))
+    remaining = num_bytes
+    while remaining:
+        want = min(len(view), remaining)
+        filled = 0
+        while filled < want:
+            filled += await recv_into(sock, view[filled:want])
+        remaining -= want
+        yield view[:want]
 
 
-def recv_exact(sock, num_bytes):
-    """Receive exactly num_bytes from the socket."""
-    data = b''
-    while len(data) < num_bytes:
-        packet = sock.recv(num_bytes - len(data))
-        if not packet:
-            raise ConnectionError("Client disconnected")
-        data += packet
-    return data
+async def receive_blob(sock, job_uuid, num_bytes):
+    """Streams the payload into the job's blob; returns the blob name."""
+    blob = blob_name(job_uuid)
+    path = blob_path(blob)
+    tmp = f'{path}.tmp'
+    loop = asyncio.get_running_loop()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    f = open(tmp, 'wb')
+    try:
+        async for chunk in recv_chunks(sock, num_bytes):
+            # Disk (or NFS) writes can block; the chunk stays valid until the next recv
+            await loop.run_in_executor(None, f.write, chunk)
+        f.close()
+        os.replace(tmp, path)
+    except BaseException:
+        f.close()
+        os.remove(tmp)
+        raise
+    return blob
 
 if __name__ == '__main__':
-    server_thread = threading.Thread(target=run_server, daemon=False)
-    server_thread.start()
-    server_thread.join()
+    asyncio.run(run_server())
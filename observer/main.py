@@ -1,7 +1,9 @@
 import os
+import re
 import redis
 import time
-import json
+import jobstate
+import metrics
 from kubernetes import client, config, watch
 from kubernetes.client.rest import ApiException
 
@@ -10,21 +12,39 @@ config.load_incluster_config()
 v1 = client.CoreV1Api()
 
 redis_host = os.getenv("REDIS_HOST", "redis")
-r = redis.Redis(host=redis_host, port=6379, db=0)
+r = metrics.instrument_redis(redis.Redis(host=redis_host, port=6379, db=0))
 
 NAMESPACE  = os.getenv("POD_NAMESPACE", "default")
 MASTER_POD = os.getenv("MASTER_POD", "mpi-node-0")
 
-def update_job_status(new_status):
-    tasks = r.lrange("running_tasks", 0, -1)
-    for task in tasks:
-        data = json.loads(task)
-        if data.get("namespace") == NAMESPACE:
-            data["status"] = new_status
-            r.lrem("running_tasks", 0, task)
-            r.lpush("running_tasks", json.dumps(data))
-            print(f"[Observer] Updated status to '{new_status}' for namespace '{NAMESPACE}'")
-            break
+# Batch markers carry the job uuid: "[SUCCESS] <uuid> ..."
+MARKER_UUID = re.compile(r"\[(?:TASK|SUCCESS|ERROR)\] ([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})")
+
+# Output of a job's program is tagged by run_and_check.py: "[JOB <uuid>] [STATUS] ..."
+JOB_TAG = re.compile(r"^\[JOB ([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\] ")
+
+def marker_uuid(line):
+    match = MARKER_UUID.search(line)
+    return match.group(1) if match else None
+
+def split_job_tag(line):
+    """Returns (uuid, line without the tag), or (None, line) for untagged lines."""
+    match = JOB_TAG.match(line)
+    if not match:
+        return None, line
+    return match.group(1), line[match.end():]
+
+def update_job_status(new_status, job_uuid=None):
+    # Without a uuid the whole batch running in this namespace is affected
+    # Returns how many jobs actually changed (replayed log lines change none)
+    job_uuids = [job_uuid] if job_uuid else jobstate.namespace_jobs(r, NAMESPACE)
+    updated = 0
+    for job_uuid in job_uuids:
+        if jobstate.transition(r, job_uuid, new_status, expected="running"):
+            metrics.JOB_RESULTS.labels(new_status).inc()
+            updated += 1
+            print(f"[Observer] Updated status to '{new_status}' for job '{job_uuid}' in namespace '{NAMESPACE}'")
+    return updated
 
 def pod_is_running():
     try:
@@ -48,9 +68,10 @@ def watch_logs():
             return
 
         w = watch.Watch()
-        task_in_progress = False
-        last_percent = None
-        percent_timestamp = None
+        # Renders in progress by uuid: several run at once when the puller
+        # partitions the MPI nodes. Untagged (legacy) markers use None.
+        tasks = {}
+        current_job = None  # last started; owns untagged [STATUS] lines
 
         print("[Observer] Starting log watch (stream open)...")
 
@@ -67,56 +88,77 @@ def watch_logs():
                     continue
 
                 print(f"[Master Log] {line}")
+                tagged_job, line = split_job_tag(line)
 
                 if "[TASK]" in line:
-                    task_in_progress = True
-                    last_percent = None
-                    percent_timestamp = time.time()
-                    print("[Observer] Detected start of new task")
+                    current_job = marker_uuid(line)
+                    now = time.time()
+                    tasks[current_job] = {"started": now, "percent": None, "percent_at": now}
+                    metrics.RENDER_PROGRESS.set(0)
+                    print(f"[Observer] Detected start of task {current_job}")
                     continue
 
                 if "[SUCCESS]" in line:
-                    update_job_status("success")
-                    task_in_progress = False
-                    print("[Observer] Task succeeded")
+                    job_uuid = marker_uuid(line)
+                    task = tasks.pop(job_uuid, None)
+                    if update_job_status("success", job_uuid) and task:
+                        seconds = time.time() - task["started"]
+                        metrics.PHASE_SECONDS.labels("render").observe(seconds)
+                        # Calibrates the puller's rank model
+                        if job_uuid:
+                            jobstate.record_run(r, job_uuid, seconds)
+                    print(f"[Observer] Task {job_uuid} succeeded")
                     continue
 
                 if "[ERROR]" in line:
-                    update_job_status("fail")
-                    task_in_progress = False
-                    print("[Observer] Task failed")
+                    # A job's own output is tagged and its uuid stripped above;
+                    # only untagged errors without a uuid fail the whole batch
+                    job_uuid = marker_uuid(line) or tagged_job
+                    tasks.pop(job_uuid, None)
+                    update_job_status("fail", job_uuid)
+                    print(f"[Observer] Task {job_uuid} failed")
                     continue
 
                 if "[STATUS]" in line and "%" in line:
+                    job_uuid = tagged_job or current_job
+                    task = tasks.get(job_uuid)
+                    if task is None:
+                        continue
                     try:
                         percent = float(line.split("%")[0].split()[-1])
                     except ValueError:
                         continue
 
                     now = time.time()
-                    if last_percent is None or percent != last_percent:
-                        last_percent = percent
-                        percent_timestamp = now
-                        print(f"[Observer] Progress: {percent}%")
+                    if task["percent"] is None or percent != task["percent"]:
+                        if task["percent"] is not None and now > task["percent_at"]:
+                            metrics.RENDER_PROGRESS_RATE.set(
+                                (percent - task["percent"]) / (now - task["percent_at"]))
+                        metrics.RENDER_PROGRESS.set(percent)
+                        task["percent"] = percent
+                        task["percent_at"] = now
+                        print(f"[Observer] Progress of {job_uuid}: {percent}%")
+                        if job_uuid:
+                            jobstate.publish_progress(r, job_uuid, percent)
                     else:
-                        if now - percent_timestamp > STUCK_TIMEOUT:
-                            update_job_status("fail")
-                            task_in_progress = False
-                            print(f"[Observer] No progress for {STUCK_TIMEOUT}s, marking as failed")
+                        if now - task["percent_at"] > STUCK_TIMEOUT:
+                            update_job_status("fail", job_uuid)
+                            tasks.pop(job_uuid, None)
+                            print(f"[Observer] No progress for {STUCK_TIMEOUT}s, marking {job_uuid} as failed")
                     continue
 
         except ApiException as e:
             print(f"[Observer] K8s API error: {e}")
             if e.status in [404, 410, 500]:
                 print("[Observer] Lost connection with master pod or pod deleted.")
-                if task_in_progress:
+                if tasks:
                     print("[Observer] Task was in progress. Marking as failed.")
                     update_job_status("fail")
                 return
 
         except Exception as e:
             print(f"[Observer] Unexpected error: {e}")
-            if task_in_progress:
+            if tasks:
                 update_job_status("fail")
                 print("[Observer] Task was in progress. Marking as failed due to unexpected error.")
             return
@@ -125,12 +167,12 @@ def watch_logs():
             w.stop()
             if not pod_is_running():
                 print("[Observer] Pod not running during final check.")
-                if task_in_progress:
+                if tasks:
                     update_job_status("fail")
                     print("[Observer] Task was in progress. Marking as failed.")
                 return
 
-            if task_in_progress:
+            if tasks:
                 print("[Observer] Log stream ended during task. Marking task as failed.")
                 update_job_status("fail")
                 return  # No retry
@@ -139,4 +181,5 @@ def watch_logs():
             time.sleep(RETRY_DELAY)
 
 if __name__ == "__main__":
+    metrics.serve()
     watch_logs()  
@@ -0,0 +1,103 @@
+# Prometheus metrics of the server, puller, observer, autoscaler and socket handler.
+#
+# Every component image ships its own copy of this file (server/, puller/,
+# observer/, autoscaler/, mpi-node/slim/, mpi-node/ubuntu/); keep them
+# identical. All metrics are declared here, so each process exports the same
+# catalogue and a component only bumps the ones it owns. Updates are in-memory
+# and lock-protected, cheap enough to leave on in the hot path.
+#
+#   fractals_phase_seconds{phase}       where a job's time goes: queue_wait, reconcile,
+#                                       key_distribution, mpirun, render, upload, stitch, pickup;
+#                                       variants (encoding WebP copies, after the job is done),
+#                                       local_render (small jobs rendered by the server)
+#   fractals_redis_seconds{command}     every Redis round trip (commands, scripts, pipelines)
+#   fractals_submissions_total{outcome} cached, coalesced, split, local, queued,
+#                                       invalid, too_large or throttled
+#   fractals_job_results_total{result}  renders finished as seen by the observer
+#   fractals_image_bytes_total{direction}  received from MPI nodes / served to clients
+import asyncio
+import os
+import threading
+import time
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", 8080))
+
+PHASE_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+REDIS_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5)
+
+PHASE_SECONDS = Histogram('fractals_phase_seconds', 'Time spent in each phase of a job',
+                          ['phase'], buckets=PHASE_BUCKETS)
+REDIS_SECONDS = Histogram('fractals_redis_seconds', 'Redis round trips by command',
+                          ['command'], buckets=REDIS_BUCKETS)
+HTTP_SECONDS = Histogram('fractals_http_request_seconds', 'Server request latency',
+                         ['endpoint'], buckets=REDIS_BUCKETS + PHASE_BUCKETS[-6:])
+
+SUBMISSIONS = Counter('fractals_submissions_total', 'Submitted renders by how they were served',
+                      ['outcome'])
+JOB_RESULTS = Counter('fractals_job_results_total', 'Finished renders by result', ['result'])
+IMAGE_BYTES = Counter('fractals_image_bytes_total', 'Image bytes received or served',
+                      ['direction'])
+BATCH_JOBS = Histogram('fractals_batch_jobs', 'Jobs run per exec session',
+                       buckets=(1, 2, 4, 8, 16, 32, 64))
+UPLOADS_ACTIVE = Gauge('fractals_uploads_active', 'Result uploads being received')
+
+RENDER_PROGRESS = Gauge('fractals_render_progress_percent', 'Progress of the running render')
+RENDER_PROGRESS_RATE = Gauge('fractals_render_progress_rate',
+                             'Percent per second between the last two [STATUS] lines')
+
+QUEUE_DEPTH = Gauge('fractals_queue_depth', 'Jobs waiting in pending_tasks')
+QUEUED_COST = Gauge('fractals_queued_cost', 'Pixel-samples waiting in pending_tasks')
+COST_RATE = Gauge('fractals_cost_rate', 'Pixel-samples per second', ['kind'])
+NAMESPACES = Gauge('fractals_namespaces', 'MPI namespaces by state', ['state'])
+SCALING_DECISIONS = Counter('fractals_scaling_decisions_total', 'Autoscaler decisions',
+                            ['direction'])
+
+_serving = False
+_serving_lock = threading.Lock()
+
+
+def serve(port=METRICS_PORT):
+    """Starts the /metrics HTTP endpoint; later calls in the same process are no-ops."""
+    global _serving
+    with _serving_lock:
+        if not _serving:
+            start_http_server(port)
+            _serving = True
+
+
+def phase(name):
+    """Context manager / decorator timing one phase of a job."""
+    return PHASE_SECONDS.labels(name).time()
+
+
+def _timed(call, command):
+    if asyncio.iscoroutinefunction(call):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await call(*args, **kwargs)
+            finally:
+                REDIS_SECONDS.labels(command or args[0]).observe(time.perf_counter() - start)
+    else:
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return call(*args, **kwargs)
+            finally:
+                REDIS_SECONDS.labels(command or args[0]).observe(time.perf_counter() - start)
+    return timed
+
+
+def instrument_redis(r):
+    """Times every round trip of the (sync or asyncio) client `r`; returns `r`."""
+    pipeline = r.pipeline
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        pipe.execute = _timed(pipe.execute, 'PIPELINE')
+        return pipe
+
+    r.execute_command = _timed(r.execute_command, None)
+    r.pipeline = timed_pipeline
+    return r
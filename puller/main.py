@@ -1,7 +1,15 @@
 import os
+import base64
 import redis
 import time
 import json
+import random
+import threading
+import jobstate
+import metrics
+from rank_model import MIN_RANKS, RankModel
+from concurrent.futures import ThreadPoolExecutor
+from informer import Informer
 from kubernetes import client, config
 from kubernetes.stream import stream
 from kubernetes.client.rest import ApiException
@@ -13,7 +21,7 @@ apps_v1 = client.AppsV1Api()
 
 # --- Redis setup ---
 redis_host = os.getenv("REDIS_HOST", "redis")
-r = redis.Redis(host=redis_host, port=6379, db=0)
+r = metrics.instrument_redis(redis.Redis(host=redis_host, port=6379, db=0))
 
 # --- Dynamic Namespace from env ---
 NAMESPACE = os.getenv("POD_NAMESPACE")
@@ -26,11 +34,129 @@ SLOTS_PER_NODE   = int(os.getenv("SLOTS_PER_NODE", 2))
 IMAGE            = os.getenv("MPI_IMAGE")
 MPIPASS          = os.getenv("MPIPASS")
 
+# Blob volume the socket handlers write finished images to; the server must
+# mount the same storage. By default the blob-store NFS export (manifests/blobs),
+# which pods on any node of any namespace can share; the kubelet mounts it with
+# the node's resolver, so it is addressed by its Service's pinned ClusterIP.
+# Setting BLOB_HOST_PATH mounts that host directory instead, which only works
+# on single-node clusters.
+BLOB_DIR        = os.getenv("BLOB_DIR", "/blobs")
+BLOB_NFS_SERVER = os.getenv("BLOB_NFS_SERVER", "10.96.100.100")
+BLOB_NFS_PATH   = os.getenv("BLOB_NFS_PATH", "/")
+BLOB_HOST_PATH  = os.getenv("BLOB_HOST_PATH")
+
+# --- Queue constants ---
+# Jobs move atomically from pending_tasks into this puller's processing list and
+# stay there until mpirun returns. While the puller is alive it refreshes its
+# heartbeat; once the heartbeat expires any puller hands the jobs back.
+PROCESSING_KEY     = f"processing:{NAMESPACE}"
+HEARTBEAT_KEY      = f"puller_alive:{NAMESPACE}"
+VISIBILITY_TIMEOUT = int(os.getenv("VISIBILITY_TIMEOUT", 30))
+BLOCK_TIMEOUT      = float(os.getenv("BLOCK_TIMEOUT", 5))
+
+# Small jobs (width*height*samples <= BATCH_MAX_WORK) are drained from the queue
+# up to BATCH_SIZE at a time and run back to back in one exec session.
+BATCH_SIZE     = int(os.getenv("BATCH_SIZE", 8))
+BATCH_MAX_WORK = int(os.getenv("BATCH_MAX_WORK", 1024 * 1024))
+
+# The MPI nodes are carved into PARTITIONS disjoint groups, each with its own
+# hostfile (hostfile.<i>). A batch of small jobs is spread over the groups and
+# every group runs its share in a separate exec session, so small renders run
+# side by side instead of each taking every slot. A single job, small or
+# large, still runs on the whole pod set (hostfile).
+PARTITIONS = max(1, min(int(os.getenv("PARTITIONS", 1)), NODE_COUNT))
+partition_runs = ThreadPoolExecutor(PARTITIONS, thread_name_prefix="partition")
+
+# How many ranks (mpirun -np) a job gets. "model": the count the rank model
+# (rank_model.py) predicts to finish soonest, at most every slot of the
+# hostfile; "all": every slot. RANK_EXPLORE is the share of jobs given a random
+# count instead, so the renders timed for calibration cover every count. It
+# slows those jobs down, so it is 0 outside a calibration sweep (1.0, see
+# testing/bench_rank_model.py). The model is refitted on the timed renders
+# every RANK_REFIT_INTERVAL seconds.
+RANK_POLICY         = os.getenv("RANK_POLICY", "model")
+RANK_EXPLORE        = float(os.getenv("RANK_EXPLORE", 0))
+RANK_REFIT_INTERVAL = float(os.getenv("RANK_REFIT_INTERVAL", 300))
+rank_model = RankModel()
+rank_model_fitted_at = 0.0
+
+# Hands every job of a dead puller back to pending_tasks with its original
+# priority by marking it queued again.
+RECLAIM_JOBS = r.register_script(jobstate.LUA_TRANSITION + """
+local processing, heartbeat, now = KEYS[1], KEYS[2], ARGV[1]
+if redis.call('EXISTS', heartbeat) == 1 then
+    return 0
+end
+local jobs = redis.call('LRANGE', processing, 0, -1)
+for _, job in ipairs(jobs) do
+    transition(cjson.decode(job)['uuid'], 'running', 'queued', '', now)
+end
+redis.call('DEL', processing)
+return #jobs
+""")
+
 # --- Observer constants ---
 OBSERVER_DEPLOYMENT = os.getenv("OBSERVER_DEPLOYMENT_NAME", "observer")
 OBSERVER_IMAGE      = os.getenv("OBSERVER_IMAGE")
 OBSERVER_REPLICAS   = int(os.getenv("OBSERVER_REPLICAS", 1))
 
+# Lets Prometheus discover the metrics endpoint of the pods created below
+METRICS_ANNOTATIONS = {"prometheus.io/scrape": "true",
+                       "prometheus.io/port": str(metrics.METRICS_PORT)}
+
+# --- Caches of this namespace's pods and workloads, kept current by watches ---
+def pod_is_ready(pod):
+    return (pod.status.phase == "Running"
+            and bool(pod.status.container_statuses)
+            and all(cs.ready for cs in pod.status.container_statuses))
+
+pods         = Informer(v1.list_namespaced_pod, NAMESPACE)
+deployments  = Informer(apps_v1.list_namespaced_deployment, NAMESPACE)
+statefulsets = Informer(apps_v1.list_namespaced_stateful_set, NAMESPACE)
+
+def ready_pods(app, items=None):
+    """Ready pods of `app`, sorted by name."""
+    return [p for p in (pods.items() if items is None else items)
+            if (p.metadata.labels or {}).get("app") == app and pod_is_ready(p)]
+
+def wait_ready(app, count, timeout=None):
+    """Blocks until at least `count` pods of `app` are ready; returns them."""
+    pods.wait_for(lambda items: len(ready_pods(app, items)) >= count, timeout)
+    return ready_pods(app)
+
+def pod_generation(pods):
+    """Identifies a pod set by names, uids, IPs and restart counts, so it changes
+    whenever a pod is replaced or restarted (and regenerates its SSH key)."""
+    return tuple((p.metadata.name, p.metadata.uid, p.status.pod_ip,
+                  sum(cs.restart_count for cs in p.status.container_statuses))
+                 for p in pods)
+
+# Pod-set generation the hostfile and SSH keys were last prepared for
+prepared_generation = None
+
+def partitions(pods):
+    """Splits the pods into PARTITIONS contiguous groups of near-equal size."""
+    count = min(PARTITIONS, len(pods))
+    size, extra = divmod(len(pods), count)
+    groups, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(pods[start:end])
+        start = end
+    return groups
+
+_exec_clients = threading.local()
+
+def exec_api():
+    """CoreV1Api for exec sessions, one per thread.
+
+    stream() swaps its client's transport to websockets for the duration of
+    the call, so concurrent sessions (and the pod watch) must not share one.
+    """
+    if not hasattr(_exec_clients, "api"):
+        _exec_clients.api = client.CoreV1Api(client.ApiClient())
+    return _exec_clients.api
+
 # --- MPI‐nodes: Service + StatefulSet generators ---
 def create_headless_service():
     svc = client.V1Service(
@@ -48,22 +174,34 @@ def create_headless_service():
         if e.status != 409:
             raise
 
+def blob_volume():
+    if BLOB_HOST_PATH:
+        source = {"host_path": client.V1HostPathVolumeSource(path=BLOB_HOST_PATH,
+                                                             type="DirectoryOrCreate")}
+    else:
+        source = {"nfs": client.V1NFSVolumeSource(server=BLOB_NFS_SERVER, path=BLOB_NFS_PATH)}
+    return client.V1Volume(name="blobs", **source)
+
 def create_statefulset():
-    env_vars = [client.V1EnvVar(name="MPIPASS", value=MPIPASS)]
+    env_vars = [client.V1EnvVar(name="MPIPASS", value=MPIPASS),
+                client.V1EnvVar(name="BLOB_DIR", value=BLOB_DIR)]
     container = client.V1Container(
         name="mpi-node",
         image=IMAGE,
         image_pull_policy="Always",
         env=env_vars,
-        ports=[client.V1ContainerPort(container_port=22)]
+        ports=[client.V1ContainerPort(container_port=22),
+               client.V1ContainerPort(container_port=metrics.METRICS_PORT)],
+        volume_mounts=[client.V1VolumeMount(name="blobs", mount_path=BLOB_DIR)]
     )
     spec = client.V1StatefulSetSpec(
         service_name=SERVICE_NAME,
         selector=client.V1LabelSelector(match_labels={"app": STATEFULSET_NAME}),
         replicas=NODE_COUNT,
         template=client.V1PodTemplateSpec(
-            metadata=client.V1ObjectMeta(labels={"app": STATEFULSET_NAME}),
-            spec=client.V1PodSpec(containers=[container])
+            metadata=client.V1ObjectMeta(labels={"app": STATEFULSET_NAME},
+                                         annotations=METRICS_ANNOTATIONS),
+            spec=client.V1PodSpec(containers=[container], volumes=[blob_volume()])
         )
     )
     sts = client.V1StatefulSet(
@@ -78,33 +216,25 @@ def create_statefulset():
             raise
 
 def ensure_mpi_deployed():
-    try:
-        sts = apps_v1.read_namespaced_stateful_set(STATEFULSET_NAME, NAMESPACE)
-        if sts.spec.replicas != NODE_COUNT:
-            apps_v1.patch_namespaced_stateful_set_scale(
-                STATEFULSET_NAME, NAMESPACE, {"spec": {"replicas": NODE_COUNT}}
-            )
-            print(f"Scaled MPI StatefulSet → {NODE_COUNT}")
-        else:
-            print(f"MPI StatefulSet already at {NODE_COUNT} replicas.")
-    except ApiException as e:
-        if e.status == 404:
-            create_headless_service()
-            create_statefulset()
-        else:
-            raise
+    sts = statefulsets.get(STATEFULSET_NAME, NAMESPACE)
+    if sts is None:
+        create_headless_service()
+        create_statefulset()
+    elif sts.spec.replicas != NODE_COUNT:
+        apps_v1.patch_namespaced_stateful_set_scale(
+            STATEFULSET_NAME, NAMESPACE, {"spec": {"replicas": NODE_COUNT}}
+        )
+        print(f"Scaled MPI StatefulSet → {NODE_COUNT}")
+    else:
+        print(f"MPI StatefulSet already at {NODE_COUNT} replicas.")
 
 def wait_for_all_nodes_ready():
     print("🔎 Waiting for MPI nodes...")
     while True:
-        pods = v1.list_namespaced_pod(NAMESPACE, label_selector=f"app={STATEFULSET_NAME}").items
-        ready = [p for p in pods
-                 if p.status.phase == "Running"
-                 and all(cs.ready for cs in p.status.container_statuses)]
+        ready = wait_ready(STATEFULSET_NAME, NODE_COUNT, timeout=10)
         print(f"  {len(ready)}/{NODE_COUNT} MPI nodes ready")
-        if len(ready) == NODE_COUNT:
-            return sorted(ready, key=lambda p: p.metadata.name)
-        time.sleep(2)
+        if len(ready) >= NODE_COUNT:
+            return ready[:NODE_COUNT]
 
 # --- Observer Deployment generator & scaler ---
 def create_observer_deployment(master_pod_name):
@@ -128,7 +258,8 @@ def create_observer_deployment(master_pod_name):
         replicas=OBSERVER_REPLICAS,
         selector=client.V1LabelSelector(match_labels={"app": OBSERVER_DEPLOYMENT}),
         template=client.V1PodTemplateSpec(
-            metadata=client.V1ObjectMeta(labels={"app": OBSERVER_DEPLOYMENT}),
+            metadata=client.V1ObjectMeta(labels={"app": OBSERVER_DEPLOYMENT},
+                                         annotations=METRICS_ANNOTATIONS),
             spec=pod_spec
         )
     )
@@ -144,82 +275,146 @@ def create_observer_deployment(master_pod_name):
             raise
 
 def ensure_observer_deployed(master_pod_name):
-    try:
-        dep = apps_v1.read_namespaced_deployment(OBSERVER_DEPLOYMENT, NAMESPACE)
-        if dep.spec.replicas != OBSERVER_REPLICAS:
-            apps_v1.patch_namespaced_deployment_scale(
-                OBSERVER_DEPLOYMENT, NAMESPACE, {"spec": {"replicas": OBSERVER_REPLICAS}}
-            )
-            print(f"Scaled Observer → {OBSERVER_REPLICAS}")
-        else:
-            print(f"Observer already at {OBSERVER_REPLICAS} replicas.")
-    except ApiException as e:
-        if e.status == 404:
-            create_observer_deployment(master_pod_name)
-        else:
-            raise
+    dep = deployments.get(OBSERVER_DEPLOYMENT, NAMESPACE)
+    if dep is None:
+        create_observer_deployment(master_pod_name)
+    elif dep.spec.replicas != OBSERVER_REPLICAS:
+        apps_v1.patch_namespaced_deployment_scale(
+            OBSERVER_DEPLOYMENT, NAMESPACE, {"spec": {"replicas": OBSERVER_REPLICAS}}
+        )
+        print(f"Scaled Observer → {OBSERVER_REPLICAS}")
+    else:
+        print(f"Observer already at {OBSERVER_REPLICAS} replicas.")
 
 def wait_for_observer_ready():
     print("🔎 Waiting for Observer...")
-    while True:
-        pods = v1.list_namespaced_pod(NAMESPACE, label_selector=f"app={OBSERVER_DEPLOYMENT}").items
-        ready = [p for p in pods
-                 if p.status.phase == "Running"
-                 and all(cs.ready for cs in p.status.container_statuses)]
-        if len(ready) >= OBSERVER_REPLICAS:
-            print("Observer is ready.")
-            return
-        time.sleep(2)
+    wait_ready(OBSERVER_DEPLOYMENT, OBSERVER_REPLICAS)
+    print("Observer is ready.")
+
+def cluster_is_warm():
+    return (len(ready_pods(STATEFULSET_NAME)) >= NODE_COUNT
+            and len(ready_pods(OBSERVER_DEPLOYMENT)) >= OBSERVER_REPLICAS)
+
+def ensure_cluster_ready():
+    """Returns the ready MPI pods, reconciling the cluster only when it is not warm."""
+    if not cluster_is_warm():
+        with metrics.phase("reconcile"):
+            ensure_mpi_deployed()
+            mpi_pods = wait_for_all_nodes_ready()
+            ensure_observer_deployed(mpi_pods[0].metadata.name)
+            wait_for_observer_ready()
+    return ready_pods(STATEFULSET_NAME)[:NODE_COUNT]
 
 # --- Helpers for MPI run ---
+def hostfile_content(pods):
+    return "".join(f"{p.status.pod_ip} slots={SLOTS_PER_NODE}\n" for p in pods)
+
 def prepare_hostfile_and_keys(master_pod, pods):
     project_root   = "/home/mpi-user/fractal/DistributedFractals"
     build_dir      = f"{project_root}/build"
     hostfile_path  = f"{build_dir}/hostfile"
-    lines = [f"{p.status.pod_ip} slots={SLOTS_PER_NODE}\n" for p in pods]
-    hostfile_content = "".join(lines)
 
-    cmd_write = f"mkdir -p {build_dir} && echo -e '{hostfile_content}' > {hostfile_path}"
-    stream(v1.connect_get_namespaced_pod_exec,
+    # The whole pod set, then one hostfile per partition
+    writes = [f"echo -e '{hostfile_content(pods)}' > {hostfile_path}"]
+    for i, group in enumerate(partitions(pods)):
+        writes.append(f"echo -e '{hostfile_content(group)}' > {hostfile_path}.{i}")
+    cmd_write = f"mkdir -p {build_dir} && " + " && ".join(writes)
+    stream(exec_api().connect_get_namespaced_pod_exec,
            name=master_pod, namespace=NAMESPACE,
            command=["/bin/bash", "-c", cmd_write],
            stderr=True, stdin=False, stdout=True, tty=False)
 
+    # Keys are shared over the whole pod set, so they serve every partition too
     script_path = f"{project_root}/src/scripts/share_public_keys.sh"
     cmd_keys = f"bash {script_path} {hostfile_path} {MPIPASS}"
-    stream(v1.connect_get_namespaced_pod_exec,
+    stream(exec_api().connect_get_namespaced_pod_exec,
            name=master_pod, namespace=NAMESPACE,
            command=["/bin/bash", "-c", cmd_keys],
            stderr=True, stdin=False, stdout=True, tty=False)
 
 
-def run_mpi_on_master(master_pod, pods, args, job_uuid):
-    prepare_hostfile_and_keys(master_pod, pods)
-
+def refit_rank_model():
+    """Refits the rank model on the timed renders if the last fit is stale."""
+    global rank_model, rank_model_fitted_at
+    if RANK_POLICY != "model" or time.time() - rank_model_fitted_at < RANK_REFIT_INTERVAL:
+        return
+    rank_model = RankModel.fit(jobstate.rank_runs(r), fallback=rank_model)
+    rank_model_fitted_at = time.time()
+    print(f"Rank model: {rank_model}")
+
+def job_ranks(data, slots):
+    """Number of ranks a job runs on out of the `slots` of its hostfile."""
+    if RANK_POLICY != "model":
+        return slots
+    if slots > MIN_RANKS and random.random() < RANK_EXPLORE:
+        return random.randint(MIN_RANKS, slots)
+    return rank_model.choose(jobstate.job_cost(data), jobstate.job_blocks(data), slots)
+
+def run_mpi_on_master(master_pod, pods, jobs):
+    """Runs (job_uuid, args, params) jobs: alone over every node, or several
+    spread over the partitions, each partition running its share back to back."""
+    # Hostfile and SSH keys only need redoing when the pod set changed
+    global prepared_generation
+    generation = pod_generation(pods)
+    if generation != prepared_generation:
+        with metrics.phase("key_distribution"):
+            prepare_hostfile_and_keys(master_pod, pods)
+        prepared_generation = generation
+
+    metrics.BATCH_JOBS.observe(len(jobs))
+    groups = partitions(pods)
+    with metrics.phase("mpirun"):
+        if len(jobs) == 1 or len(groups) == 1:
+            run_jobs_on_master(master_pod, jobs, "hostfile", len(pods) * SLOTS_PER_NODE)
+        else:
+            # Longest job first onto the least loaded partition
+            shares = [[] for _ in groups[:len(jobs)]]
+            for job in sorted(jobs, key=lambda job: jobstate.job_cost(job[2]), reverse=True):
+                min(shares, key=lambda share: sum(jobstate.job_cost(j[2]) for j in share)).append(job)
+            runs = [partition_runs.submit(run_jobs_on_master, master_pod, share,
+                                          f"hostfile.{i}", len(groups[i]) * SLOTS_PER_NODE)
+                    for i, share in enumerate(shares)]
+            for run in runs:
+                run.result()
+    print(f"MPI batch of {len(jobs)} job(s) finished on {min(len(jobs), len(groups))} partition(s).")
+
+def run_jobs_on_master(master_pod, jobs, hostfile, slots):
+    """Runs jobs back to back over `hostfile` in a single exec session.
+
+    Each job gets its own rank count; mapping by slot fills the hostfile's
+    nodes in order, so a job on fewer ranks only uses the first nodes.
+    """
     project_root = "/home/mpi-user/fractal/DistributedFractals/build"
-    total_slots  = NODE_COUNT * SLOTS_PER_NODE
-    mpi_cmd = (
-        f"mpirun -np {total_slots} "
-        f"--hostfile {project_root}/hostfile "
-        f"{project_root}/fractal_mpi "
-        
-        # Output Network Settings
-        f"{' '.join(args)} -on 0.0.0.0 5001 {job_uuid}"
-    )
-    print(f"Running MPI command: {mpi_cmd}")
-
+    manifest = []
+    ranks = {}
+    for job_uuid, args, data in jobs:
+        ranks[job_uuid] = job_ranks(data, slots)
+        mpi_cmd = [
+            "mpirun", "-np", str(ranks[job_uuid]), "--map-by", "slot",
+            "--hostfile", f"{project_root}/{hostfile}",
+            f"{project_root}/fractal_mpi",
+            *args,
+            # Output Network Settings
+            "-on", "0.0.0.0", "5001", job_uuid,
+        ]
+        print(f"Running MPI command: {' '.join(mpi_cmd)}")
+        manifest.append({"uuid": job_uuid, "cmd": mpi_cmd})
+
+    # The observer times each render against its rank count
+    jobstate.set_job_ranks(r, ranks)
+
+    encoded = base64.b64encode(json.dumps(manifest).encode()).decode()
     run_and_check_cmd = (
-        f"python3 /home/mpi-user/run_and_check.py {mpi_cmd} "
+        f"python3 /home/mpi-user/run_and_check.py --batch {encoded} "
         # redirige stdout → fd 1, stderr → fd 2
         f">/proc/1/fd/1 2>/proc/1/fd/2"
     )
 
-    output = stream(v1.connect_get_namespaced_pod_exec,
+    output = stream(exec_api().connect_get_namespaced_pod_exec,
            name=master_pod, namespace=NAMESPACE,
            command=["/bin/bash", "-l", "-c", run_and_check_cmd],
            stderr=True, stdin=False, stdout=True, tty=False)
     print(output)
-    print("MPI job initiated.")
 
 def build_mpi_args(data):
     args = []
@@ -239,49 +434,82 @@ def build_mpi_args(data):
             args.extend([flag, str(data[key])])
     return args
 
-# --- Main loop ---
-def main_loop():
-    print("Puller started. Listening for tasks in Redis…")
+# --- Queue helpers ---
+def heartbeat_loop():
     while True:
-        if r.llen("pending_tasks") > 0:
-            ensure_mpi_deployed()
-            mpi_pods = wait_for_all_nodes_ready()
-            ensure_observer_deployed(mpi_pods[0].metadata.name)
-            wait_for_observer_ready()
-            
-            job = r.lpop("pending_tasks")
-            if not job:
-                continue  # pudo haber alguien más leyendo
-        else:
-            time.sleep(1)
-            continue
+        r.set(HEARTBEAT_KEY, 1, ex=VISIBILITY_TIMEOUT)
+        time.sleep(VISIBILITY_TIMEOUT / 3)
 
-        print("Received job:", job)
-        data     = json.loads(job)
-        job_uuid = data.pop("uuid", None)
+def reclaim(processing_key):
+    namespace = processing_key.split(":", 1)[1]
+    moved = RECLAIM_JOBS(keys=[processing_key, f"puller_alive:{namespace}"], args=[time.time()])
+    if moved:
+        print(f"Reclaimed {moved} job(s) from {processing_key}")
 
-        # Añadir campos status y namespace
-        data["status"]     = ""
-        data["namespace"] = NAMESPACE
+def reclaim_orphans():
+    for key in r.scan_iter(match="processing:*"):
+        reclaim(key.decode())
 
-        # Push a running_task
-        r.lpush("running_tasks", json.dumps(data))
-        print("Pushed to running_task.")
+def recover_own_jobs():
+    # Jobs left by a previous run of this puller go back before we start
+    r.delete(HEARTBEAT_KEY)
+    reclaim(PROCESSING_KEY)
+
+# --- Main loop ---
+def main_loop():
+    print("Puller started. Listening for tasks in Redis…")
+    recover_own_jobs()
+    metrics.serve()
+    threading.Thread(target=heartbeat_loop, daemon=True).start()
+    for informer in (pods, deployments, statefulsets):
+        informer.start()
+    for informer in (pods, deployments, statefulsets):
+        informer.wait_synced()
 
-        # Build MPI args
-        filtered = {k: v for k, v in data.items() if k not in ["status", "namespace"]}
-        mpi_args = build_mpi_args(filtered)
+    while True:
+        # A draining namespace finishes its work but takes no new jobs
+        if r.sismember("draining_namespaces", NAMESPACE):
+            time.sleep(BLOCK_TIMEOUT)
+            continue
 
-        # 1) Asegurar MPI‐nodes
-        ensure_mpi_deployed()
-        mpi_pods = wait_for_all_nodes_ready()
+        ensure_cluster_ready()
 
-        # 2) Asegurar Observer
-        ensure_observer_deployed(mpi_pods[0].metadata.name)
-        wait_for_observer_ready()
+        # Atomic handoff of the highest-priority job(s): never outside Redis
+        batch = jobstate.dequeue_jobs(r, PROCESSING_KEY, NAMESPACE,
+                                      limit=BATCH_SIZE, max_work=BATCH_MAX_WORK)
+        if not batch:
+            # Wakes up as soon as something is queued
+            jobstate.wait_for_jobs(r, BLOCK_TIMEOUT)
+            reclaim_orphans()
+            continue
 
-        # 3) Ejecutar MPI
-        run_mpi_on_master(mpi_pods[0].metadata.name, mpi_pods, mpi_args, job_uuid)
+        jobs = []
+        for raw in batch:
+            print("Received job:", raw)
+            data     = json.loads(raw)
+            job_uuid = data.get("uuid")
+            print(f"Job {job_uuid} running in {NAMESPACE}.")
+            if "submitted_at" in data:
+                metrics.PHASE_SECONDS.labels("queue_wait").observe(time.time() - data["submitted_at"])
+
+            # Build MPI args
+            jobs.append((job_uuid, build_mpi_args(data), data))
+
+        # Let the observer find the batch by namespace
+        jobstate.set_namespace_jobs(r, NAMESPACE, [job[0] for job in jobs])
+
+        # 1) Asegurar MPI‐nodes y Observer (no-op while the pod set is warm)
+        mpi_pods = ensure_cluster_ready()
+
+        # 2) Ejecutar MPI
+        refit_rank_model()
+        run_mpi_on_master(mpi_pods[0].metadata.name, mpi_pods, jobs)
+
+        # The observer owns the jobs from here on
+        pipe = r.pipeline()
+        for raw in batch:
+            pipe.lrem(PROCESSING_KEY, 1, raw)
+        pipe.execute()
 
 if __name__ == "__main__":
     main_loop()
@@ -0,0 +1,106 @@
+# Cost model picking how many MPI ranks a job runs on.
+#
+# fractal_mpi is master/worker: rank 0 hands out blocks of block_size x
+# block_size pixels and the other ranks render them. Every rank adds launch
+# time (an SSH session and a process) and master traffic, so small images
+# finish sooner on fewer ranks. A job of `cost` pixel-samples cut into
+# `blocks` blocks is modelled to take, on n ranks,
+#
+#   t(n) = startup + per_rank * n + cost * ceil(blocks / (n - 1)) / blocks / rate
+#
+# seconds: a fixed launch cost, a cost per rank, and the blocks dealt in
+# rounds to n - 1 workers that render `rate` pixel-samples per second each.
+# The coefficients start from the RANK_* defaults below and are refitted by
+# least squares on the renders the observer timed (jobstate.rank_runs).
+import math
+import os
+
+MIN_RANKS = 2  # the master and one worker
+
+RANK_STARTUP     = float(os.getenv("RANK_STARTUP", 1.0))
+RANK_PER_RANK    = float(os.getenv("RANK_PER_RANK", 0.1))
+RANK_WORKER_RATE = float(os.getenv("RANK_WORKER_RATE", 5e6))  # pixel-samples/s per worker
+RANK_MIN_RUNS    = int(os.getenv("RANK_MIN_RUNS", 20))
+
+
+def features(ranks, cost, blocks):
+    """Terms of t(n) the coefficients (startup, per_rank, 1 / rate) multiply."""
+    rounds = math.ceil(blocks / (ranks - 1))
+    return (1.0, float(ranks), cost * rounds / blocks)
+
+
+def _solve(a, b):
+    """Solves the square system a x = b by Gaussian elimination; None if singular."""
+    n = len(b)
+    m = [list(row) + [rhs] for row, rhs in zip(a, b)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda i: abs(m[i][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for i in range(col + 1, n):
+            f = m[i][col] / m[col][col]
+            for j in range(col, n + 1):
+                m[i][j] -= f * m[col][j]
+    x = [0.0] * n
+    for i in reversed(range(n)):
+        x[i] = (m[i][n] - sum(m[i][j] * x[j] for j in range(i + 1, n))) / m[i][i]
+    return x
+
+
+class RankModel:
+    """t(n) with fitted coefficients; `runs` is how many timed renders it was fitted on."""
+
+    def __init__(self, startup=RANK_STARTUP, per_rank=RANK_PER_RANK, rate=RANK_WORKER_RATE, runs=0):
+        self.startup = startup
+        self.per_rank = per_rank
+        self.rate = rate
+        self.runs = runs
+
+    def __repr__(self):
+        return (f"RankModel(startup={self.startup:.3f}, per_rank={self.per_rank:.3f}, "
+                f"rate={self.rate:.4g}, runs={self.runs})")
+
+    def predict(self, ranks, cost, blocks):
+        one, n, work = features(ranks, cost, blocks)
+        return self.startup * one + self.per_rank * n + work / self.rate
+
+    def choose(self, cost, blocks, max_ranks):
+        """Number of ranks in [MIN_RANKS, max_ranks] with the lowest predicted time.
+
+        More than one worker per block never helps, so the search stops there.
+        """
+        if max_ranks < MIN_RANKS:
+            return max_ranks
+        top = min(max_ranks, blocks + 1)
+        return min(range(MIN_RANKS, top + 1), key=lambda n: (self.predict(n, cost, blocks), n))
+
+    @classmethod
+    def fit(cls, runs, fallback=None):
+        """Least-squares fit on {"ranks", "cost", "blocks", "seconds"} runs.
+
+        Returns `fallback` (the defaults if None) while there are fewer than
+        RANK_MIN_RUNS usable runs, they all used the same number of ranks, or
+        the fit is not physical (a non-positive rate).
+        """
+        fallback = fallback or cls()
+        rows, times = [], []
+        for run in runs:
+            if run['ranks'] >= MIN_RANKS and run['blocks'] > 0:
+                rows.append(features(run['ranks'], run['cost'], run['blocks']))
+                times.append(run['seconds'])
+        if len(rows) < RANK_MIN_RUNS or len({row[1] for row in rows}) < 2:
+            return fallback
+
+        # Columns span many orders of magnitude: scale them to 1 first
+        scale = [max(abs(row[j]) for row in rows) or 1.0 for j in range(3)]
+        scaled = [[row[j] / scale[j] for j in range(3)] for row in rows]
+        normal = [[sum(row[i] * row[j] for row in scaled) for j in range(3)] for i in range(3)]
+        rhs = [sum(row[i] * t for row, t in zip(scaled, times)) for i in range(3)]
+        solution = _solve(normal, rhs)
+        if solution is None:
+            return fallback
+        startup, per_rank, inverse_rate = (x / s for x, s in zip(solution, scale))
+        if inverse_rate <= 0:
+            return fallback
+        return cls(max(startup, 0.0), max(per_rank, 0.0), 1.0 / inverse_rate, len(rows))
@@ -0,0 +1,35 @@
+# Frame parameters of a keyframed camera path.
+#
+# Keyframes are full render parameters. Frames are spread evenly over the path,
+# from the first keyframe to the last, with an equal share of frames per
+# segment. Between two keyframes the camera moves
+# linearly, while zoom is interpolated geometrically, so a zoom animation
+# magnifies by the same factor every frame. All other parameters come from the
+# keyframe that starts the segment.
+import math
+
+
+def interpolate(a, b, t):
+    """Parameters a fraction t in [0, 1] of the way from keyframe a to keyframe b."""
+    return {
+        **a,
+        'camera_x': a['camera_x'] + (b['camera_x'] - a['camera_x']) * t,
+        'camera_y': a['camera_y'] + (b['camera_y'] - a['camera_y']) * t,
+        'zoom': math.exp(math.log(a['zoom']) + (math.log(b['zoom']) - math.log(a['zoom'])) * t),
+    }
+
+
+def keyframe_path(keyframes, frames):
+    """Parameters of `frames` frames along the path through `keyframes`."""
+    if len(keyframes) < 2 or frames < len(keyframes):
+        raise ValueError("need at least two keyframes and one frame per keyframe")
+    if any(k['zoom'] <= 0 for k in keyframes):
+        raise ValueError("zoom must be positive")
+    segments = len(keyframes) - 1
+    path = []
+    for i in range(frames):
+        # Position along the path in keyframe units
+        s = i * segments / (frames - 1)
+        k = min(int(s), segments - 1)
+        path.append(interpolate(keyframes[k], keyframes[k + 1], s - k))
+    return path
@@ -1,42 +1,217 @@
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g, send_file
 from flask_cors import CORS
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from animation import keyframe_path
+from blob_store import BlobStore
+from concurrent.futures import ThreadPoolExecutor
+from local_engine import LocalEngine
+from result_cache import ResultCache
+from job_updates import JobUpdates
+from tiling import split_job, pyramid_tile
+from tile_cache import TileCache
+import archive
+import jobstate
+import metrics
+import hashlib
+import queue
 import redis
+import threading
+import time
 import uuid
 import json
+import math
+import os
 
 # Initialize Flask
 app = Flask(__name__)
 CORS(app)
 
 # Redis client
-r = redis.Redis(host='redis', port=6379, db=0)
+r = metrics.instrument_redis(redis.Redis(host='redis', port=6379, db=0))
+
+# Finished images live as blobs on the volume shared with the socket handlers;
+# completed_tasks only holds their names. Results are kept BLOB_TTL seconds
+# after they finish (or were last served from the result cache), whether or
+# not they were downloaded, so interrupted downloads can resume with Range.
+BLOB_DIR         = os.getenv("BLOB_DIR", "/blobs")
+BLOB_TTL         = float(os.getenv("BLOB_TTL", 3600))
+BLOB_GC_INTERVAL = float(os.getenv("BLOB_GC_INTERVAL", 60))
+blob_store = BlobStore(BLOB_DIR)
+
+# Result cache (keyed by the canonical hash of the render parameters, holds blob names)
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+RESULT_CACHE_TTL       = float(os.getenv("RESULT_CACHE_TTL", 3600))
+result_cache = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+
+# Renders at or above SPLIT_MIN_PIXELS are split into SPLIT_TILE_SIZE sub-region jobs;
+# 0 (the default) disables splitting until tiling.py is checked against the renderer
+SPLIT_MIN_PIXELS = int(os.getenv("SPLIT_MIN_PIXELS", 0))
+SPLIT_TILE_SIZE  = int(os.getenv("SPLIT_TILE_SIZE", 2048))
+
+# Attaches a submission to an identical in-flight job, or registers it as the leader.
+# Returns the leader uuid when the render is already queued or running.
+ATTACH_INFLIGHT = r.register_script("""
+local key, job_uuid = ARGV[1], ARGV[2]
+redis.call('HSET', 'completed_tasks', job_uuid, '')
+redis.call('HSET', 'task_keys', job_uuid, key)
+local leader = redis.call('HGET', 'inflight_jobs', key)
+if leader then
+    redis.call('SADD', 'job_waiters:' .. leader, job_uuid)
+    return leader
+end
+redis.call('HSET', 'inflight_jobs', key, job_uuid)
+return false
+""")
+
+# Admission control, in pixel-samples of jobstate.job_cost (0 disables a limit):
+#   MAX_JOB_WORK      largest width*height*samples of one job (400 above it)
+#   MAX_QUEUED_COST   cap on the cost waiting in pending_tasks across all clients
+#   CLIENT_COST_RATE  per-client token bucket refill per second, holding at most
+#   CLIENT_COST_BURST tokens; a job needs min(cost, burst) tokens and takes its
+#                     full cost, so a large job leaves its client in debt
+# Refused submissions get 429 with a Retry-After: the time the bucket needs to
+# refill, or the time the cluster needs to drain the excess queued cost at the
+# throughput the autoscaler measures (ADMISSION_RETRY_AFTER while unknown).
+# Jobs answered from the result cache or coalesced onto an in-flight job are
+# never charged.
+MAX_JOB_WORK          = int(os.getenv("MAX_JOB_WORK", 16384 * 16384 * 16))
+MAX_QUEUED_COST       = float(os.getenv("MAX_QUEUED_COST", 2e10))
+CLIENT_COST_RATE      = float(os.getenv("CLIENT_COST_RATE", 5e6))
+CLIENT_COST_BURST     = float(os.getenv("CLIENT_COST_BURST", 60 * CLIENT_COST_RATE))
+ADMISSION_RETRY_AFTER = float(os.getenv("ADMISSION_RETRY_AFTER", 10))
+
+# Charges `cost` to the client's bucket (KEYS[1]) if the queue and the bucket
+# allow it. Returns false when admitted, {'queue', excess cost, throughput} or
+# {'client', seconds until enough tokens} otherwise; numbers as strings, as Lua
+# numbers would be truncated to integers.
+ADMIT = r.register_script("""
+local bucket, cost, now = KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2])
+local rate, burst, max_queued = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+if max_queued > 0 then
+    local queued = tonumber(redis.call('HGET', 'job_counters', 'queued_cost') or '0')
+    -- A job larger than the cap is still admitted into an empty queue
+    if queued > 0 and queued + cost > max_queued then
+        local throughput = redis.call('HGET', 'job_counters', 'throughput') or '0'
+        return {'queue', tostring(queued + cost - max_queued), throughput}
+    end
+end
+if rate > 0 then
+    local state = redis.call('HMGET', bucket, 'tokens', 'at')
+    local tokens = tonumber(state[1]) or burst
+    local at = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(now - at, 0) * rate)
+    local needed = math.min(cost, burst)
+    if tokens < needed then
+        return {'client', tostring((needed - tokens) / rate)}
+    end
+    redis.call('HSET', bucket, 'tokens', tokens - cost, 'at', now)
+    redis.call('EXPIRE', bucket, math.ceil((burst + cost) / rate) + 1)
+end
+return false
+""")
+
+# Submissions of at least PREVIEW_MIN_WORK pixel-samples (width*height*samples)
+# also queue a downscaled, single-sample render of the same view (at most
+# PREVIEW_MAX_EDGE pixels per side); "preview": true or false in the body
+# overrides that choice. The preview jumps PREVIEW_BOOST seconds ahead in the
+# queue. Until the full image is ready, get-image answers 202 with the preview's
+# uuid in X-Preview-UUID once it can be fetched (like any image, by that uuid).
+# previews maps each job to its preview's uuid.
+PREVIEW_MIN_WORK = int(os.getenv("PREVIEW_MIN_WORK", 2048 * 2048))
+PREVIEW_MAX_EDGE = int(os.getenv("PREVIEW_MAX_EDGE", 256))
+PREVIEW_BOOST    = float(os.getenv("PREVIEW_BOOST", 3600))
+
+# Jobs of at most LOCAL_MAX_WORK pixel-samples (width*height*samples) skip the
+# cluster: the server renders them with its NumPy engine on LOCAL_WORKERS
+# processes. 0 disables the fast path; testing/bench_local_engine.py finds the
+# crossover where the cluster becomes faster. Past LOCAL_MAX_PENDING local jobs,
+# small jobs are queued for the cluster as usual. The engine's images differ from
+# the cluster's, so they are cached and coalesced under 'local:'-prefixed keys.
+LOCAL_MAX_WORK    = int(os.getenv("LOCAL_MAX_WORK", 0))
+LOCAL_WORKERS     = int(os.getenv("LOCAL_WORKERS", os.cpu_count() or 1))
+LOCAL_MAX_PENDING = int(os.getenv("LOCAL_MAX_PENDING", 4 * LOCAL_WORKERS))
+local_engine = LocalEngine(LOCAL_WORKERS, LOCAL_MAX_PENDING)
+local_renders = ThreadPoolExecutor(LOCAL_MAX_PENDING, thread_name_prefix='local-render')
+
+# Stores a locally rendered image for the job and its coalesced submissions,
+# as the socket handler's FINISH_JOB does for the cluster's images.
+FINISH_LOCAL = r.register_script("""
+local job_uuid, blob, now = ARGV[1], ARGV[2], ARGV[3]
+local targets = redis.call('SMEMBERS', 'job_waiters:' .. job_uuid)
+table.insert(targets, job_uuid)
+for _, target in ipairs(targets) do
+    redis.call('HSET', 'completed_tasks', target, blob)
+    redis.call('HSET', 'completed_at', target, now)
+    redis.call('PUBLISH', 'job_updates', cjson.encode({uuid = target, event = 'ready'}))
+end
+redis.call('DEL', 'job_waiters:' .. job_uuid)
+local key = redis.call('HGET', 'task_keys', job_uuid)
+if key and redis.call('HGET', 'inflight_jobs', key) == job_uuid then
+    redis.call('HDEL', 'inflight_jobs', key)
+end
+return #targets - 1
+""")
+
+# Moves a job from one cache and coalescing key to another; later duplicates
+# no longer attach to it
+REKEY_JOB = r.register_script("""
+local job_uuid, old, new = ARGV[1], ARGV[2], ARGV[3]
+if redis.call('HGET', 'inflight_jobs', old) == job_uuid then
+    redis.call('HDEL', 'inflight_jobs', old)
+end
+redis.call('HSET', 'task_keys', job_uuid, new)
+""")
+
+# Batches (animations) queue up to BATCH_MAX_FRAMES frames in two pipelined
+# round trips. batch:<id> lists the frame uuids in order for BATCH_TTL seconds.
+BATCH_MAX_FRAMES = int(os.getenv("BATCH_MAX_FRAMES", 1000))
+BATCH_TTL        = jobstate.JOB_TTL
+
+# Progress and ready notifications pushed to /api/job-events streams. Streams
+# send a comment every SSE_KEEPALIVE seconds and re-check for the image then,
+# so an update lost while the subscription reconnects only delays them.
+SSE_KEEPALIVE = float(os.getenv("SSE_KEEPALIVE", 15))
+job_updates = JobUpdates(r, jobstate.UPDATES_CHANNEL)
+
+# Deep-zoom tile pyramid
+TILE_CACHE_DIR       = os.getenv("TILE_CACHE_DIR", "/data/tiles")
+TILE_CACHE_MAX_BYTES = int(os.getenv("TILE_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+TILE_SIZE            = int(os.getenv("TILE_SIZE", 256))
+TILE_SAMPLES         = int(os.getenv("TILE_SAMPLES", 1))
+TILE_BLOCK_SIZE      = int(os.getenv("TILE_BLOCK_SIZE", 64))
+TILE_MAX_ZOOM        = int(os.getenv("TILE_MAX_ZOOM", 40))
+TILE_EXTENT          = float(os.getenv("TILE_EXTENT", 2.0))
+tile_cache = TileCache(TILE_CACHE_DIR, TILE_CACHE_MAX_BYTES)
 
 done = False
 
-@app.route('/api/submit-job', methods=['PUT'])
-def submit_job():
-    body = request.get_json(force=True)
-    job_uuid = str(uuid.uuid4())
+# Fields that identify a render, in the order they are hashed
+RENDER_FIELDS = ['width', 'height', 'block_size', 'samples', 'camera_x', 'camera_y', 'zoom', 'type', 'color_mode']
 
-    try:
-        # Validate parameters
-        params = ['width','height','block_size','samples','camerax','cameray','zoom','type', 'color_mode']
-        for p in params:
-            _ = body[p]
-        width, height, block_size = map(int, [body['width'], body['height'], body['block_size']])
-        samples = int(body['samples'])
-        camera_x, camera_y, zoom = map(float, [body['camerax'], body['cameray'], body['zoom']])
-        render_type = int(body['type'])
-        color_mode = int(body['color_mode'])
-    except Exception:
-        return jsonify({"error": "Parámetros inválidos"}), 400
+def positive_int(value):
+    """An integer >= 1 given as a JSON number or a numeric string; ValueError otherwise."""
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(f"not an integer: {value!r}")
+    number = int(value)
+    if number < 1:
+        raise ValueError(f"not positive: {value!r}")
+    return number
 
-    # Store uuid in images hash map
-    r.hset('completed_tasks', job_uuid, b'')
+def parse_job_params(body):
+    """Validates a submitted payload and returns the normalized render parameters.
 
-    # Queue job
-    job_data = {
-        'uuid': job_uuid,
+    Sizes must be positive integers: anything else would give the job a zero
+    or negative cost, which admission and the queue priority would reward.
+    """
+    params = ['width','height','block_size','samples','camerax','cameray','zoom','type', 'color_mode']
+    for p in params:
+        _ = body[p]
+    width, height, block_size, samples = map(
+        positive_int, [body['width'], body['height'], body['block_size'], body['samples']])
+    camera_x, camera_y, zoom = map(float, [body['camerax'], body['cameray'], body['zoom']])
+    render_type = int(body['type'])
+    color_mode = int(body['color_mode'])
+    return {
         'width': width,
         'height': height,
         'block_size': block_size,
@@ -47,21 +222,351 @@ def submit_job():
         'type': render_type,
         'color_mode': color_mode,
     }
-    r.lpush('pending_tasks', json.dumps(job_data))
-    app.logger.info(f"Queued job: {job_data}")
-    return jsonify({"uuid": job_uuid}), 202
+
+def job_key(job_data):
+    """Canonical hash of the render parameters; identical renders share a key."""
+    # Adding 0.0 folds -0.0 into 0.0 so both hash the same
+    canonical = [job_data[f] + 0.0 if isinstance(job_data[f], float) else job_data[f]
+                 for f in RENDER_FIELDS]
+    return hashlib.sha256(json.dumps(canonical).encode()).hexdigest()
+
+def render_key(job_data):
+    """job_key of the image the job will get. The local engine only approximates
+    the cluster's renderer, so its images are cached and coalesced apart."""
+    key = job_key(job_data)
+    return f'local:{key}' if renders_locally(job_data) else key
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    if 'request_start' in g:
+        metrics.HTTP_SECONDS.labels(request.endpoint or 'unknown').observe(
+            time.perf_counter() - g.request_start)
+    return response
+
+@app.route('/api/submit-job', methods=['PUT'])
+def submit_job():
+    body = request.get_json(force=True)
+    job_uuid = str(uuid.uuid4())
+
+    try:
+        job_params = parse_job_params(body)
+    except Exception:
+        metrics.SUBMISSIONS.labels('invalid').inc()
+        return jsonify({"error": "Parámetros inválidos"}), 400
+
+    refused = check_budget([job_params]) or admit([job_params])
+    if refused:
+        return refused
+
+    priority = queue_render(job_uuid, job_params)
+    response = {"uuid": job_uuid, "estimated_start": estimate_start(priority)}
+    work = job_params['width'] * job_params['height'] * job_params['samples']
+    if body.get('preview', work >= PREVIEW_MIN_WORK) and r.hget('completed_tasks', job_uuid) == b'':
+        response['preview_uuid'] = queue_preview(job_uuid, job_params)
+    return jsonify(response), 202
+
+def check_budget(frames):
+    """400 response if a job exceeds MAX_JOB_WORK, else None."""
+    if MAX_JOB_WORK and any(p['width'] * p['height'] * p['samples'] > MAX_JOB_WORK for p in frames):
+        metrics.SUBMISSIONS.labels('too_large').inc()
+        return jsonify({"error": "Trabajo demasiado grande", "max_work": MAX_JOB_WORK}), 400
+    return None
+
+def client_id():
+    # The client's nginx sets X-Real-IP to the peer it saw; X-Forwarded-For starts
+    # with whatever the client sent, so it cannot identify a bucket
+    return request.headers.get('X-Real-IP') or request.remote_addr
+
+def admit(frames):
+    """Charges the render cost of `frames` to the client; a 429 response if refused, else None.
+
+    Only renders that will reach a renderer are charged: frames answered from
+    the cache, or coalesced onto an in-flight job or an earlier frame, are free.
+    """
+    pending = {}
+    for job_params in frames:
+        key = render_key(job_params)
+        if key not in result_cache:
+            pending.setdefault(key, job_params)
+    if pending:
+        keys = list(pending)
+        for key, leader in zip(keys, r.hmget('inflight_jobs', keys)):
+            if leader is not None:
+                del pending[key]
+    cost = sum(jobstate.job_cost(p) for p in pending.values())
+    if not cost:
+        return None
+    refused = ADMIT(keys=[f'admission:{client_id()}'],
+                    args=[cost, time.time(), CLIENT_COST_RATE, CLIENT_COST_BURST, MAX_QUEUED_COST])
+    if not refused:
+        return None
+
+    reason = refused[0].decode()
+    if reason == 'queue':
+        excess, throughput = float(refused[1]), float(refused[2])
+        retry_after = excess / throughput if throughput > 0 else ADMISSION_RETRY_AFTER
+        message = "Cola llena, intente más tarde"
+    else:
+        retry_after = float(refused[1])
+        message = "Demasiadas solicitudes, intente más tarde"
+    retry_after = max(1, math.ceil(retry_after))
+    metrics.SUBMISSIONS.labels('throttled').inc()
+    app.logger.info(f"Refused {len(frames)} job(s) of {client_id()} ({reason}), retry in {retry_after}s")
+    return jsonify({"error": message, "reason": reason, "retry_after": retry_after}), 429, \
+        {'Retry-After': str(retry_after)}
+
+def queue_render(job_uuid, job_params, boost=0):
+    """Registers job_uuid in completed_tasks and gets its image rendered.
+
+    Repeated renders are answered from the cache, duplicates of an in-flight
+    job are coalesced onto it and large renders are split into tiles.
+    Returns the queue priority of the job that will produce the image, or None
+    when nothing needs to wait in the queue.
+    """
+    key = render_key(job_params)
+
+    # Answer repeated renders from the cache without touching the cluster
+    cached = result_cache.get(key)
+    if cached is not None and blob_store.touch(cached):
+        pipe = r.pipeline()
+        pipe.hset('completed_tasks', job_uuid, cached)
+        pipe.hset('completed_at', job_uuid, time.time())
+        pipe.execute()
+        metrics.SUBMISSIONS.labels('cached').inc()
+        app.logger.info(f"Cache hit for job {job_uuid} ({key})")
+        return None
+
+    # Store uuid in images hash map, coalescing with an identical in-flight job
+    leader = ATTACH_INFLIGHT(args=[key, job_uuid])
+    if leader:
+        metrics.SUBMISSIONS.labels('coalesced').inc()
+        app.logger.info(f"Job {job_uuid} attached to in-flight job {leader.decode()}")
+        job = jobstate.get_job(r, leader.decode())
+        return job['priority'] if job and job['status'] == 'queued' else None
+
+    if splits(job_params):
+        metrics.SUBMISSIONS.labels('split').inc()
+        return queue_split_job(job_uuid, job_params)
+
+    if render_locally(job_uuid, job_params):
+        return None
+
+    # Queue job
+    priority = jobstate.enqueue_job(r, job_uuid, job_params, boost=boost)
+    metrics.SUBMISSIONS.labels('queued').inc()
+    app.logger.info(f"Queued job {job_uuid}: {job_params}")
+    return priority
+
+def renders_locally(job_params):
+    work = job_params['width'] * job_params['height'] * job_params['samples']
+    return LOCAL_MAX_WORK > 0 and 0 < work <= LOCAL_MAX_WORK and local_engine.supports(job_params)
+
+def render_locally(job_uuid, job_params):
+    """Hands a small job to the local engine; returns False if it must go to the cluster."""
+    if not renders_locally(job_params):
+        return False
+    if not local_engine.try_acquire():
+        to_cluster(job_uuid, job_params)
+        return False
+    metrics.SUBMISSIONS.labels('local').inc()
+    local_renders.submit(finish_local, job_uuid, job_params)
+    return True
+
+def finish_local(job_uuid, job_params):
+    try:
+        with metrics.phase('local_render'):
+            image = local_engine.render(job_params)
+        blob = BlobStore.name(job_uuid)
+        blob_store.write(blob, image)
+        waiters = FINISH_LOCAL(args=[job_uuid, blob, time.time()])
+        app.logger.info(f"Rendered job {job_uuid} locally ({waiters} coalesced)")
+    except Exception as e:
+        # The cluster can still render it; coalesced submissions keep waiting on it
+        app.logger.error(f"Local render of {job_uuid} failed, queueing it: {e}")
+        to_cluster(job_uuid, job_params)
+        jobstate.enqueue_job(r, job_uuid, job_params)
+    finally:
+        local_engine.release()
+
+def to_cluster(job_uuid, job_params):
+    """Rekeys a job meant for the local engine that the cluster renders instead,
+    so its image is cached as a cluster render. Its coalesced submissions stay."""
+    REKEY_JOB(args=[job_uuid, f'local:{job_key(job_params)}', job_key(job_params)])
+
+def preview_params(job_params):
+    """The same view at most PREVIEW_MAX_EDGE pixels per side with one sample."""
+    width, height = job_params['width'], job_params['height']
+    longest = max(width, height)
+    # Only ever shrinks, so a degenerate size cannot divide by zero
+    scale = PREVIEW_MAX_EDGE / longest if longest > PREVIEW_MAX_EDGE else 1.0
+    # The view depends only on the aspect ratio and zoom (see tiling.py)
+    return {
+        **job_params,
+        'width': max(1, round(width * scale)),
+        'height': max(1, round(height * scale)),
+        'samples': 1,
+    }
+
+def queue_preview(job_uuid, job_params):
+    """Queues the preview of a job ahead of ordinary jobs; returns its uuid, or None
+    when the job is no bigger than its preview."""
+    params = preview_params(job_params)
+    if params['width'] * params['height'] * params['samples'] >= \
+            job_params['width'] * job_params['height'] * job_params['samples']:
+        return None
+    preview_uuid = str(uuid.uuid4())
+    # Like any render, a preview is answered from the cache or coalesced when it can be
+    queue_render(preview_uuid, params, boost=PREVIEW_BOOST)
+    r.hset('previews', job_uuid, preview_uuid)
+    return preview_uuid
+
+def estimate_start(priority):
+    """Seconds until a job with this priority is expected to start, if known."""
+    if priority is None:
+        return 0
+    _, cost_ahead = jobstate.queue_position(r, priority)
+    throughput = jobstate.counters(r).get('throughput', 0.0)
+    if throughput <= 0:
+        return None
+    return round(cost_ahead / throughput, 1)
+
+def splits(job_params):
+    return 0 < SPLIT_MIN_PIXELS <= job_params['width'] * job_params['height']
+
+def queue_split_job(job_uuid, job_params):
+    """Queues a large render as independent tiles that the socket handler stitches back."""
+    tiles = split_job(job_params, SPLIT_TILE_SIZE)
+    priority = None
+    pipe = r.pipeline()
+    for (x, y, w, h), tile_params in tiles:
+        tile_uuid = str(uuid.uuid4())
+        layout = {'x': x, 'y': y, 'w': w, 'h': h,
+                  'width': job_params['width'], 'height': job_params['height']}
+        pipe.hset(f'split:{job_uuid}', tile_uuid, json.dumps(layout))
+        pipe.hset('tile_parent', tile_uuid, job_uuid)
+        priority = jobstate.enqueue_job(r, tile_uuid, tile_params, client=pipe)
+    pipe.execute()
+    app.logger.info(f"Queued job {job_uuid} as {len(tiles)} tiles")
+    return priority
+
+@app.route('/api/submit-batch', methods=['PUT'])
+def submit_batch():
+    """Queues many renders as one batch.
+
+    The body is either {"jobs": [...]} with one submit-job payload per frame,
+    or {"keyframes": [...], "frames": n} for an animation along a camera path.
+    Fields in an optional "base" payload apply to every job or keyframe.
+    """
+    body = request.get_json(force=True)
+    try:
+        base = body.get('base', {})
+        count = int(body['frames']) if 'keyframes' in body else len(body['jobs'])
+        if not 1 <= count <= BATCH_MAX_FRAMES:
+            return jsonify({"error": f"Un lote tiene entre 1 y {BATCH_MAX_FRAMES} imágenes"}), 400
+        if 'keyframes' in body:
+            keyframes = [parse_job_params({**base, **k}) for k in body['keyframes']]
+            frames = keyframe_path(keyframes, count)
+        else:
+            frames = [parse_job_params({**base, **job}) for job in body['jobs']]
+    except Exception:
+        metrics.SUBMISSIONS.labels('invalid').inc()
+        return jsonify({"error": "Parámetros inválidos"}), 400
+
+    refused = check_budget(frames) or admit(frames)
+    if refused:
+        return refused
+
+    batch_id = str(uuid.uuid4())
+    frame_uuids = queue_batch(batch_id, frames)
+    return jsonify({"batch": batch_id, "uuids": frame_uuids}), 202
+
+def queue_batch(batch_id, frames):
+    """queue_render for a whole batch: the cache is checked in memory, then all
+    frames attach to in-flight renders in one transaction, and those left queue
+    in one more pipelined round trip. Returns the frame uuids."""
+    frame_uuids = [str(uuid.uuid4()) for _ in frames]
+    now = time.time()
+    pipe = r.pipeline()
+    attached = []
+    for frame_uuid, job_params in zip(frame_uuids, frames):
+        key = render_key(job_params)
+        cached = result_cache.get(key)
+        if cached is not None and blob_store.touch(cached):
+            pipe.hset('completed_tasks', frame_uuid, cached)
+            pipe.hset('completed_at', frame_uuid, now)
+            metrics.SUBMISSIONS.labels('cached').inc()
+            continue
+        # Identical frames of the batch coalesce onto the first one
+        attached.append((len(pipe), frame_uuid, job_params))
+        ATTACH_INFLIGHT(args=[key, frame_uuid], client=pipe)
+    pipe.rpush(f'batch:{batch_id}', *frame_uuids)
+    pipe.expire(f'batch:{batch_id}', BATCH_TTL)
+    results = pipe.execute()
+
+    pipe = r.pipeline()
+    split = []
+    for index, frame_uuid, job_params in attached:
+        if results[index]:
+            metrics.SUBMISSIONS.labels('coalesced').inc()
+        elif splits(job_params):
+            split.append((frame_uuid, job_params))
+        elif not render_locally(frame_uuid, job_params):
+            jobstate.enqueue_job(r, frame_uuid, job_params, client=pipe)
+            metrics.SUBMISSIONS.labels('queued').inc()
+    pipe.execute()
+    for frame_uuid, job_params in split:
+        metrics.SUBMISSIONS.labels('split').inc()
+        queue_split_job(frame_uuid, job_params)
+    app.logger.info(f"Queued batch {batch_id} of {len(frames)} frames")
+    return frame_uuids
 
 @app.route('/api/get-image/<uuid>', methods=['GET'])
 def get_image(uuid):
+    """The finished image; while it renders, 202 naming its preview (if ready).
+
+    ?variant=webp or ?variant=thumb asks for a smaller encoding, served once
+    the socket handler has written it (the PNG until then).
+    """
+    variant = request.args.get('variant')
+    if variant is not None and variant not in BlobStore.VARIANTS:
+        return jsonify({'error':'Unknown variant'}), 400
     try:
-        image = r.hget('completed_tasks', uuid)
-        if image is None:
+        pipe = r.pipeline()
+        pipe.hget('completed_tasks', uuid)
+        pipe.hget('task_keys', uuid)
+        pipe.hget('completed_at', uuid)
+        pipe.hget('previews', uuid)
+        pipe.hget('failed_tasks', uuid)
+        blob, key, completed_at, preview, failure = pipe.execute()
+        if blob is None:
             return jsonify({'error':'UUID not found'}), 404
-        if image == b'':
-            return jsonify({'message':'Still processing'}), 202
+        if failure is not None:
+            return jsonify({'error':'Render failed','details':failure.decode()}), 500
+        if blob == b'':
+            # Polls stay small: the client fetches the preview once, by its uuid
+            headers = {}
+            if preview and r.hget('completed_tasks', preview) not in (None, b''):
+                headers['X-Preview-UUID'] = preview.decode()
+            return jsonify({'message':'Still processing'}), 202, headers
+
+        blob = blob.decode()
+        found = blob_file(blob, variant)
+        if found is None:
+            return jsonify({'error':'Result expired'}), 404
+        path, mimetype, size = found
+        if request.range is None:
+            if key:
+                result_cache.put(key.decode(), blob, blob_store.size(blob))
+            if completed_at:
+                metrics.PHASE_SECONDS.labels('pickup').observe(time.time() - float(completed_at))
+            metrics.IMAGE_BYTES.labels('served').inc(size)
 
-        r.hdel('completed_tasks', uuid)
-        return Response(image, mimetype='image/png'), 200
+        # Streams the file (sendfile where the server supports it) and answers Range requests
+        return send_file(path, mimetype=mimetype, conditional=True, max_age=0)
 
     except redis.RedisError as e:
         app.logger.error(f"Redis error: {e}")
@@ -71,6 +576,294 @@ def get_image(uuid):
         app.logger.error(f"Unexpected error: {e}")
         return jsonify({'error':'Unexpected error','details':str(e)}), 500
 
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def blob_file(blob, variant=None):
+    """(path, mimetype, size) of a blob's variant, falling back to the PNG itself;
+    None once the blob has been collected."""
+    if variant is not None:
+        name = BlobStore.variant(blob, variant)
+        size = blob_store.size(name)
+        if size is not None:
+            return blob_store.path(name), BlobStore.VARIANTS[variant][1], size
+    size = blob_store.size(blob)
+    if size is None:
+        return None
+    return blob_store.path(blob), 'image/png', size
+
+@app.route('/api/job-events/<uuid>', methods=['GET'])
+def job_events(uuid):
+    """Server-Sent Events stream of a job: `progress` events, a `preview` event
+    when its preview can be fetched, then one `ready` event, or one `failed`
+    event if the cluster gave up on the render."""
+    try:
+        pipe = r.pipeline()
+        pipe.hget('completed_tasks', uuid)
+        pipe.hget('task_keys', uuid)
+        pipe.hget('previews', uuid)
+        pipe.hget('failed_tasks', uuid)
+        image, key, preview, failure = pipe.execute()
+        if image is None:
+            return jsonify({'error':'UUID not found'}), 404
+        # Coalesced submissions report the progress of the job rendering for them
+        leader = r.hget('inflight_jobs', key) if key else None
+    except redis.RedisError as e:
+        app.logger.error(f"Redis error: {e}")
+        return jsonify({'error':'Redis error','details':str(e)}), 500
+
+    watched = {uuid, leader.decode()} if leader else {uuid}
+    preview = preview.decode() if preview else None
+    if preview:
+        watched.add(preview)
+
+    def stream():
+        if failure is not None:
+            yield sse('failed', {'error': failure.decode()})
+            return
+        updates = job_updates.subscribe(watched)
+        try:
+            # The image or preview may have landed before the subscription
+            ready = image != b'' or r.hget('completed_tasks', uuid) != b''
+            if preview and not ready and r.hget('completed_tasks', preview):
+                yield sse('preview', {'uuid': preview})
+            while not ready:
+                try:
+                    update = updates.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    pipe = r.pipeline(transaction=False)
+                    pipe.hget('completed_tasks', uuid)
+                    pipe.hget('failed_tasks', uuid)
+                    blob, lost_failure = pipe.execute()
+                    if lost_failure is not None:
+                        yield sse('failed', {'error': lost_failure.decode()})
+                        return
+                    ready = blob != b''
+                    yield ": keep-alive\n\n"
+                    continue
+                if update['uuid'] == preview:
+                    if update['event'] == 'ready':
+                        yield sse('preview', {'uuid': preview})
+                    continue
+                if update['event'] == 'progress':
+                    yield sse('progress', {'progress': update['progress']})
+                if update['event'] == 'failed' and update['uuid'] == uuid:
+                    yield sse('failed', {'error': update['error']})
+                    return
+                ready = update['event'] == 'ready' and update['uuid'] == uuid
+            yield sse('ready', {'uuid': uuid})
+        finally:
+            job_updates.unsubscribe(updates, watched)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/job-status/<uuid>', methods=['GET'])
+def job_status(uuid):
+    try:
+        job = jobstate.get_job(r, uuid)
+    except redis.RedisError as e:
+        app.logger.error(f"Redis error: {e}")
+        return jsonify({'error':'Redis error','details':str(e)}), 500
+    if job is None:
+        return jsonify({'error':'UUID not found'}), 404
+    return jsonify(job), 200
+
+def batch_frames(batch_id):
+    """Frame uuids of a batch and their blob names (b'' while rendering, None once expired)."""
+    frame_uuids = [u.decode() for u in r.lrange(f'batch:{batch_id}', 0, -1)]
+    return frame_uuids, (r.hmget('completed_tasks', frame_uuids) if frame_uuids else [])
+
+@app.route('/api/batch-status/<batch_id>', methods=['GET'])
+def batch_status(batch_id):
+    try:
+        frame_uuids, blobs = batch_frames(batch_id)
+        failures = r.hmget('failed_tasks', frame_uuids) if frame_uuids else []
+    except redis.RedisError as e:
+        app.logger.error(f"Redis error: {e}")
+        return jsonify({'error':'Redis error','details':str(e)}), 500
+    if not frame_uuids:
+        return jsonify({'error':'Batch not found'}), 404
+    done = sum(1 for blob in blobs if blob)
+    failed = sum(1 for failure in failures if failure is not None)
+    return jsonify({
+        'frames': len(frame_uuids),
+        'done': done,
+        'failed': failed,
+        'expired': sum(1 for blob in blobs if blob is None),
+        'progress': 100 * done / len(frame_uuids),
+    }), 200
+
+@app.route('/api/batch-archive/<batch_id>', methods=['GET'])
+def batch_archive(batch_id):
+    """Streams the finished frames of a batch as a tar (default) or ?format=zip archive.
+
+    Frames still rendering are left out; X-Frames-Included tells how many made it.
+    """
+    fmt = request.args.get('format', 'tar')
+    if fmt not in archive.FORMATS:
+        return jsonify({'error':'Unknown format'}), 400
+    try:
+        frame_uuids, blobs = batch_frames(batch_id)
+    except redis.RedisError as e:
+        app.logger.error(f"Redis error: {e}")
+        return jsonify({'error':'Redis error','details':str(e)}), 500
+    if not frame_uuids:
+        return jsonify({'error':'Batch not found'}), 404
+
+    files = [(f'frame_{i:05d}.png', blob_store.path(blob.decode()))
+             for i, blob in enumerate(blobs) if blob]
+    if not files:
+        return jsonify({'message':'Still processing'}), 202
+    mimetype, extension = archive.FORMATS[fmt]
+
+    def counted(chunks):
+        for chunk in chunks:
+            metrics.IMAGE_BYTES.labels('served').inc(len(chunk))
+            yield chunk
+
+    return Response(counted(archive.stream(fmt, files)), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=batch-{batch_id}.{extension}',
+        'X-Frames-Included': str(len(files)),
+        'X-Frames-Total': str(len(frame_uuids)),
+    })
+
+@app.route('/api/tile/<int:render_type>/<int:color_mode>/<int:z>/<int:x>/<int:y>', methods=['GET'])
+def get_tile(render_type, color_mode, z, x, y):
+    if z > TILE_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        return jsonify({'error':'Tile out of range'}), 404
+
+    tile = (render_type, color_mode, z, x, y)
+    image = tile_cache.get(*tile)
+    if image is not None:
+        return tile_response(image)
+
+    try:
+        job_params = {
+            **pyramid_tile(z, x, y, TILE_SIZE, TILE_EXTENT),
+            'block_size': TILE_BLOCK_SIZE,
+            'samples': TILE_SAMPLES,
+            'type': render_type,
+            'color_mode': color_mode,
+        }
+        key = job_key(job_params)
+
+        # One render per tile, however many viewers request it meanwhile
+        tile_uuid = str(uuid.uuid4())
+        if r.hsetnx('tile_jobs', key, tile_uuid):
+            queue_render(tile_uuid, job_params)
+            return jsonify({'uuid': tile_uuid, 'message':'Rendering tile'}), 202, {'Retry-After': '1'}
+
+        tile_uuid = r.hget('tile_jobs', key).decode()
+        pipe = r.pipeline()
+        pipe.hget('completed_tasks', tile_uuid)
+        pipe.hget('failed_tasks', tile_uuid)
+        blob, failure = pipe.execute()
+        if failure is not None:
+            # Quarantined: forget it, so the next request queues a fresh render
+            pipe = r.pipeline()
+            pipe.hdel('completed_tasks', tile_uuid)
+            pipe.hdel('completed_at', tile_uuid)
+            pipe.hdel('task_keys', tile_uuid)
+            pipe.hdel('failed_tasks', tile_uuid)
+            pipe.hdel('tile_jobs', key)
+            pipe.execute()
+            return jsonify({'error':'Render failed','details':failure.decode()}), 500
+        if blob is None or (blob and blob_store.size(blob.decode()) is None):
+            # The render was lost; forget it so the next request queues it again
+            r.hdel('tile_jobs', key)
+            return jsonify({'message':'Rendering tile'}), 202, {'Retry-After': '1'}
+        if blob == b'':
+            return jsonify({'uuid': tile_uuid, 'message':'Rendering tile'}), 202, {'Retry-After': '1'}
+
+        image = blob_store.read(blob.decode())
+        tile_cache.put(tile, image)
+        pipe = r.pipeline()
+        pipe.hdel('completed_tasks', tile_uuid)
+        pipe.hdel('completed_at', tile_uuid)
+        pipe.hdel('task_keys', tile_uuid)
+        pipe.hdel('tile_jobs', key)
+        pipe.execute()
+        return tile_response(image)
+
+    except redis.RedisError as e:
+        app.logger.error(f"Redis error: {e}")
+        return jsonify({'error':'Redis error','details':str(e)}), 500
+
+def tile_response(image):
+    response = Response(image, mimetype='image/png')
+    response.headers['Cache-Control'] = 'public, max-age=86400, immutable'
+    return response, 200
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route('/api/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'results': result_cache.stats(), 'tiles': tile_cache.stats(),
+                    'blobs': blob_store.stats()}), 200
+
+def unstitched_tiles(job_uuids):
+    """The tiles among job_uuids whose split parent has neither been stitched nor failed."""
+    parents = {}
+    for start in range(0, len(job_uuids), 1000):
+        batch = job_uuids[start:start + 1000]
+        parents.update((job_uuid, parent) for job_uuid, parent
+                       in zip(batch, r.hmget('tile_parent', batch)) if parent)
+    if not parents:
+        return set()
+    pending = list(set(parents.values()))
+    failed = {parent for parent, reason in zip(pending, r.hmget('failed_tasks', pending))
+              if reason is not None}
+    return {job_uuid for job_uuid, parent in parents.items() if parent not in failed}
+
+def collect_results():
+    """Forgets results older than BLOB_TTL and deletes their blobs.
+
+    Tiles wait for their parent: the stitch removes them, or they expire
+    with the rest once the parent has failed.
+    """
+    cutoff = time.time() - BLOB_TTL
+    expired = [job_uuid for job_uuid, completed_at in r.hscan_iter('completed_at', count=1000)
+               if float(completed_at) < cutoff]
+    waiting = unstitched_tiles(expired)
+    expired = [job_uuid for job_uuid in expired if job_uuid not in waiting]
+    for start in range(0, len(expired), 1000):
+        batch = expired[start:start + 1000]
+        pipe = r.pipeline()
+        pipe.hdel('completed_tasks', *batch)
+        pipe.hdel('completed_at', *batch)
+        pipe.hdel('task_keys', *batch)
+        pipe.hdel('previews', *batch)
+        pipe.hdel('failed_tasks', *batch)
+        pipe.hdel('tile_parent', *batch)
+        # Leftovers of split jobs that failed before being stitched
+        pipe.delete(*(f'{prefix}:{job_uuid.decode()}' for job_uuid in batch
+                      for prefix in ('split', 'split_done')))
+        pipe.execute()
+    if waiting:
+        # Keep the files of the tiles too until their stitch
+        for blob in r.hmget('completed_tasks', list(waiting)):
+            if blob:
+                blob_store.touch(blob.decode())
+    removed = blob_store.collect(BLOB_TTL)
+    if expired or removed:
+        app.logger.info(f"Expired {len(expired)} results and {removed} blobs")
+
+def blob_gc_loop():
+    while True:
+        # One server replica collects per interval
+        if r.set('blob_gc_lock', 1, nx=True, ex=max(int(BLOB_GC_INTERVAL), 1)):
+            try:
+                collect_results()
+            except (redis.RedisError, OSError) as e:
+                app.logger.error(f"Blob collection failed: {e}")
+        time.sleep(BLOB_GC_INTERVAL)
+
 
 if __name__ == '__main__':
+    if LOCAL_MAX_WORK > 0:
+        local_engine.start()
+    threading.Thread(target=blob_gc_loop, daemon=True).start()
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,86 @@
+import os
+import tarfile
+import time
+import zipfile
+
+CHUNK_SIZE = 1024 * 1024
+
+# format -> (mimetype, file extension)
+FORMATS = {'tar': ('application/x-tar', 'tar'), 'zip': ('application/zip', 'zip')}
+
+
+class _Sink:
+    """Write-only file object whose contents are drained by the generator writing to it."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _open_files(files):
+    """Yields (name, file, size) for each (name, path); files that vanished are skipped."""
+    for name, path in files:
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            continue
+        with f:
+            yield name, f, os.fstat(f.fileno()).st_size
+
+
+def _chunks(f):
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def stream(fmt, files):
+    """Archives (name, path) pairs as an iterator of bytes, one file chunk at a time.
+
+    Nothing but the current chunk is held in memory, so archives of any size
+    can be streamed straight into a response.
+    """
+    return _tar_stream(files) if fmt == 'tar' else _zip_stream(files)
+
+
+def _tar_stream(files):
+    now = int(time.time())
+    for name, f, size in _open_files(files):
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime, info.mode = size, now, 0o644
+        yield info.tobuf(format=tarfile.GNU_FORMAT)
+        yield from _chunks(f)
+        if size % tarfile.BLOCKSIZE:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+    # End-of-archive marker
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def _zip_stream(files):
+    # The sink is not seekable, so zipfile writes sizes in data descriptors.
+    # Images are already compressed: store them as they are.
+    sink = _Sink()
+    date_time = time.localtime()[:6]
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+        for name, f, size in _open_files(files):
+            info = zipfile.ZipInfo(name, date_time)
+            info.file_size = size
+            with zf.open(info, 'w') as entry:
+                for chunk in _chunks(f):
+                    entry.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+
+
+class BlobStore:
+    """Finished images on the volume shared with the MPI nodes' socket handlers.
+
+    A blob is an immutable PNG named after the job that rendered it,
+    <root>/<uuid[:2]>/<uuid>.png; Redis only stores that name. Submissions
+    coalesced onto a job share its blob, so blobs are never deleted on
+    download: `collect` removes every blob not written or touched for `ttl`
+    seconds. The socket handler also writes smaller encodings of each image
+    next to it (VARIANTS); these may lag behind the PNG or be missing.
+    """
+
+    VARIANTS = {'webp': ('.webp', 'image/webp'), 'thumb': ('.thumb.webp', 'image/webp')}
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self.collected = 0
+        self.collected_bytes = 0
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def name(job_uuid):
+        return f"{job_uuid[:2]}/{job_uuid}.png"
+
+    @staticmethod
+    def variant(name, kind):
+        return name[:-len('.png')] + BlobStore.VARIANTS[kind][0]
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def size(self, name):
+        """Size of a blob in bytes, or None once it has been collected."""
+        try:
+            return os.stat(self.path(name)).st_size
+        except FileNotFoundError:
+            return None
+
+    def touch(self, name):
+        """Restarts the TTL of a blob and its variants; returns False if it is already gone."""
+        try:
+            os.utime(self.path(name))
+        except FileNotFoundError:
+            return False
+        for kind in self.VARIANTS:
+            try:
+                os.utime(self.path(self.variant(name, kind)))
+            except FileNotFoundError:
+                pass
+        return True
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def write(self, name, data):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def collect(self, ttl):
+        """Deletes blobs (and abandoned partial uploads) older than ttl seconds."""
+        cutoff = time.time() - ttl
+        removed = removed_bytes = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                    if st.st_mtime < cutoff:
+                        os.remove(path)
+                        removed += 1
+                        removed_bytes += st.st_size
+                except FileNotFoundError:
+                    continue
+        with self._lock:
+            self.collected += removed
+            self.collected_bytes += removed_bytes
+        return removed
+
+    def stats(self):
+        with self._lock:
+            return {'collected': self.collected, 'collected_bytes': self.collected_bytes}
@@ -0,0 +1,59 @@
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+
+import redis
+
+
+class JobUpdates:
+    """Fans the job_updates pub/sub channel out to local subscribers by uuid.
+
+    The whole process shares one Redis subscription, however many clients are
+    waiting; each subscriber gets a queue that receives the decoded updates
+    ({"uuid", "event", ...}) of the uuids it asked for.
+    """
+
+    def __init__(self, r, channel):
+        self.r = r
+        self.channel = channel
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._thread = None
+
+    def subscribe(self, uuids):
+        updates = queue.Queue()
+        with self._lock:
+            for job_uuid in uuids:
+                self._subscribers[job_uuid].add(updates)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return updates
+
+    def unsubscribe(self, updates, uuids):
+        with self._lock:
+            for job_uuid in uuids:
+                subscribers = self._subscribers.get(job_uuid)
+                if subscribers is not None:
+                    subscribers.discard(updates)
+                    if not subscribers:
+                        del self._subscribers[job_uuid]
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    self._dispatch(json.loads(message['data']))
+            except redis.RedisError as e:
+                print(f"job_updates subscription lost: {e}")
+                time.sleep(1)
+
+    def _dispatch(self, update):
+        with self._lock:
+            subscribers = list(self._subscribers.get(update['uuid'], ()))
+        for updates in subscribers:
+            updates.put(update)
@@ -0,0 +1,353 @@
+# Per-job state records shared by the server, puller, observer and autoscaler.
+#
+# Every component image ships its own copy of this file (server/, puller/,
+# observer/, autoscaler/); keep them identical.
+#
+#   job:<uuid>        hash   params, payload, cost, priority, status, namespace, attempts,
+#                            submitted_at, updated_at, ranks (MPI ranks of its last run)
+#   jobs:<status>     set    uuids currently in that status (queued, running, success, fail,
+#                            retrying, quarantined); the autoscaler removes a success once it
+#                            has handled it, and prune_index the ones whose record expired
+#   retry_at          zset   uuids of failed jobs waiting out their retry backoff, scored by
+#                            the time they go back to the queue
+#   pending_tasks     zset   payloads (uuid, submitted_at, cost and the render parameters) of
+#                            queued jobs scored by priority (lowest runs first)
+#   pending_signal    list   one token per enqueue; idle pullers block on it
+#   job_events        stream one entry per transition (uuid, from, to, namespace, at)
+#   ns_jobs:<ns>      list   uuids of the batch last started in that namespace
+#   job_counters      hash   queued_cost (cost of queued jobs), submitted / submitted_cost
+#                            and completed_cost (monotonic totals for rate estimates)
+#   rank_runs         list   JSON {"ranks", "cost", "blocks", "seconds"} of recent renders,
+#                            newest first; calibrates the puller's rank model
+#   job_updates       pubsub JSON {"uuid", "event": "progress" | "ready" | "failed", "progress",
+#                            "error"} pushed to clients; "ready" is published by the socket
+#                            handler, "failed" by the autoscaler when it quarantines a job
+#
+# All updates go through the Lua below, so a transition is a single atomic,
+# constant-time operation regardless of how many jobs exist. Entering `queued`
+# puts the job's payload in pending_tasks and leaving it takes it out, so queue
+# membership and status can never disagree.
+#
+# Priority is shortest-job-first with aging: a job's score is its first enqueue
+# time plus cost / PRIORITY_COST_RATE seconds. Small jobs overtake large ones,
+# but a large job is never overtaken by jobs submitted more than its cost
+# allowance later. Retries keep their original score. Interactive previews are
+# enqueued with a `boost` (seconds subtracted from the score), which puts them
+# ahead of every ordinary job submitted within that window.
+#
+# A failed job is retried after a backoff (running -> fail -> retrying ->
+# queued) until the autoscaler gives up on it and quarantines it.
+import json
+import os
+import time
+
+JOB_TTL = 24 * 3600      # seconds a finished job record is kept
+EVENTS_MAXLEN = 10000    # approximate length cap of the job_events stream
+RANK_RUNS_MAXLEN = 2000  # timed renders kept in rank_runs
+COST_AHEAD_SCAN = 256    # queued jobs queue_position sums exactly
+UPDATES_CHANNEL = 'job_updates'
+
+# Relative cost per pixel-sample of each fractal type, e.g. "0:1,1:1.5"
+TYPE_WEIGHTS = {int(t): float(w) for t, w in
+                (pair.split(':') for pair in os.getenv("COST_TYPE_WEIGHTS", "").split(',') if pair)}
+
+
+# Pixel-samples of cost that delay a job by one second of queue priority
+PRIORITY_COST_RATE = float(os.getenv("PRIORITY_COST_RATE", 1e6))
+
+
+def job_cost(params):
+    """Estimated render cost in pixel-samples, weighted by fractal type."""
+    work = params['width'] * params['height'] * params['samples']
+    return work * TYPE_WEIGHTS.get(params['type'], 1.0)
+
+
+def job_blocks(params):
+    """Number of block_size x block_size blocks the MPI master hands out."""
+    size = params['block_size']
+    return -(-params['width'] // size) * -(-params['height'] // size)
+
+
+# Lua helper prepended to every script that changes a job's status. Returns the
+# previous status, or false when the job does not exist or is not in `expected`.
+LUA_TRANSITION = """
+local function transition(job_uuid, expected, new, namespace, now)
+    local job = 'job:' .. job_uuid
+    local current = redis.call('HGET', job, 'status')
+    if not current or (expected ~= '' and current ~= expected) then
+        return false
+    end
+    redis.call('SREM', 'jobs:' .. current, job_uuid)
+    redis.call('SADD', 'jobs:' .. new, job_uuid)
+    redis.call('HSET', job, 'status', new, 'updated_at', now)
+    local cost = tonumber(redis.call('HGET', job, 'cost') or '0')
+    if current == 'queued' then
+        redis.call('HINCRBYFLOAT', 'job_counters', 'queued_cost', -cost)
+        redis.call('ZREM', 'pending_tasks', redis.call('HGET', job, 'payload'))
+    end
+    if new == 'queued' then
+        redis.call('HINCRBYFLOAT', 'job_counters', 'queued_cost', cost)
+        redis.call('ZADD', 'pending_tasks', redis.call('HGET', job, 'priority'),
+                   redis.call('HGET', job, 'payload'))
+        redis.call('LPUSH', 'pending_signal', 1)
+        redis.call('LTRIM', 'pending_signal', 0, 999)
+    elseif new == 'success' then
+        redis.call('HINCRBYFLOAT', 'job_counters', 'completed_cost', cost)
+    end
+    if namespace ~= '' then
+        redis.call('HSET', job, 'namespace', namespace)
+    end
+    redis.call('XADD', 'job_events', 'MAXLEN', '~', %d, '*',
+               'uuid', job_uuid, 'from', current, 'to', new,
+               'namespace', namespace, 'at', now)
+    return current
+end
+""" % EVENTS_MAXLEN
+
+_TRANSITION = LUA_TRANSITION + """
+return transition(ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5])
+"""
+
+_ENQUEUE = """
+local job_uuid, params, payload, now, cost, priority = ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6]
+redis.call('HSET', 'job:' .. job_uuid, 'params', params, 'payload', payload, 'status', 'queued',
+           'cost', cost, 'priority', priority, 'attempts', 0, 'submitted_at', now, 'updated_at', now)
+redis.call('SADD', 'jobs:queued', job_uuid)
+redis.call('ZADD', 'pending_tasks', priority, payload)
+redis.call('LPUSH', 'pending_signal', 1)
+redis.call('LTRIM', 'pending_signal', 0, 999)
+redis.call('HINCRBYFLOAT', 'job_counters', 'queued_cost', cost)
+redis.call('HINCRBYFLOAT', 'job_counters', 'submitted_cost', cost)
+redis.call('HINCRBY', 'job_counters', 'submitted', 1)
+redis.call('XADD', 'job_events', 'MAXLEN', '~', %d, '*',
+           'uuid', job_uuid, 'from', '', 'to', 'queued', 'namespace', '', 'at', now)
+""" % EVENTS_MAXLEN
+
+# Takes the best job into the processing list and marks it running. If that
+# job is small (width*height*samples <= max_work), keeps taking jobs while the
+# next one is small too, up to `limit`.
+_DEQUEUE = LUA_TRANSITION + """
+local processing, namespace, now = KEYS[1], ARGV[1], ARGV[2]
+local limit, max_work = tonumber(ARGV[3]), tonumber(ARGV[4])
+local jobs = {}
+while #jobs < limit do
+    local head = redis.call('ZRANGE', 'pending_tasks', 0, 0)
+    if #head == 0 then
+        break
+    end
+    local data = cjson.decode(head[1])
+    local small = data['width'] * data['height'] * data['samples'] <= max_work
+    if #jobs > 0 and not small then
+        break
+    end
+    redis.call('LPUSH', processing, head[1])
+    if not transition(data['uuid'], 'queued', 'running', namespace, now) then
+        -- Not a tracked job: take it out of the queue ourselves
+        redis.call('ZREM', 'pending_tasks', head[1])
+    end
+    table.insert(jobs, head[1])
+    if not small then
+        break
+    end
+end
+return jobs
+"""
+
+# Counts the failure and parks a failed job in retry_at until `due`.
+_RETRY = LUA_TRANSITION + """
+local job_uuid, due, now = ARGV[1], ARGV[2], ARGV[3]
+if not transition(job_uuid, 'fail', 'retrying', '', now) then
+    return false
+end
+redis.call('ZADD', 'retry_at', due, job_uuid)
+return redis.call('HINCRBY', 'job:' .. job_uuid, 'attempts', 1)
+"""
+
+# Queues every job whose backoff is over, with its original priority.
+_RELEASE_RETRIES = LUA_TRANSITION + """
+local now = ARGV[1]
+local due = redis.call('ZRANGEBYSCORE', 'retry_at', '-inf', now, 'LIMIT', 0, 1000)
+for _, job_uuid in ipairs(due) do
+    redis.call('ZREM', 'retry_at', job_uuid)
+    transition(job_uuid, 'retrying', 'queued', '', now)
+end
+return #due
+"""
+
+# Number and estimated total cost of the queued jobs ahead of `priority`. The
+# first `limit` of them are summed from their payloads; any further ones are
+# taken to cost the average of the rest of the queue (from queued_cost), so a
+# call stays O(log n + limit) however deep the queue is.
+_COST_AHEAD = """
+local bound, limit = '(' .. ARGV[1], tonumber(ARGV[2])
+local ahead = redis.call('ZCOUNT', 'pending_tasks', '-inf', bound)
+local scanned = redis.call('ZRANGEBYSCORE', 'pending_tasks', '-inf', bound, 'LIMIT', 0, limit)
+local cost = 0
+for _, payload in ipairs(scanned) do
+    local data = cjson.decode(payload)
+    -- Payloads queued before costs were stored in them fall back to the record
+    cost = cost + tonumber(data['cost'] or redis.call('HGET', 'job:' .. data['uuid'], 'cost') or '0')
+end
+if ahead > #scanned then
+    local rest = redis.call('ZCARD', 'pending_tasks') - #scanned
+    local queued = tonumber(redis.call('HGET', 'job_counters', 'queued_cost') or '0')
+    cost = cost + math.max(queued - cost, 0) / rest * (ahead - #scanned)
+end
+return {ahead, tostring(cost)}
+"""
+
+_scripts = {}
+
+
+def _script(r, name, source):
+    key = (id(r), name)
+    if key not in _scripts:
+        _scripts[key] = r.register_script(source)
+    return _scripts[key]
+
+
+def enqueue_job(r, job_uuid, params, client=None, boost=0):
+    """Records a new job and queues it. `client` may be a pipeline of `r`.
+
+    Returns the job's priority score.
+    """
+    now = time.time()
+    cost = job_cost(params)
+    priority = now - boost + cost / PRIORITY_COST_RATE
+    payload = json.dumps({'uuid': job_uuid, 'submitted_at': now, 'cost': cost, **params})
+    _script(r, 'enqueue', _ENQUEUE)(
+        args=[job_uuid, json.dumps(params), payload, now, cost, priority], client=client)
+    return priority
+
+
+def dequeue_jobs(r, processing_key, namespace, limit=1, max_work=0):
+    """Moves the next job(s) into `processing_key` as running; returns their payloads."""
+    return _script(r, 'dequeue', _DEQUEUE)(
+        keys=[processing_key], args=[namespace, time.time(), limit, max_work])
+
+
+def schedule_retry(r, job_uuid, delay):
+    """Moves a failed job to retrying for `delay` seconds; returns its attempts, or None if refused."""
+    now = time.time()
+    attempts = _script(r, 'retry', _RETRY)(args=[job_uuid, now + delay, now])
+    return attempts if attempts else None
+
+
+def release_retries(r):
+    """Queues the retrying jobs whose backoff is over; returns how many."""
+    return _script(r, 'release_retries', _RELEASE_RETRIES)(args=[time.time()])
+
+
+def wait_for_jobs(r, timeout):
+    """Blocks until a job may have been queued, or `timeout` seconds pass."""
+    r.blpop('pending_signal', timeout)
+
+
+def queue_position(r, priority):
+    """Number of queued jobs ahead of `priority` and the sum of their costs
+    (extrapolated past the first COST_AHEAD_SCAN)."""
+    ahead, cost = _script(r, 'cost_ahead', _COST_AHEAD)(args=[priority, COST_AHEAD_SCAN])
+    return ahead, float(cost)
+
+
+def transition(r, job_uuid, new, expected=None, namespace=None):
+    """Moves a job to `new`; returns the previous status or None if refused."""
+    previous = _script(r, 'transition', _TRANSITION)(
+        args=[job_uuid, expected or '', new, namespace or '', time.time()])
+    return previous.decode() if previous else None
+
+
+def get_job(r, job_uuid):
+    record = r.hgetall(f'job:{job_uuid}')
+    if not record:
+        return None
+    job = {k.decode(): v.decode() for k, v in record.items()}
+    job['params'] = json.loads(job['params'])
+    job['attempts'] = int(job['attempts'])
+    job['cost'] = float(job['cost'])
+    job['priority'] = float(job['priority'])
+    if 'ranks' in job:
+        job['ranks'] = int(job['ranks'])
+    return job
+
+
+def peek_jobs(r, status, count=100):
+    """Up to `count` uuids from the `status` index, left in place.
+
+    Handling a job takes it out of the index (its next transition, or
+    ack_jobs), so a reader that dies first leaves it for the next one.
+    """
+    return [u.decode() for u in r.srandmember(f'jobs:{status}', count)]
+
+
+def ack_jobs(r, status, job_uuids, client=None):
+    """Takes handled uuids out of the `status` index: successes, which have no
+    next status, and jobs whose record is gone."""
+    if job_uuids:
+        (client or r).srem(f'jobs:{status}', *job_uuids)
+
+
+def prune_index(r, status):
+    """Drops the uuids whose job record has expired from the `status` index; returns how many."""
+    key = f'jobs:{status}'
+    members = list(r.sscan_iter(key, count=1000))
+    expired = []
+    for start in range(0, len(members), 1000):
+        batch = members[start:start + 1000]
+        pipe = r.pipeline(transaction=False)
+        for job_uuid in batch:
+            pipe.exists(b'job:' + job_uuid)
+        expired += [u for u, exists in zip(batch, pipe.execute()) if not exists]
+    if expired:
+        r.srem(key, *expired)
+    return len(expired)
+
+
+def expire_job(r, job_uuid):
+    r.expire(f'job:{job_uuid}', JOB_TTL)
+
+
+def set_namespace_jobs(r, namespace, job_uuids):
+    pipe = r.pipeline()
+    pipe.delete(f'ns_jobs:{namespace}')
+    pipe.rpush(f'ns_jobs:{namespace}', *job_uuids)
+    pipe.execute()
+
+
+def set_job_ranks(r, ranks):
+    """Records the number of MPI ranks each job (uuid -> ranks) is about to run on."""
+    pipe = r.pipeline(transaction=False)
+    for job_uuid, count in ranks.items():
+        pipe.hset(f'job:{job_uuid}', 'ranks', count)
+    pipe.execute()
+
+
+def record_run(r, job_uuid, seconds):
+    """Adds a finished render that took `seconds` to rank_runs, if its ranks are known."""
+    job = get_job(r, job_uuid)
+    if not job or 'ranks' not in job:
+        return
+    run = {'ranks': job['ranks'], 'cost': job['cost'], 'blocks': job_blocks(job['params']),
+           'seconds': seconds}
+    pipe = r.pipeline(transaction=False)
+    pipe.lpush('rank_runs', json.dumps(run))
+    pipe.ltrim('rank_runs', 0, RANK_RUNS_MAXLEN - 1)
+    pipe.execute()
+
+
+def rank_runs(r):
+    return [json.loads(run) for run in r.lrange('rank_runs', 0, -1)]
+
+
+def namespace_jobs(r, namespace):
+    return [u.decode() for u in r.lrange(f'ns_jobs:{namespace}', 0, -1)]
+
+
+def publish_progress(r, job_uuid, percent):
+    r.publish(UPDATES_CHANNEL, json.dumps({'uuid': job_uuid, 'event': 'progress', 'progress': percent}))
+
+
+def counters(r):
+    """Current job_counters as floats (missing counters read as 0)."""
+    values = r.hgetall('job_counters')
+    return {k.decode(): float(v) for k, v in values.items()}
@@ -0,0 +1,146 @@
+# Vectorized escape-time renderer for jobs too small to be worth the cluster.
+#
+# For a thumbnail or a preview, queueing, the Kubernetes exec and mpirun
+# startup take far longer than the pixels themselves. The server renders such
+# jobs itself: each image is cut into bands of BAND_ROWS rows and the bands are
+# computed with NumPy on a pool of worker processes.
+#
+# It approximates fractal_mpi rather than reproducing it: the pixel mapping is
+# the one tiling.py assumes, while the iteration cap, the Julia constant and the
+# palettes below are this engine's own. Its images are therefore not
+# pixel-identical to the cluster's, and the server caches and coalesces them
+# under their own keys (app.render_key). Each of the `samples` samples of a
+# pixel is taken at a fixed low-discrepancy offset inside it, and their colors
+# are averaged.
+#
+#   type        0 Mandelbrot, 1 Julia set (c = JULIA_C)
+#   color_mode  0 black and white, 1 grayscale, 2 blue-green-red gradient
+import io
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+MAX_ITERATIONS = int(os.getenv("LOCAL_MAX_ITERATIONS", 256))
+JULIA_C        = complex(os.getenv("LOCAL_JULIA_C", "-0.8+0.156j"))
+BAND_ROWS      = int(os.getenv("LOCAL_BAND_ROWS", 32))
+
+TYPES       = (0, 1)
+COLOR_MODES = (0, 1, 2)
+
+# Gradient stops of color_mode 2, from fast escapes to slow ones
+_GRADIENT_AT = (0.0, 0.5, 1.0)
+_GRADIENT    = ((0, 0, 255), (0, 255, 0), (255, 0, 0))
+
+
+def sample_offsets(samples):
+    """Sub-pixel offsets of a pixel's samples (R2 sequence; the centre for one sample)."""
+    a1, a2 = 0.7548776662466927, 0.5698402909980532
+    return [((0.5 + n * a1) % 1.0, (0.5 + n * a2) % 1.0) for n in range(samples)]
+
+
+def escape_time(c, julia):
+    """Smoothed iteration count at which each point escapes; MAX_ITERATIONS if it never does."""
+    result = np.full(c.shape, float(MAX_ITERATIONS))
+    flat = result.reshape(-1)
+    index = np.arange(c.size)
+    z = c.reshape(-1).copy() if julia else np.zeros(c.size, dtype=complex)
+    k = np.full(c.size, JULIA_C) if julia else c.reshape(-1).copy()
+    for i in range(MAX_ITERATIONS):
+        z = z * z + k
+        escaped = z.real * z.real + z.imag * z.imag > 4.0
+        if escaped.any():
+            flat[index[escaped]] = i + 1 - np.log2(np.log(np.abs(z[escaped])))
+            # Only points still bounded are iterated further
+            bounded = ~escaped
+            z, k, index = z[bounded], k[bounded], index[bounded]
+            if not index.size:
+                break
+    return result
+
+
+def colorize(counts, color_mode):
+    inside = counts >= MAX_ITERATIONS
+    t = np.clip(counts / MAX_ITERATIONS, 0.0, 1.0)
+    if color_mode == 0:
+        rgb = np.repeat(np.where(inside, 0.0, 255.0)[..., None], 3, axis=-1)
+    elif color_mode == 1:
+        rgb = np.repeat((255.0 * np.sqrt(t))[..., None], 3, axis=-1)
+    else:
+        rgb = np.stack([np.interp(t, _GRADIENT_AT, [stop[channel] for stop in _GRADIENT])
+                        for channel in range(3)], axis=-1)
+    rgb[inside] = 0.0
+    return rgb
+
+
+def render_band(params, y0, y1):
+    """Rows [y0, y1) of the image as an (y1 - y0, width, 3) uint8 array."""
+    width, height, zoom = params['width'], params['height'], params['zoom']
+    julia = params['type'] == 1
+    xs = np.arange(width, dtype=float)
+    ys = np.arange(y0, y1, dtype=float)
+    total = np.zeros((y1 - y0, width, 3))
+    for dx, dy in sample_offsets(params['samples']):
+        re = params['camera_x'] + (2 * (xs + dx) / width - 1) * (width / height) / zoom
+        im = params['camera_y'] - (2 * (ys + dy) / height - 1) / zoom
+        c = re[None, :] + 1j * im[:, None]
+        total += colorize(escape_time(c, julia), params['color_mode'])
+    return (total / params['samples']).round().astype(np.uint8)
+
+
+class LocalEngine:
+    """Renders small jobs on `workers` local processes.
+
+    At most `max_pending` jobs are rendered or waiting at a time; `try_acquire`
+    refuses more, and the caller sends those to the cluster instead.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pool = None
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @staticmethod
+    def supports(params):
+        return params['type'] in TYPES and params['color_mode'] in COLOR_MODES and params['zoom'] > 0
+
+    def try_acquire(self):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers)
+            return self._pool
+
+    def start(self):
+        """Forks the workers now. Call it before the process starts other threads."""
+        self.pool().submit(int).result()
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def render(self, params):
+        """Renders the job and returns its PNG."""
+        rows = range(0, params['height'], BAND_ROWS)
+        bands = [self.pool().submit(render_band, params, y, min(y + BAND_ROWS, params['height']))
+                 for y in rows]
+        pixels = np.concatenate([band.result() for band in bands])
+        buf = io.BytesIO()
+        Image.fromarray(pixels, 'RGB').save(buf, format='PNG')
+        return buf.getvalue()
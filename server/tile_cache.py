@@ -0,0 +1,88 @@
+import os
+import threading
+
+
+class TileCache:
+    """Persistent on-disk cache of pyramid tiles bounded by a byte budget.
+
+    Tiles are stored as <root>/<type>/<color_mode>/<z>/<x>/<y>.png. Reads touch
+    the file's mtime, so evicting the oldest mtimes first gives LRU order that
+    survives restarts.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self._bytes = sum(size for _, _, size in self._scan())
+
+    def _path(self, render_type, color_mode, z, x, y):
+        return os.path.join(self.root, str(render_type), str(color_mode), str(z), str(x), f"{y}.png")
+
+    def _scan(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith('.png'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_mtime, st.st_size
+
+    def get(self, *tile):
+        path = self._path(*tile)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, tile, data):
+        path = self._path(*tile)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._bytes += len(data)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Re-scan so the budget reflects what is actually on disk, then drop
+        # the least recently used tiles until we are back to 90% of it.
+        entries = sorted(self._scan(), key=lambda e: e[1])
+        self._bytes = sum(size for _, _, size in entries)
+        target = self.max_bytes * 0.9
+        for path, _, size in entries:
+            if self._bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
@@ -0,0 +1,62 @@
+# Viewport math shared by the job splitter and the tile pyramid.
+#
+# The renderer maps pixel (px, py) of a width x height image to the plane as
+#   x = camera_x + (2 * px / width  - 1) * (width / height) / zoom
+#   y = camera_y - (2 * py / height - 1) / zoom
+# so one pixel spans 2 / (height * zoom) plane units on both axes. A sub-region
+# of the image is therefore rendered by a job with the same pixel span centred
+# on the sub-region.
+#
+# That mapping is assumed, not taken from the renderer's source (fractal_mpi is
+# built from DistributedFractals, outside this repo). testing/check_split_parity.py
+# compares a stitched render with the unsplit one on an MPI node; job splitting
+# (SPLIT_MIN_PIXELS) stays off by default until it passes.
+
+
+def pixel_span(height, zoom):
+    return 2.0 / (height * zoom)
+
+
+def sub_viewport(job_params, x, y, w, h):
+    """Render parameters that produce the w x h region at pixel offset (x, y)."""
+    width, height = job_params['width'], job_params['height']
+    span = pixel_span(height, job_params['zoom'])
+    return {
+        **job_params,
+        'width': w,
+        'height': h,
+        'camera_x': job_params['camera_x'] + (x + w / 2 - width / 2) * span,
+        'camera_y': job_params['camera_y'] - (y + h / 2 - height / 2) * span,
+        'zoom': job_params['zoom'] * height / h,
+    }
+
+
+def split_job(job_params, tile_size):
+    """Splits a render into a grid of independent sub-region jobs.
+
+    Returns a list of ((x, y, w, h), tile_params) in row-major order.
+    """
+    width, height = job_params['width'], job_params['height']
+    tiles = []
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            w = min(tile_size, width - x)
+            h = min(tile_size, height - y)
+            tiles.append(((x, y, w, h), sub_viewport(job_params, x, y, w, h)))
+    return tiles
+
+
+def pyramid_tile(z, x, y, tile_size, extent):
+    """Render parameters of tile (x, y) at level z of a square tile pyramid.
+
+    Level 0 is a single tile covering [-extent, extent] on both axes around the
+    origin; every level doubles the number of tiles per side.
+    """
+    size = 2.0 * extent / (2 ** z)
+    return {
+        'width': tile_size,
+        'height': tile_size,
+        'camera_x': -extent + (x + 0.5) * size,
+        'camera_y': extent - (y + 0.5) * size,
+        'zoom': 2.0 / size,
+    }
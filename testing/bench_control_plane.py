@@ -0,0 +1,835 @@
+#!/usr/bin/env python3
+"""Offline benchmark of the Python control plane.
+
+Runs the real server/app.py, autoscaler/main.py, puller/main.py,
+observer/main.py and socket_handler.py in one process against fakeredis (or a
+real Redis with --redis) and a fake Kubernetes API:
+
+  - namespaces, deployments and statefulsets are kept in memory; creating the
+    puller Deployment starts a puller for that namespace, creating the
+    observer Deployment starts an observer, and pods become ready after
+    --pod-start seconds. Namespaces, pods, deployments and statefulsets are
+    delivered through list + watch like the real API;
+  - exec into the master pod runs a fake fractal_mpi for every job of the
+    batch: it writes the run_and_check.py markers and [STATUS] lines to the
+    master pod's log, then uploads a PNG to socket_handler.py on port 5001
+    with the real wire protocol.
+
+Clients submit jobs through the Flask app and wait for the image in a closed
+loop, either polling /api/get-image (--notify poll) or listening on the
+/api/job-events stream (--notify sse). The report gives submit→start (fake
+fractal_mpi starting) and submit→image latency percentiles, jobs/s, the
+Redis commands each component issued and the Kubernetes API calls (by method;
+a watch counts once, when it is opened). Render time is width*height*samples /
+--render-rate, so with the default rate almost all latency is control plane.
+
+Usage: python3 testing/bench_control_plane.py [--jobs 200] [--concurrency 8]
+       [--size 256] [--render-rate 5e7] [--max-namespaces 2] [--json]
+"""
+import argparse
+import base64
+import bisect
+import collections
+import functools
+import importlib.util
+import io
+import json
+import os
+import random
+import re
+import shlex
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import fakeredis
+import redis
+import redis.asyncio
+import redis.client
+import yaml
+from kubernetes import client, config, utils, watch
+import kubernetes.stream
+from kubernetes.client.rest import ApiException
+from PIL import Image
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+UPLOAD_PORT = 5001  # fixed in socket_handler.py
+
+
+class PodKilled(BaseException):
+    """Raised in the threads of a deleted namespace so they stop like its pods would."""
+
+
+# --- Redis: every component gets its own client that counts its commands ---
+class RedisStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = collections.defaultdict(collections.Counter)
+
+    def add(self, component, command, n=1):
+        with self._lock:
+            self.counts[component][command] += n
+
+    def snapshot(self):
+        with self._lock:
+            return {c: collections.Counter(cmds) for c, cmds in self.counts.items()}
+
+
+STATS = RedisStats()
+_loading = threading.local()   # component being imported: (kind, FakeNamespace or None)
+
+
+def check_alive(namespace):
+    if namespace is not None and namespace.deleted:
+        raise PodKilled()
+
+
+def counting_clients(redis_url):
+    """Returns factories of counting sync and asyncio clients for one shared Redis."""
+    if redis_url:
+        sync_base, async_base = redis.Redis, redis.asyncio.Redis
+        kwargs = {k: v for k, v in redis.connection.parse_url(redis_url).items()
+                  if k in ('host', 'port', 'db', 'password', 'username')}
+    else:
+        sync_base, async_base = fakeredis.FakeRedis, fakeredis.FakeAsyncRedis
+        kwargs = {'server': fakeredis.FakeServer()}
+
+    class CountingRedis(sync_base):
+        def execute_command(self, *args, **options):
+            check_alive(self.bench_namespace)
+            STATS.add(self.bench_component, str(args[0]).upper())
+            return super().execute_command(*args, **options)
+
+        def pipeline(self, transaction=True, shard_hint=None):
+            pipe = super().pipeline(transaction, shard_hint)
+            pipe.bench_component = self.bench_component
+            pipe.bench_namespace = self.bench_namespace
+            return pipe
+
+    class CountingAsyncRedis(async_base):
+        async def execute_command(self, *args, **options):
+            STATS.add(self.bench_component, str(args[0]).upper())
+            return await super().execute_command(*args, **options)
+
+        def pipeline(self, transaction=True, shard_hint=None):
+            pipe = super().pipeline(transaction, shard_hint)
+            pipe.bench_component = self.bench_component
+            return pipe
+
+    def make(cls):
+        def factory(*_, **__):
+            kind, namespace = getattr(_loading, 'component', ('harness', None))
+            instance = cls(**kwargs)
+            instance.bench_component = kind
+            instance.bench_namespace = namespace
+            return instance
+        return factory
+
+    return make(CountingRedis), make(CountingAsyncRedis)
+
+
+def patch_pipelines():
+    def counted(execute):
+        def wrapper(self, *args, **kwargs):
+            component = getattr(self, 'bench_component', None)
+            if component:
+                check_alive(getattr(self, 'bench_namespace', None))
+                for command in self.command_stack:
+                    STATS.add(component, str(command[0][0]).upper())
+            return execute(self, *args, **kwargs)
+        return wrapper
+
+    def counted_async(execute):
+        async def wrapper(self, *args, **kwargs):
+            component = getattr(self, 'bench_component', None)
+            if component:
+                for command in self.command_stack:
+                    STATS.add(component, str(command[0][0]).upper())
+            return await execute(self, *args, **kwargs)
+        return wrapper
+
+    redis.client.Pipeline.execute = counted(redis.client.Pipeline.execute)
+    redis.asyncio.client.Pipeline.execute = counted_async(redis.asyncio.client.Pipeline.execute)
+
+
+# --- Fake Kubernetes API ---
+WATCHED_KINDS = {"Deployment": "deployments", "StatefulSet": "statefulsets"}
+
+
+class FakeNamespace:
+    def __init__(self, name):
+        self.name = name
+        self.obj = client.V1Namespace(metadata=client.V1ObjectMeta(name=name),
+                                      status=client.V1NamespaceStatus(phase="Active"))
+        self.objects = {}                          # (kind, name) -> object
+        self.pods = {}
+        self.logs = collections.defaultdict(list)  # pod name -> lines
+        self.deleted = False
+
+
+class FakeCluster:
+    def __init__(self, args):
+        self.args = args
+        self.cond = threading.Condition()
+        self.namespaces = {}
+        self.resource_version = 0
+        self.events = []       # (resource_version, resource, namespace, type, object)
+        self.api_calls = collections.Counter()  # fake API method (or "watch <resource>") -> calls
+        self.started = {}      # job uuid -> time the fake fractal_mpi started
+        self._png = {}
+        self._next_ip = 0
+
+    # helpers -----------------------------------------------------------
+    def _namespace(self, name):
+        namespace = self.namespaces.get(name)
+        if namespace is None or namespace.deleted:
+            raise ApiException(status=404, reason="Not Found")
+        return namespace
+
+    def _bump(self):
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def _record(self, resource, event_type, obj):
+        # Called with self.cond held, like an object write in the API server
+        obj.metadata.resource_version = self._bump()
+        self.events.append((self.resource_version, resource, obj.metadata.namespace, event_type, obj))
+        self.cond.notify_all()
+
+    def later(self, delay, fn, *args):
+        timer = threading.Timer(delay, fn, args)
+        timer.daemon = True
+        timer.start()
+
+    def add_pod(self, ns_name, name, app):
+        with self.cond:
+            namespace = self.namespaces.get(ns_name)
+            if namespace is None or namespace.deleted:
+                return
+            self._next_ip += 1
+            pod = client.V1Pod(
+                metadata=client.V1ObjectMeta(
+                    name=name, namespace=ns_name, uid=str(uuid.uuid4()), labels={"app": app}),
+                status=client.V1PodStatus(
+                    phase="Running",
+                    pod_ip=f"10.0.{self._next_ip // 256}.{self._next_ip % 256}",
+                    container_statuses=[client.V1ContainerStatus(
+                        name=app, image="fake", image_id="", ready=True, restart_count=0)]))
+            namespace.pods[name] = pod
+            self._record("pods", "ADDED", pod)
+
+    def delete_pod(self, ns_name, name):
+        # Its StatefulSet or Deployment brings it back after --pod-start
+        with self.cond:
+            namespace = self._namespace(ns_name)
+            pod = namespace.pods.pop(name, None)
+            if pod is None:
+                raise ApiException(status=404, reason="Not Found")
+            self._record("pods", "DELETED", pod)
+        self.later(self.args.pod_start, self.add_pod, ns_name, name, pod.metadata.labels["app"])
+
+    def log(self, namespace, pod, line):
+        with self.cond:
+            namespace.logs[pod].append(line)
+            self.cond.notify_all()
+
+    def start_component(self, kind, path, namespace, env):
+        with _load_lock:
+            _loading.component = (kind, namespace)
+            module = load_module(f"{kind}_{namespace.name}", path, env)
+            _loading.component = ('harness', None)
+        if kind == "puller":
+            entry = module.main_loop
+        else:
+            def entry():
+                # The observer exits when the master pod goes away; its container restarts
+                while True:
+                    module.watch_logs()
+                    time.sleep(1)
+        threading.Thread(target=entry, daemon=True).start()
+
+    # namespaces ---------------------------------------------------------
+    def create_namespace(self, name):
+        with self.cond:
+            if name in self.namespaces:
+                raise ApiException(status=409, reason="AlreadyExists")
+            self.namespaces[name] = FakeNamespace(name)
+            self._record("namespaces", "ADDED", self.namespaces[name].obj)
+
+    def delete_namespace(self, name):
+        with self.cond:
+            namespace = self._namespace(name)
+            namespace.deleted = True
+            namespace.obj.status.phase = "Terminating"
+            self._record("namespaces", "MODIFIED", namespace.obj)
+        self.later(self.args.ns_delete, self._remove_namespace, name)
+
+    def _remove_namespace(self, name):
+        with self.cond:
+            namespace = self.namespaces.pop(name, None)
+            if namespace is None:
+                return
+            for pod in namespace.pods.values():
+                self._record("pods", "DELETED", pod)
+            self._record("namespaces", "DELETED", namespace.obj)
+
+    def create_object(self, ns_name, kind, name, obj):
+        with self.cond:
+            namespace = self._namespace(ns_name)
+            if (kind, name) in namespace.objects:
+                raise ApiException(status=409, reason="AlreadyExists")
+            namespace.objects[(kind, name)] = obj
+            # Manifests applied from dicts are stored as they are and not watched
+            if kind in WATCHED_KINDS and not isinstance(obj, dict):
+                obj.metadata.namespace = ns_name
+                self._record(WATCHED_KINDS[kind], "ADDED", obj)
+        return namespace
+
+    def scale_object(self, ns_name, kind, name, replicas):
+        obj = self.read_object(ns_name, kind, name)
+        with self.cond:
+            obj.spec.replicas = replicas
+            self._record(WATCHED_KINDS[kind], "MODIFIED", obj)
+
+    def read_object(self, ns_name, kind, name):
+        with self.cond:
+            obj = self._namespace(ns_name).objects.get((kind, name))
+        if obj is None:
+            raise ApiException(status=404, reason="Not Found")
+        return obj
+
+    def count_api_call(self, name):
+        with self.cond:
+            self.api_calls[name] += 1
+
+    def api_snapshot(self):
+        with self.cond:
+            return collections.Counter(self.api_calls)
+
+    # lists and watches ---------------------------------------------------
+    def list_objects(self, resource, ns_name=None, label_selector=None):
+        """(objects, resource version) of a resource, cluster-wide or in one namespace."""
+        matches = label_matcher(label_selector)
+        with self.cond:
+            if resource == "namespaces":
+                items = [namespace.obj for namespace in self.namespaces.values()]
+            else:
+                if ns_name and (ns_name not in self.namespaces or self.namespaces[ns_name].deleted):
+                    # Only the namespace's own components list it: they are gone with it
+                    raise PodKilled()
+                scope = [self.namespaces[ns_name]] if ns_name else list(self.namespaces.values())
+                items = []
+                for namespace in scope:
+                    if resource == "pods":
+                        items.extend(namespace.pods.values())
+                    else:
+                        items.extend(obj for (kind, _), obj in namespace.objects.items()
+                                     if WATCHED_KINDS.get(kind) == resource and not isinstance(obj, dict))
+            return [obj for obj in items if matches(obj)], str(self.resource_version)
+
+    def watch_events(self, resource, ns_name, resource_version, label_selector=None):
+        matches = label_matcher(label_selector)
+        # A namespaced watch ends with its namespace, like the component running it
+        namespace = self.namespaces.get(ns_name) if ns_name else None
+        if ns_name and namespace is None:
+            raise PodKilled()
+        since = int(resource_version or 0)
+        self.count_api_call(f"watch {resource}")
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: (namespace is not None and namespace.deleted)
+                                   or (self.events and self.events[-1][0] > since))
+                if namespace is not None and namespace.deleted:
+                    raise PodKilled()
+                start = bisect.bisect_right(self.events, since, key=lambda e: e[0])
+                events = self.events[start:]
+            for rv, kind, obj_ns, event_type, obj in events:
+                since = rv
+                if kind == resource and (ns_name is None or obj_ns == ns_name) and matches(obj):
+                    yield {"type": event_type, "object": obj}
+
+    def follow_log(self, ns_name, pod):
+        # Like `kubectl logs -f`: replays the whole log, then follows it
+        namespace = self.namespaces[ns_name]
+        lines = namespace.logs[pod]
+        seen = 0
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: namespace.deleted or len(lines) > seen)
+                if namespace.deleted:
+                    raise PodKilled()
+                new = lines[seen:]
+            seen += len(new)
+            yield from new
+
+    # exec -----------------------------------------------------------------
+    def exec(self, ns_name, pod, command):
+        namespace = self.namespaces.get(ns_name)
+        check_alive(namespace)
+        time.sleep(self.args.exec_latency)
+        script = command[-1]
+        if "run_and_check.py --batch" not in script:
+            return ""
+        manifest = json.loads(base64.b64decode(shlex.split(script)[3]))
+        for job in manifest:
+            self.fake_fractal_mpi(namespace, pod, job["uuid"], job["cmd"])
+        return ""
+
+    def fake_fractal_mpi(self, namespace, pod, job_uuid, cmd):
+        self.log(namespace, pod, f"[TASK] {job_uuid} Master is running...")
+        self.started[job_uuid] = time.time()
+        opts = dict(zip(cmd[::2], cmd[1::2]))
+        width, height = int(opts["--width"]), int(opts["--height"])
+        duration = width * height * int(opts["--samples"]) / self.args.render_rate
+        for percent in (25, 50, 75, 100):
+            time.sleep(duration / 4)
+            check_alive(namespace)
+            # run_and_check.py tags the program's output with the job
+            self.log(namespace, pod, f"[JOB {job_uuid}] [STATUS] {percent:.1f}%")
+
+        if random.random() < self.args.fail_rate:
+            self.log(namespace, pod, f"[ERROR] {job_uuid} Program exited with code 1")
+            return
+        upload_image(job_uuid, self.png(width, height))
+        self.log(namespace, pod, f"[SUCCESS] {job_uuid} Program finished with exit code 0")
+
+    def png(self, width, height):
+        if (width, height) not in self._png:
+            buf = io.BytesIO()
+            Image.new("RGB", (width, height), (40, 90, 160)).save(buf, "PNG")
+            self._png[(width, height)] = buf.getvalue()
+        return self._png[(width, height)]
+
+
+def upload_image(job_uuid, data):
+    """Sends an image to socket_handler.py the way fractal_mpi does."""
+    encoded = job_uuid.encode()
+    with socket.create_connection(("127.0.0.1", UPLOAD_PORT)) as sock:
+        sock.sendall(struct.pack(">I", len(encoded)) + encoded + struct.pack(">I", len(data)))
+        sock.sendall(data)
+
+
+class CountedApi:
+    """Counts every call of the fake API's public methods in cluster.api_calls."""
+
+    def __getattribute__(self, name):
+        attr = object.__getattribute__(self, name)
+        if name.startswith("_") or name == "cluster" or not callable(attr):
+            return attr
+        cluster = object.__getattribute__(self, "cluster")
+
+        @functools.wraps(attr)
+        def counted(*args, **kwargs):
+            cluster.count_api_call(name)
+            return attr(*args, **kwargs)
+        counted.__self__ = self  # FakeWatch finds the API through it
+        return counted
+
+
+class FakeCoreV1Api(CountedApi):
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def list_namespace(self, **_):
+        items, version = self.cluster.list_objects("namespaces")
+        return client.V1NamespaceList(items=items, metadata=client.V1ListMeta(resource_version=version))
+
+    def create_namespace(self, body):
+        self.cluster.create_namespace(body.metadata.name)
+
+    def delete_namespace(self, name):
+        self.cluster.delete_namespace(name)
+
+    def list_namespaced_pod(self, namespace, **_):
+        items, version = self.cluster.list_objects("pods", namespace)
+        return client.V1PodList(items=items, metadata=client.V1ListMeta(resource_version=version))
+
+    def list_pod_for_all_namespaces(self, label_selector=None, **_):
+        items, version = self.cluster.list_objects("pods", label_selector=label_selector)
+        return client.V1PodList(items=items, metadata=client.V1ListMeta(resource_version=version))
+
+    def delete_namespaced_pod(self, name, namespace):
+        self.cluster.delete_pod(namespace, name)
+
+    def read_namespaced_pod(self, name, namespace):
+        with self.cluster.cond:
+            pod = self.cluster._namespace(namespace).pods.get(name)
+        if pod is None:
+            raise ApiException(status=404, reason="Not Found")
+        return pod
+
+    def read_namespaced_pod_log(self, name, namespace, **_):
+        raise NotImplementedError("only used through watch.Watch().stream")
+
+    def connect_get_namespaced_pod_exec(self, name, namespace, command, **_):
+        return self.cluster.exec(namespace, name, command)
+
+    def create_namespaced_service(self, namespace, body):
+        self.cluster.create_object(namespace, "Service", body.metadata.name, body)
+
+
+class FakeAppsV1Api(CountedApi):
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def create_namespaced_stateful_set(self, namespace, body):
+        self.cluster.create_object(namespace, "StatefulSet", body.metadata.name, body)
+        app = body.spec.template.metadata.labels["app"]
+        for i in range(body.spec.replicas):
+            self.cluster.later(self.cluster.args.pod_start, self.cluster.add_pod,
+                               namespace, f"{body.metadata.name}-{i}", app)
+
+    def read_namespaced_stateful_set(self, name, namespace):
+        return self.cluster.read_object(namespace, "StatefulSet", name)
+
+    def patch_namespaced_stateful_set_scale(self, name, namespace, body):
+        self.cluster.scale_object(namespace, "StatefulSet", name, body["spec"]["replicas"])
+
+    def list_namespaced_stateful_set(self, namespace, **_):
+        items, version = self.cluster.list_objects("statefulsets", namespace)
+        return client.V1StatefulSetList(items=items, metadata=client.V1ListMeta(resource_version=version))
+
+    def create_namespaced_deployment(self, namespace, body):
+        cluster = self.cluster
+        ns = cluster.create_object(namespace, "Deployment", body.metadata.name, body)
+        container = body.spec.template.spec.containers[0]
+        env = {e.name: e.value for e in container.env or []}
+        app = body.spec.template.metadata.labels["app"]
+
+        def start():
+            cluster.start_component("observer", os.path.join(ROOT, "observer", "main.py"), ns, env)
+            cluster.add_pod(namespace, f"{body.metadata.name}-0", app)
+        cluster.later(cluster.args.pod_start, start)
+
+    def read_namespaced_deployment(self, name, namespace):
+        return self.cluster.read_object(namespace, "Deployment", name)
+
+    def patch_namespaced_deployment_scale(self, name, namespace, body):
+        self.cluster.scale_object(namespace, "Deployment", name, body["spec"]["replicas"])
+
+    def list_namespaced_deployment(self, namespace, **_):
+        items, version = self.cluster.list_objects("deployments", namespace)
+        return client.V1DeploymentList(items=items, metadata=client.V1ListMeta(resource_version=version))
+
+
+class FakeWatch:
+    # list function -> (resource, namespaced)
+    WATCHABLE = {
+        "list_namespace": ("namespaces", False),
+        "list_pod_for_all_namespaces": ("pods", False),
+        "list_namespaced_pod": ("pods", True),
+        "list_namespaced_deployment": ("deployments", True),
+        "list_namespaced_stateful_set": ("statefulsets", True),
+    }
+
+    def stream(self, func, *args, **kwargs):
+        api = func.__self__
+        if func.__name__ in self.WATCHABLE:
+            resource, namespaced = self.WATCHABLE[func.__name__]
+            return api.cluster.watch_events(resource, args[0] if namespaced else None,
+                                            kwargs.get("resource_version"), kwargs.get("label_selector"))
+        if func.__name__ == "read_namespaced_pod_log":
+            return api.cluster.follow_log(kwargs["namespace"], kwargs["name"])
+        raise NotImplementedError(func.__name__)
+
+    def stop(self):
+        pass
+
+
+def label_matcher(selector):
+    """Predicate of a label selector: comma-separated `key=value` and `key in (a,b)` terms."""
+    terms = []
+    for term in re.findall(r"[^,(]+(?:\([^)]*\))?", selector or ""):
+        term = term.strip()
+        if " in " in term:
+            key, values = term.split(" in ", 1)
+            terms.append((key.strip(), {v.strip() for v in values.strip("() ").split(",")}))
+        elif term:
+            key, value = term.split("=", 1)
+            terms.append((key.strip(), {value.strip()}))
+
+    def matches(obj):
+        labels = obj.metadata.labels or {}
+        return all(labels.get(key) in values for key, values in terms)
+    return matches
+
+
+def fake_create_from_dict(cluster):
+    def create_from_dict(_, data, namespace=None, **__):
+        kind, name = data["kind"], data["metadata"]["name"]
+        try:
+            ns = cluster.create_object(namespace, kind, name, data)
+        except ApiException as e:
+            raise utils.FailToCreateError([e])
+        if kind == "Deployment" and name == "puller":
+            container = data["spec"]["template"]["spec"]["containers"][0]
+            env = {e["name"]: e.get("value", namespace) for e in container.get("env", [])}
+            env.update(cluster.args.puller_env)
+            cluster.later(cluster.args.pod_start, cluster.start_component,
+                          "puller", os.path.join(ROOT, "puller", "main.py"), ns, env)
+    return create_from_dict
+
+
+def fake_stream(func, name, namespace, command, **_):
+    return func(name=name, namespace=namespace, command=command)
+
+
+# --- Loading the components ---
+_load_lock = threading.RLock()
+
+
+def load_module(module_name, path, env):
+    """Imports `path` as `module_name` with `env` applied to os.environ meanwhile."""
+    directory = os.path.dirname(path)
+    saved = dict(os.environ)
+    os.environ.update(env)
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        sys.path.remove(directory)
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def load_component(kind, path, env=None):
+    with _load_lock:
+        _loading.component = (kind, None)
+        try:
+            return load_module(kind, path, env or {})
+        finally:
+            _loading.component = ('harness', None)
+
+
+def install_fakes(cluster, redis_url):
+    sync_factory, async_factory = counting_clients(redis_url)
+    redis.Redis = sync_factory
+    redis.asyncio.Redis = async_factory
+    patch_pipelines()
+
+    config.load_incluster_config = lambda *_, **__: None
+    client.CoreV1Api = lambda *_, **__: FakeCoreV1Api(cluster)
+    client.AppsV1Api = lambda *_, **__: FakeAppsV1Api(cluster)
+    client.ApiClient = lambda *_, **__: object()
+    watch.Watch = FakeWatch
+    kubernetes.stream.stream = fake_stream
+    utils.create_from_dict = fake_create_from_dict(cluster)
+
+    default_hook = threading.excepthook
+    threading.excepthook = lambda a: None if a.exc_type is PodKilled else default_hook(a)
+
+
+def write_manifests(directory):
+    configmap = os.path.join(ROOT, "manifests", "autoscaler", "autoscaler-configmap.yaml")
+    with open(configmap) as f:
+        for name, content in yaml.safe_load(f)["data"].items():
+            with open(os.path.join(directory, name), "w") as out:
+                out.write(content)
+
+
+def start_socket_handler():
+    import asyncio
+    module = load_component("socket_handler", os.path.join(ROOT, "mpi-node", "slim", "socket_handler.py"))
+    threading.Thread(target=lambda: asyncio.run(module.run_server()), daemon=True).start()
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", UPLOAD_PORT), timeout=1).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+# --- Workload ---
+def job_body(size, samples):
+    return {
+        "width": size, "height": size, "block_size": 64, "samples": samples,
+        "camerax": random.uniform(-1.5, 0.5), "cameray": random.uniform(-1, 1),
+        "zoom": random.uniform(1, 100), "type": 0, "color_mode": 0,
+    }
+
+
+def wait_for_ready(http, job_uuid):
+    resp = http.get(f"/api/job-events/{job_uuid}", buffered=False)
+    try:
+        for chunk in resp.response:
+            if b"event: ready" in chunk:
+                return
+    finally:
+        resp.close()
+
+
+def run_job(http, body, args, deadline):
+    """Submits one job and waits until its image arrives; returns (uuid, submitted, done)."""
+    submitted = time.time()
+    resp = http.put("/api/submit-job", json=body)
+    if resp.status_code != 202:
+        return None, submitted, None
+    job_uuid = resp.get_json()["uuid"]
+    if args.notify == "sse":
+        wait_for_ready(http, job_uuid)
+    while time.time() < deadline:
+        resp = http.get(f"/api/get-image/{job_uuid}")
+        if resp.status_code == 200:
+            return job_uuid, submitted, time.time()
+        if resp.status_code != 202:
+            break
+        time.sleep(args.poll_interval)
+    return job_uuid, submitted, None
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": values[-1]}
+
+
+def run_benchmark(args, server, cluster):
+    http = server.app.test_client()
+    deadline = time.time() + args.timeout
+
+    # Cold start: first namespace, pods and observer come up
+    cold = run_job(http, job_body(args.size, args.samples), args, deadline)
+    if cold[2] is None:
+        raise SystemExit("warm-up job did not finish; is port 5001 free?")
+    before = STATS.snapshot()
+    api_before = cluster.api_snapshot()
+
+    results = []
+    lock = threading.Lock()
+    remaining = iter(range(args.jobs))
+
+    def worker():
+        http = server.app.test_client()
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            result = run_job(http, job_body(args.size, args.samples), args, deadline)
+            with lock:
+                results.append(result)
+
+    started = time.time()
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - started
+
+    after = STATS.snapshot()
+    ops = {c: after[c] - before.get(c, collections.Counter()) for c in after}
+    api_calls = cluster.api_snapshot() - api_before
+    done = [r for r in results if r[2] is not None]
+    start_latency = [cluster.started[u] - s for u, s, _ in done if u in cluster.started]
+    image_latency = [d - s for _, s, d in done]
+    with cluster.cond:
+        namespaces = sorted(n for n, ns in cluster.namespaces.items() if not ns.deleted)
+
+    return {
+        "cold_start_s": cold[2] - cold[1],
+        "jobs": len(results),
+        "completed": len(done),
+        "elapsed_s": elapsed,
+        "jobs_per_s": len(done) / elapsed if elapsed else 0.0,
+        "submit_to_start_ms": {k: v * 1000 for k, v in percentiles(start_latency).items()},
+        "submit_to_image_ms": {k: v * 1000 for k, v in percentiles(image_latency).items()},
+        "redis_ops": {c: {"total": sum(cmds.values()), "per_job": sum(cmds.values()) / max(len(done), 1),
+                          "top": dict(cmds.most_common(5))}
+                      for c, cmds in sorted(ops.items()) if sum(cmds.values())},
+        "k8s_calls": dict(api_calls.most_common()),
+        "namespaces": namespaces,
+    }
+
+
+def print_report(report, out):
+    print(f"cold start          {report['cold_start_s']:.2f} s", file=out)
+    print(f"jobs                {report['completed']}/{report['jobs']} completed "
+          f"in {report['elapsed_s']:.2f} s ({report['jobs_per_s']:.1f} jobs/s)", file=out)
+    for name in ("submit_to_start_ms", "submit_to_image_ms"):
+        pcts = "  ".join(f"{k} {v:8.1f}" for k, v in report[name].items())
+        print(f"{name:<20}{pcts}", file=out)
+    total = sum(c["total"] for c in report["redis_ops"].values())
+    print(f"redis ops           {total} ({total / max(report['completed'], 1):.1f} per job)", file=out)
+    for component, c in report["redis_ops"].items():
+        top = ", ".join(f"{k} {v}" for k, v in c["top"].items())
+        print(f"  {component:<17} {c['total']:>8} {c['per_job']:8.1f}/job  {top}", file=out)
+    calls = ", ".join(f"{k} {v}" for k, v in report["k8s_calls"].items())
+    print(f"k8s api calls       {sum(report['k8s_calls'].values())} ({calls})", file=out)
+    print(f"namespaces          {', '.join(report['namespaces'])}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8, help="clients in the closed loop")
+    parser.add_argument("--size", type=int, default=256, help="image width and height")
+    parser.add_argument("--samples", type=int, default=1)
+    parser.add_argument("--render-rate", type=float, default=5e7, help="fake pixel-samples per second")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of renders that fail")
+    parser.add_argument("--pod-start", type=float, default=0.5, help="seconds until a new pod is ready")
+    parser.add_argument("--ns-delete", type=float, default=1.0, help="seconds a deleted namespace lingers")
+    parser.add_argument("--exec-latency", type=float, default=0.02, help="seconds per pod exec call")
+    parser.add_argument("--notify", default="poll", choices=["poll", "sse"],
+                        help="how clients learn the image is ready")
+    parser.add_argument("--poll-interval", type=float, default=0.02, help="client get-image poll interval")
+    parser.add_argument("--policy", default="cost", choices=["cost", "threshold"])
+    parser.add_argument("--max-namespaces", type=int, default=2)
+    parser.add_argument("--partitions", type=int, default=1, help="PARTITIONS of every puller")
+    parser.add_argument("--redis", metavar="URL", help="use a real Redis (it is flushed) instead of fakeredis")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the components' own output")
+    args = parser.parse_args()
+    args.puller_env = {"BLOCK_TIMEOUT": "1", "PARTITIONS": str(args.partitions)}
+    # Every component's metrics endpoint on a free port
+    os.environ["METRICS_PORT"] = "0"
+
+    out = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    cluster = FakeCluster(args)
+    install_fakes(cluster, args.redis)
+    if args.redis:
+        redis.Redis().flushdb()
+
+    workdir = tempfile.mkdtemp(prefix="bench-control-plane-")
+    manifests = os.path.join(workdir, "manifests")
+    os.makedirs(manifests)
+    write_manifests(manifests)
+
+    # The socket handlers and the server share one blob directory
+    os.environ["BLOB_DIR"] = os.path.join(workdir, "blobs")
+    start_socket_handler()
+    server = load_component("server", os.path.join(ROOT, "server", "app.py"),
+                            {"TILE_CACHE_DIR": os.path.join(workdir, "tiles")})
+    autoscaler = load_component("autoscaler", os.path.join(ROOT, "autoscaler", "main.py"), {
+        "MANIFEST_DIR": manifests,
+        "SCALING_POLICY": args.policy,
+        "MAX_NAMESPACES": str(args.max_namespaces),
+    })
+    threading.Thread(target=autoscaler.main_loop, daemon=True).start()
+
+    report = run_benchmark(args, server, cluster)
+    if args.json:
+        print(json.dumps(report, indent=2), file=out)
+    else:
+        print_report(report, out)
+    out.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
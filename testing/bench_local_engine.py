@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Crossover benchmark of the server's local render engine against the cluster.
+
+Renders square images of every --sizes x --samples combination with
+server/local_engine.py on --workers processes and compares the time with the
+cluster's, either measured end to end on a live deployment (--server URL,
+whose LOCAL_MAX_WORK must be 0 so the jobs really reach the cluster) or
+modelled as --cluster-overhead seconds of queueing, exec and mpirun startup
+plus width*height*samples / --cluster-rate. The report lists both times per
+job and the largest work (width*height*samples) below which the local engine
+always wins: a starting point for LOCAL_MAX_WORK.
+
+Usage: python3 testing/bench_local_engine.py [--sizes 64,128,256,512,1024]
+       [--samples 1,4] [--workers 4] [--server http://fractals:5000] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "server"))
+
+from local_engine import LocalEngine  # noqa: E402
+
+# Seahorse valley: a busy view where most points need many iterations
+VIEW = {"camera_x": -0.745, "camera_y": 0.1, "zoom": 20.0, "type": 0, "color_mode": 2}
+
+
+def job_params(size, samples):
+    return {"width": size, "height": size, "block_size": 64, "samples": samples, **VIEW}
+
+
+def time_local(engine, params, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        engine.render(params)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def time_cluster(server, params, timeout):
+    body = {**params, "camerax": params["camera_x"], "cameray": params["camera_y"]}
+    request = urllib.request.Request(f"{server}/api/submit-job", data=json.dumps(body).encode(),
+                                     method="PUT", headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        job_uuid = json.load(response)["uuid"]
+    while time.perf_counter() - start < timeout:
+        with urllib.request.urlopen(f"{server}/api/get-image/{job_uuid}") as response:
+            if response.status == 200:
+                response.read()
+                return time.perf_counter() - start
+        time.sleep(0.05)
+    return None
+
+
+def crossover(rows):
+    """Largest work such that the local engine wins for every job up to it."""
+    best = 0
+    for row in sorted(rows, key=lambda row: row["work"]):
+        if row["cluster_s"] is not None and row["local_s"] >= row["cluster_s"]:
+            break
+        best = row["work"]
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="64,128,256,512,1024", help="image edge lengths")
+    parser.add_argument("--samples", default="1,4", help="samples per pixel")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeat", type=int, default=3, help="local runs per job (best is kept)")
+    parser.add_argument("--server", metavar="URL", help="measure the cluster through this server")
+    parser.add_argument("--cluster-overhead", type=float, default=3.0,
+                        help="modelled seconds of queueing, exec and mpirun startup")
+    parser.add_argument("--cluster-rate", type=float, default=5e7,
+                        help="modelled cluster pixel-samples per second")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for a cluster job")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    engine = LocalEngine(args.workers, 1)
+    engine.start()
+
+    rows = []
+    for samples in map(int, args.samples.split(",")):
+        for size in map(int, args.sizes.split(",")):
+            params = job_params(size, samples)
+            work = size * size * samples
+            if args.server:
+                cluster_s = time_cluster(args.server.rstrip("/"), params, args.timeout)
+            else:
+                cluster_s = args.cluster_overhead + work / args.cluster_rate
+            rows.append({"size": size, "samples": samples, "work": work,
+                         "local_s": time_local(engine, params, args.repeat), "cluster_s": cluster_s})
+    engine.close()
+
+    report = {"workers": args.workers, "cluster": "measured" if args.server else "model",
+              "jobs": rows, "crossover_work": crossover(rows)}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"local engine on {args.workers} workers vs cluster ({report['cluster']})")
+    print(f"{'size':>6} {'samples':>7} {'work':>12} {'local s':>9} {'cluster s':>10}  faster")
+    for row in rows:
+        cluster_s = row["cluster_s"]
+        faster = "?" if cluster_s is None else ("local" if row["local_s"] < cluster_s else "cluster")
+        cluster = "timeout" if cluster_s is None else f"{cluster_s:.3f}"
+        print(f"{row['size']:>6} {row['samples']:>7} {row['work']:>12} "
+              f"{row['local_s']:>9.3f} {cluster:>10}  {faster}")
+    print(f"suggested LOCAL_MAX_WORK={report['crossover_work']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""Calibration sweep of the puller's rank model (puller/rank_model.py).
+
+Fits the model on timed renders and checks how well it predicts and which
+rank counts it picks for square images of every --sizes x --samples
+combination, on --slots slots:
+
+  - by default the renders are simulated: --runs jobs of random size on a
+    random rank count, timed by t(n) with the --true-* coefficients and
+    --noise relative log-normal noise. The report compares the picked count
+    with the best one under the true coefficients, and its time with that of
+    running on every slot (RANK_POLICY=all);
+  - with --redis URL the renders are the ones the observer recorded
+    (rank_runs). Run the pullers with RANK_EXPLORE=1 so they cover every rank
+    count; --server URL first submits --repeat jobs per size x samples
+    through that server and waits for them.
+
+Every fifth run is held out of the fit; the report gives the mean absolute
+percentage error of the fitted and the default model on those.
+
+Usage: python3 testing/bench_rank_model.py [--sizes 64,256,1024,4096]
+       [--samples 1,4] [--slots 8] [--runs 200]
+       [--redis redis://redis:6379/0 [--server http://fractals:5000]] [--json]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "puller"))
+
+from rank_model import MIN_RANKS, RankModel  # noqa: E402
+
+BLOCK_SIZE = 64
+VIEW = {"camera_x": -0.745, "camera_y": 0.1, "zoom": 20.0, "type": 0, "color_mode": 2}
+
+
+def job_shape(size, samples):
+    """(cost, blocks) of a square job, as jobstate computes them for type 0."""
+    return size * size * samples, math.ceil(size / BLOCK_SIZE) ** 2
+
+
+def simulate(args, truth):
+    sizes, samples = parse_list(args.sizes), parse_list(args.samples)
+    runs = []
+    for _ in range(args.runs):
+        cost, blocks = job_shape(random.choice(sizes), random.choice(samples))
+        ranks = random.randint(MIN_RANKS, args.slots)
+        seconds = truth.predict(ranks, cost, blocks) * random.lognormvariate(0, args.noise)
+        runs.append({"ranks": ranks, "cost": cost, "blocks": blocks, "seconds": seconds})
+    return runs
+
+
+def submit_sweep(server, args):
+    """Submits --repeat jobs per size x samples and waits for every image."""
+    pending = []
+    for samples in parse_list(args.samples):
+        for size in parse_list(args.sizes):
+            for i in range(args.repeat):
+                # Distinct views, so the server neither caches nor coalesces them
+                body = {"width": size, "height": size, "block_size": BLOCK_SIZE, "samples": samples,
+                        **VIEW, "camerax": VIEW["camera_x"] + i * 1e-9, "cameray": VIEW["camera_y"],
+                        "preview": False}
+                request = urllib.request.Request(f"{server}/api/submit-job", method="PUT",
+                                                 data=json.dumps(body).encode(),
+                                                 headers={"Content-Type": "application/json"})
+                with urllib.request.urlopen(request) as response:
+                    pending.append(json.load(response)["uuid"])
+    deadline = time.time() + args.timeout
+    while pending and time.time() < deadline:
+        job_uuid = pending[0]
+        with urllib.request.urlopen(f"{server}/api/get-image/{job_uuid}") as response:
+            if response.status == 200:
+                pending.pop(0)
+                continue
+        time.sleep(0.5)
+    if pending:
+        print(f"{len(pending)} job(s) still unfinished after {args.timeout}s", file=sys.stderr)
+
+
+def recorded_runs(url):
+    import redis
+    return [json.loads(run) for run in redis.Redis.from_url(url).lrange("rank_runs", 0, -1)]
+
+
+def mape(model, runs):
+    if not runs:
+        return None
+    return 100 * sum(abs(model.predict(run["ranks"], run["cost"], run["blocks"]) - run["seconds"])
+                     / run["seconds"] for run in runs) / len(runs)
+
+
+def parse_list(text):
+    return [int(x) for x in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="64,256,1024,4096", help="image edge lengths")
+    parser.add_argument("--samples", default="1,4", help="samples per pixel")
+    parser.add_argument("--slots", type=int, default=8, help="NODE_COUNT * SLOTS_PER_NODE")
+    parser.add_argument("--runs", type=int, default=200, help="simulated renders")
+    parser.add_argument("--noise", type=float, default=0.1, help="simulated log-normal noise")
+    parser.add_argument("--true-startup", type=float, default=1.5)
+    parser.add_argument("--true-per-rank", type=float, default=0.15)
+    parser.add_argument("--true-rate", type=float, default=4e6)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--redis", metavar="URL", help="fit the renders recorded in this Redis")
+    parser.add_argument("--server", metavar="URL", help="submit a sweep through this server first")
+    parser.add_argument("--repeat", type=int, default=3, help="jobs per size x samples (--server)")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds to wait for the sweep")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    truth = None
+    if args.redis:
+        if args.server:
+            submit_sweep(args.server.rstrip("/"), args)
+        runs = recorded_runs(args.redis)
+    else:
+        truth = RankModel(args.true_startup, args.true_per_rank, args.true_rate)
+        runs = simulate(args, truth)
+
+    held_out = runs[::5]
+    fitted = RankModel.fit([run for i, run in enumerate(runs) if i % 5], fallback=RankModel())
+    default = RankModel()
+
+    rows = []
+    for samples in parse_list(args.samples):
+        for size in parse_list(args.sizes):
+            cost, blocks = job_shape(size, samples)
+            ranks = fitted.choose(cost, blocks, args.slots)
+            row = {"size": size, "samples": samples, "ranks": ranks,
+                   "predicted_s": fitted.predict(ranks, cost, blocks),
+                   "predicted_all_s": fitted.predict(args.slots, cost, blocks)}
+            if truth:
+                best = truth.choose(cost, blocks, args.slots)
+                row.update(best_ranks=best, true_s=truth.predict(ranks, cost, blocks),
+                           true_best_s=truth.predict(best, cost, blocks),
+                           true_all_s=truth.predict(args.slots, cost, blocks))
+            rows.append(row)
+
+    report = {"source": "redis" if args.redis else "simulated", "runs": len(runs),
+              "model": vars(fitted), "default": vars(default),
+              "held_out": len(held_out), "mape_fitted": mape(fitted, held_out),
+              "mape_default": mape(default, held_out), "jobs": rows}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{len(runs)} {report['source']} runs, {fitted}")
+    for name in ("fitted", "default"):
+        error = report[f"mape_{name}"]
+        print(f"held-out error ({name} model): " + ("n/a" if error is None else f"{error:.1f}%"))
+    header = f"{'size':>6} {'samples':>7} {'np':>4} {'pred s':>8} {'pred all s':>10}"
+    if truth:
+        header += f" {'best np':>7} {'true s':>8} {'best s':>8} {'all s':>8}"
+    print(header)
+    for row in rows:
+        line = (f"{row['size']:>6} {row['samples']:>7} {row['ranks']:>4} "
+                f"{row['predicted_s']:>8.3f} {row['predicted_all_s']:>10.3f}")
+        if truth:
+            line += (f" {row['best_ranks']:>7} {row['true_s']:>8.3f} "
+                     f"{row['true_best_s']:>8.3f} {row['true_all_s']:>8.3f}")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
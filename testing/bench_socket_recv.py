@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Microbenchmark of the socket_handler.py receive path.
+
+Compares the legacy blocking `data += packet` loop with the asyncio
+`recv_exact` preallocated buffer and the chunked `recv_chunks` stream for 1 MB,
+64 MB and 512 MB
+payloads. Every measurement runs in a fresh interpreter so peak RSS is not
+polluted by earlier runs.
+
+Usage: python3 testing/bench_socket_recv.py [--sizes 1,64,512] [--timeout 120]
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "mpi-node", "slim"))
+
+MB = 1024 * 1024
+VARIANTS = ["legacy", "recv_exact", "recv_chunks"]
+
+
+def legacy_recv_exact(sock, num_bytes):
+    data = b''
+    while len(data) < num_bytes:
+        packet = sock.recv(num_bytes - len(data))
+        if not packet:
+            raise ConnectionError("Client disconnected")
+        data += packet
+    return data
+
+
+def sender(sock, num_bytes):
+    block = b'\0' * MB
+    view = memoryview(block)
+    remaining = num_bytes
+    while remaining:
+        n = min(remaining, MB)
+        sock.sendall(view[:n])
+        remaining -= n
+    sock.close()
+
+
+def child(variant, size_mb):
+    import socket_handler
+
+    num_bytes = size_mb * MB
+    rx, tx = socket.socketpair()
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t = threading.Thread(target=sender, args=(tx, num_bytes))
+
+    async def receive():
+        if variant == "recv_exact":
+            return len(await socket_handler.recv_exact(rx, num_bytes))
+        total = 0
+        async for chunk in socket_handler.recv_chunks(rx, num_bytes):
+            total += len(chunk)
+        return total
+
+    start = time.perf_counter()
+    t.start()
+    if variant == "legacy":
+        received = len(legacy_recv_exact(rx, num_bytes))
+    else:
+        rx.setblocking(False)
+        received = asyncio.run(receive())
+    elapsed = time.perf_counter() - start
+    t.join()
+
+    assert received == num_bytes
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({
+        "seconds": elapsed,
+        "peak_rss_mb": peak_kb / 1024,
+        "rss_growth_mb": (peak_kb - baseline_kb) / 1024,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1,64,512", help="payload sizes in MB")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds per run")
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], int(args.child[1]))
+        return
+
+    print(f"{'size':>7} {'variant':>12} {'MB/s':>10} {'seconds':>9} {'peak RSS':>10} {'RSS growth':>11}")
+    for size_mb in map(int, args.sizes.split(",")):
+        for variant in VARIANTS:
+            try:
+                out = subprocess.run(
+                    [sys.executable, __file__, "--child", variant, str(size_mb)],
+                    capture_output=True, text=True, timeout=args.timeout, check=True,
+                ).stdout
+            except subprocess.TimeoutExpired:
+                print(f"{size_mb:>5}MB {variant:>12} {'timeout':>10}")
+                continue
+            res = json.loads(out)
+            print(f"{size_mb:>5}MB {variant:>12} {size_mb / res['seconds']:>10.1f} "
+                  f"{res['seconds']:>9.3f} {res['peak_rss_mb']:>8.1f}MB {res['rss_growth_mb']:>9.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
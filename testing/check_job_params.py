@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Checks that the server refuses malformed render sizes before admission.
+
+Loads the real server/app.py against fakeredis and submits payloads whose
+width, height, samples or block_size are zero, negative, fractional or not
+numbers, through both submit-job and submit-batch. Each must get 400 without
+touching the client's token bucket, job_counters or pending_tasks; a valid
+payload must still be queued. Exits non-zero on the first failure.
+
+Usage: python3 testing/check_job_params.py
+"""
+import os
+import sys
+import tempfile
+
+import fakeredis
+import redis
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "server"))
+
+VALID = {"width": 64, "height": 64, "block_size": 16, "samples": 1, "camerax": -0.5,
+         "cameray": 0.0, "zoom": 1.0, "type": 0, "color_mode": 2}
+SIZE_FIELDS = ("width", "height", "block_size", "samples")
+BAD_VALUES = (0, -256, 2.5, "-1", "abc", None, True)
+
+
+def load_app():
+    scratch = tempfile.mkdtemp(prefix="check_job_params-")
+    os.environ.setdefault("BLOB_DIR", os.path.join(scratch, "blobs"))
+    os.environ.setdefault("TILE_CACHE_DIR", os.path.join(scratch, "tiles"))
+    server = fakeredis.FakeServer()
+    redis.Redis = lambda *args, **kwargs: fakeredis.FakeRedis(server=server)
+    import app
+    return app
+
+
+def main():
+    app = load_app()
+    http = app.app.test_client()
+    failures = []
+
+    def untouched():
+        return (not app.r.exists("job_counters") and not app.r.zcard("pending_tasks")
+                and not app.r.keys("admission:*"))
+
+    for field in SIZE_FIELDS:
+        for value in BAD_VALUES:
+            body = {**VALID, field: value}
+            for path, payload in (("/api/submit-job", {**body, "preview": True}),
+                                  ("/api/submit-batch", {"jobs": [VALID, body]})):
+                status = http.put(path, json=payload).status_code
+                if status != 400 or not untouched():
+                    failures.append(f"{path} with {field}={value!r}: {status}")
+
+    status = http.put("/api/submit-job", json=VALID).status_code
+    if status != 202 or app.r.zcard("pending_tasks") != 1:
+        failures.append(f"valid payload: {status}")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"OK: {len(SIZE_FIELDS) * len(BAD_VALUES) * 2} malformed submissions refused")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Checks that one job's error does not fail the rest of its batch.
+
+Loads the real observer/main.py against fakeredis and a fake Kubernetes API,
+runs two jobs as one batch in a namespace and replays a master log where the
+first job's program reports an error on its own (tagged) output before
+run_and_check.py's [ERROR] marker, and the second job succeeds. The first job
+must end failed and the second succeeded. Exits non-zero on failure.
+
+Usage: python3 testing/check_observer_errors.py
+"""
+import importlib.util
+import os
+import sys
+import uuid
+from types import SimpleNamespace
+
+import fakeredis
+import redis
+from kubernetes import client, config, watch
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+OBSERVER = os.path.join(HERE, "..", "observer")
+sys.path.insert(0, OBSERVER)
+
+import jobstate  # noqa: E402
+
+NAMESPACE = "fractal-job-check"
+PARAMS = {"width": 64, "height": 64, "block_size": 16, "samples": 1, "camera_x": -0.5,
+          "camera_y": 0.0, "zoom": 1.0, "type": 0, "color_mode": 2}
+
+
+def master_log(failing, passing):
+    return [
+        f"[TASK] {failing} Master is running...",
+        f"[JOB {failing}] [STATUS] 50.0%",
+        f"[JOB {failing}] [ERROR] Out of memory allocating the image",
+        f"[ERROR] {failing} Program exited with code 1",
+        f"[TASK] {passing} Master is running...",
+        f"[JOB {passing}] [STATUS] 100.0%",
+        f"[SUCCESS] {passing} Program finished with exit code 0",
+    ]
+
+
+class FakeCoreV1Api:
+    """The master pod runs while the log is replayed, then is gone."""
+
+    def __init__(self):
+        self.reads = 0
+
+    def read_namespaced_pod(self, name, namespace):
+        self.reads += 1
+        phase = "Running" if self.reads == 1 else "Succeeded"
+        return SimpleNamespace(status=SimpleNamespace(phase=phase))
+
+    def read_namespaced_pod_log(self, **_):
+        raise NotImplementedError("streamed by FakeWatch")
+
+
+def load_observer(server, log):
+    class FakeWatch:
+        def stream(self, func, **_):
+            yield from log
+
+        def stop(self):
+            pass
+
+    redis.Redis = lambda *args, **kwargs: fakeredis.FakeRedis(server=server)
+    config.load_incluster_config = lambda *_, **__: None
+    client.CoreV1Api = FakeCoreV1Api
+    watch.Watch = FakeWatch
+    os.environ["POD_NAMESPACE"] = NAMESPACE
+    spec = importlib.util.spec_from_file_location("observer", os.path.join(OBSERVER, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    server = fakeredis.FakeServer()
+    r = fakeredis.FakeRedis(server=server)
+    failing, passing = str(uuid.uuid4()), str(uuid.uuid4())
+    for job_uuid in (failing, passing):
+        jobstate.enqueue_job(r, job_uuid, PARAMS)
+    jobstate.dequeue_jobs(r, f"processing:{NAMESPACE}", NAMESPACE, limit=2,
+                          max_work=64 * 64)
+    jobstate.set_namespace_jobs(r, NAMESPACE, [failing, passing])
+
+    observer = load_observer(server, master_log(failing, passing))
+    observer.watch_logs()
+
+    statuses = {job_uuid: jobstate.get_job(r, job_uuid)["status"] for job_uuid in (failing, passing)}
+    expected = {failing: "fail", passing: "success"}
+    if statuses != expected:
+        print(f"FAIL: expected {expected}, got {statuses}")
+        sys.exit(1)
+    print("OK: the error failed only its own job")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Checks that a split render stitches back into the unsplit image.
+
+Run it on an MPI master pod, where fractal_mpi is built. It renders one view
+whole, then as the SPLIT_TILE_SIZE tiles the server's splitter
+(server/tiling.py) would queue, pastes the tiles like the socket handler
+does, and compares the two images pixel by pixel. fractal_mpi uploads each
+render here with the socket handler's wire protocol (-on 127.0.0.1 --port).
+
+The check fails when more than --max-mismatch of the pixels differ by more
+than --tolerance on any channel (edges of the set may flip a pixel or two
+from rounding). Splitting (SPLIT_MIN_PIXELS) should stay off until it passes.
+
+Usage: kubectl cp testing/check_split_parity.py server/tiling.py <ns>/mpi-node-0:/tmp/
+       kubectl exec -n <ns> mpi-node-0 -- python3 /tmp/check_split_parity.py
+       [--width 1024] [--height 768] [--tile-size 256] [--ranks 2] [--type 0]
+"""
+import argparse
+import io
+import os
+import socket
+import subprocess
+import sys
+import threading
+import uuid
+
+from PIL import Image, ImageChops
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "server"))
+sys.path.insert(0, HERE)  # tiling.py copied next to this script
+
+from tiling import split_job  # noqa: E402
+
+BUILD = "/home/mpi-user/fractal/DistributedFractals/build"
+FLAGS = ["width", "height", "block_size", "samples", "zoom", "camera_x", "camera_y",
+         "type", "color_mode"]
+
+
+def recv_exact(conn, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = conn.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("sender disconnected")
+        buf += chunk
+    return bytes(buf)
+
+
+class Receiver:
+    """Accepts uploads on `port` and keeps each image by uuid."""
+
+    def __init__(self, port):
+        self.images = {}
+        self.cond = threading.Condition()
+        self.sock = socket.create_server(("127.0.0.1", port))
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            conn, _ = self.sock.accept()
+            with conn:
+                uuid_len = int.from_bytes(recv_exact(conn, 4), "big")
+                job_uuid = recv_exact(conn, uuid_len).decode()
+                size = int.from_bytes(recv_exact(conn, 4), "big")
+                image = Image.open(io.BytesIO(recv_exact(conn, size))).convert("RGB")
+            with self.cond:
+                self.images[job_uuid] = image
+                self.cond.notify_all()
+
+    def pop(self, job_uuid, timeout=30):
+        with self.cond:
+            if not self.cond.wait_for(lambda: job_uuid in self.images, timeout):
+                raise TimeoutError(f"no upload for {job_uuid}")
+            return self.images.pop(job_uuid)
+
+
+def render(params, receiver, args):
+    job_uuid = str(uuid.uuid4())
+    cmd = ["mpirun", "-np", str(args.ranks), f"{BUILD}/fractal_mpi"]
+    for key in FLAGS:
+        cmd += [f"--{key}", str(params[key])]
+    cmd += ["-on", "127.0.0.1", str(args.port), job_uuid]
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    return receiver.pop(job_uuid)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--tile-size", type=int, default=256, help="SPLIT_TILE_SIZE")
+    parser.add_argument("--samples", type=int, default=1)
+    parser.add_argument("--zoom", type=float, default=20.0)
+    parser.add_argument("--camera-x", type=float, default=-0.745)
+    parser.add_argument("--camera-y", type=float, default=0.1)
+    parser.add_argument("--type", type=int, default=0)
+    parser.add_argument("--color-mode", type=int, default=2)
+    parser.add_argument("--ranks", type=int, default=2, help="mpirun -np per render")
+    parser.add_argument("--port", type=int, default=5002, help="where this script receives renders")
+    parser.add_argument("--tolerance", type=int, default=8, help="per-channel difference allowed")
+    parser.add_argument("--max-mismatch", type=float, default=0.001,
+                        help="fraction of pixels allowed above --tolerance")
+    args = parser.parse_args()
+
+    params = {"width": args.width, "height": args.height, "block_size": 64,
+              "samples": args.samples, "zoom": args.zoom, "camera_x": args.camera_x,
+              "camera_y": args.camera_y, "type": args.type, "color_mode": args.color_mode}
+    receiver = Receiver(args.port)
+
+    whole = render(params, receiver, args)
+    stitched = Image.new("RGB", (args.width, args.height))
+    tiles = split_job(params, args.tile_size)
+    for (x, y, w, h), tile_params in tiles:
+        stitched.paste(render(tile_params, receiver, args), (x, y))
+
+    red, green, blue = ImageChops.difference(whole, stitched).split()
+    diff = ImageChops.lighter(ImageChops.lighter(red, green), blue)  # largest channel difference
+    histogram = diff.histogram()
+    mismatched = sum(histogram[args.tolerance + 1:])
+    fraction = mismatched / (args.width * args.height)
+    print(f"{len(tiles)} tiles, {mismatched} of {args.width * args.height} pixels differ "
+          f"by more than {args.tolerance} ({100 * fraction:.3f}%), max difference {diff.getextrema()[1]}")
+    if fraction > args.max_mismatch:
+        whole.save("parity_whole.png")
+        stitched.save("parity_stitched.png")
+        print("FAIL: wrote parity_whole.png and parity_stitched.png")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()